@@ -0,0 +1,66 @@
+import os
+import threading
+from typing import Dict
+
+# 0 desactiva el límite correspondiente.
+MAX_SESIONES = int(os.getenv('MAX_SESIONES', '0'))
+MAX_TURNOS_EN_CURSO = int(os.getenv('MAX_TURNOS_EN_CURSO', '0'))
+
+class ControlAdmision:
+    # Cuenta las sesiones abiertas y los turnos de chat aceptados (en cola o
+    # en curso) de todo el proceso. Lo que supera el límite se rechaza al
+    # momento en lugar de alargar la cola de todos.
+    
+    def __init__(self, max_sesiones: int = MAX_SESIONES, max_turnos: int = MAX_TURNOS_EN_CURSO):
+        self.max_sesiones = max_sesiones
+        self.max_turnos = max_turnos
+        self._bloqueo = threading.Lock()
+        self.sesiones = 0
+        self.turnos = 0
+        self.sesiones_rechazadas = 0
+        self.turnos_rechazados = 0
+    
+    def entrar_sesion(self) -> bool:
+        with self._bloqueo:
+            if self.max_sesiones and self.sesiones >= self.max_sesiones:
+                self.sesiones_rechazadas += 1
+                return False
+            self.sesiones += 1
+            return True
+    
+    def salir_sesion(self):
+        with self._bloqueo:
+            self.sesiones = max(0, self.sesiones - 1)
+    
+    def reservar_turno(self) -> bool:
+        with self._bloqueo:
+            if self.max_turnos and self.turnos >= self.max_turnos:
+                self.turnos_rechazados += 1
+                return False
+            self.turnos += 1
+            return True
+    
+    def liberar_turno(self):
+        with self._bloqueo:
+            self.turnos = max(0, self.turnos - 1)
+    
+    def estadisticas(self) -> Dict:
+        with self._bloqueo:
+            return {
+                'sesiones': self.sesiones,
+                'max_sesiones': self.max_sesiones,
+                'sesiones_rechazadas': self.sesiones_rechazadas,
+                'turnos': self.turnos,
+                'max_turnos': self.max_turnos,
+                'turnos_rechazados': self.turnos_rechazados,
+            }
+
+_control_global = None
+_bloqueo_global = threading.Lock()
+
+def obtener_control_admision() -> ControlAdmision:
+    global _control_global
+    with _bloqueo_global:
+        if _control_global is None:
+            _control_global = ControlAdmision()
+        return _control_global
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+COMPRESION_ARCHIVO = os.getenv('ARCHIVO_COMPRESION', 'zlib')
+DIAS_RETENCION = float(os.getenv('ARCHIVO_DIAS', '180'))
+MENSAJES_CALIENTES_MINIMOS = int(os.getenv('ARCHIVO_MENSAJES_MINIMOS', '200'))
+MENSAJES_POR_SEGMENTO = int(os.getenv('ARCHIVO_MENSAJES_POR_SEGMENTO', '500'))
+NIVEL_ZLIB = 6
+NIVEL_ZSTD = 10
+SEGMENTOS_EN_CACHE = 32
+
+def ruta_archivo(ruta_bd: str) -> str:
+    # El archivo vive junto a la base de datos principal: chatbot.db ->
+    # chatbot_archivo.db.
+    if ruta_bd == ":memory:" or not ruta_bd:
+        return ":memory:"
+    base, extension = os.path.splitext(ruta_bd)
+    return f"{base}_archivo{extension or '.db'}"
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def comprimir_mensajes(mensajes: List[dict], codec: str = COMPRESION_ARCHIVO) -> Tuple[str, bytes]:
+    # Cada mensaje se guarda como [id, rol, contenido, tokens, fecha]. Sin el
+    # paquete zstandard se usa zlib; el códec queda anotado en el segmento.
+    filas = [
+        [m['id'], m['role'], m['content'], m['token_count'], m['timestamp']]
+        for m in mensajes
+    ]
+    datos = json.dumps(filas, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if codec == 'zstd':
+        zstandard = _zstandard()
+        if zstandard is not None:
+            return 'zstd', zstandard.ZstdCompressor(level=NIVEL_ZSTD).compress(datos)
+    return 'zlib', zlib.compress(datos, NIVEL_ZLIB)
+
+def descomprimir_mensajes(codec: str, datos: bytes) -> List[dict]:
+    if codec == 'zlib':
+        crudo = zlib.decompress(datos)
+    elif codec == 'zstd':
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise RuntimeError("El archivo contiene segmentos zstd y el paquete zstandard no está instalado")
+        crudo = zstandard.ZstdDecompressor().decompress(datos)
+    else:
+        raise ValueError(f"Códec de segmento desconocido: {codec}")
+    return [
+        {'id': fila[0], 'role': fila[1], 'content': fila[2], 'token_count': fila[3], 'timestamp': fila[4]}
+        for fila in json.loads(crudo)
+    ]
+
+class CacheSegmentos:
+    # Los segmentos no cambian una vez escritos, así que se guardan ya
+    # descomprimidos por id; al hacer scroll hacia atrás el mismo segmento se
+    # lee varias veces seguidas.
+    
+    def __init__(self, capacidad: int = SEGMENTOS_EN_CACHE):
+        self.capacidad = capacidad
+        self._segmentos: "OrderedDict[int, List[dict]]" = OrderedDict()
+        self._bloqueo = threading.Lock()
+    
+    def obtener(self, id_segmento: int) -> Optional[List[dict]]:
+        with self._bloqueo:
+            mensajes = self._segmentos.get(id_segmento)
+            if mensajes is not None:
+                self._segmentos.move_to_end(id_segmento)
+            return mensajes
+    
+    def guardar(self, id_segmento: int, mensajes: List[dict]):
+        with self._bloqueo:
+            self._segmentos[id_segmento] = mensajes
+            while len(self._segmentos) > self.capacidad:
+                self._segmentos.popitem(last=False)
+    
+    def olvidar(self, ids_segmentos: Iterable[int]):
+        with self._bloqueo:
+            for id_segmento in ids_segmentos:
+                self._segmentos.pop(id_segmento, None)
+
+cache_segmentos = CacheSegmentos()
+
+def main(argumentos: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Mueve los mensajes antiguos a segmentos comprimidos en la base de datos de archivo"
+    )
+    parser.add_argument("--bd", help="ruta de la base de datos (por defecto la de la aplicación)")
+    parser.add_argument("--dias", type=float, default=DIAS_RETENCION,
+                        help="se archivan los mensajes con más de estos días")
+    parser.add_argument("--mantener", type=int, default=MENSAJES_CALIENTES_MINIMOS,
+                        help="mensajes más recientes de cada usuario que nunca se archivan")
+    parser.add_argument("--usuario", type=int, help="archivar solo este id de usuario")
+    parser.add_argument("--activar-vacuum", action="store_true",
+                        help="convierte la base de datos a auto_vacuum incremental (ejecuta VACUUM una vez)")
+    args = parser.parse_args(argumentos)
+    
+    import database as bd
+    
+    if args.bd:
+        bd.NOMBRE_BD = args.bd
+    try:
+        bd.inicializar_base_datos()
+        if args.activar_vacuum:
+            bd.activar_vacuum_incremental()
+            print("auto_vacuum incremental activado")
+        resultado = bd.archivar_mensajes_antiguos(args.dias, args.mantener, id_usuario=args.usuario)
+    finally:
+        bd.cerrar_conexiones()
+    
+    print(f"Usuarios: {resultado['usuarios']}  segmentos: {resultado['segmentos']}  "
+          f"mensajes: {resultado['mensajes']}")
+    if resultado['mensajes']:
+        print(f"Texto: {resultado['bytes_originales'] / 1024:.1f} KiB -> "
+              f"{resultado['bytes_comprimidos'] / 1024:.1f} KiB comprimidos")
+    print(f"Páginas liberadas: {resultado['paginas_liberadas']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,53 @@
+import os
+import time
+import hashlib
+import secrets
+import threading
 import bcrypt
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional, Tuple
 import database as bd
 
+COSTE_BCRYPT = int(os.getenv('BCRYPT_COSTE', '12'))
+TRABAJADORES_BCRYPT = int(os.getenv('BCRYPT_TRABAJADORES', '0')) or (os.cpu_count() or 1)
+DURACION_SESION = float(os.getenv('SESION_DIAS', '30')) * 86400
+
+_pool: Optional[ThreadPoolExecutor] = None
+_bloqueo_pool = threading.Lock()
+
+def _obtener_pool() -> ThreadPoolExecutor:
+    # bcrypt libera el GIL; con un hilo por núcleo cada hash corre a plena
+    # velocidad y los que sobran esperan en cola en lugar de repartirse la CPU.
+    global _pool
+    with _bloqueo_pool:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=TRABAJADORES_BCRYPT, thread_name_prefix="bcrypt")
+        return _pool
+
 def generar_hash_contrasena(contrasena: str) -> str:
-    sal = bcrypt.gensalt()
+    sal = bcrypt.gensalt(rounds=COSTE_BCRYPT)
     hash_generado = bcrypt.hashpw(contrasena.encode('utf-8'), sal)
     return hash_generado.decode('utf-8')
 
 def verificar_contrasena(contrasena: str, hash_contrasena: str) -> bool:
     return bcrypt.checkpw(contrasena.encode('utf-8'), hash_contrasena.encode('utf-8'))
 
-def registrar_usuario(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[int]]:
+def coste_hash(hash_contrasena: str) -> Optional[int]:
+    # Formato "$2b$12$...".
+    partes = hash_contrasena.split('$')
+    try:
+        return int(partes[2])
+    except (IndexError, ValueError):
+        return None
+
+def _actualizar_coste(usuario: dict, contrasena: str):
+    try:
+        nuevo = generar_hash_contrasena(contrasena)
+        bd.actualizar_hash_contrasena(usuario['id'], usuario['password_hash'], nuevo)
+    except Exception as e:
+        print(f"Error al actualizar el hash de la contraseña: {e}")
+
+def _registrar_usuario(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[int]]:
     if not nombre_usuario or len(nombre_usuario) < 3:
         return False, "El nombre de usuario debe tener al menos 3 caracteres", None
     
@@ -29,7 +66,7 @@ def registrar_usuario(nombre_usuario: str, contrasena: str) -> Tuple[bool, str,
     else:
         return False, "Error al crear el usuario", None
 
-def iniciar_sesion(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[dict]]:
+def _iniciar_sesion(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[dict]]:
     if not nombre_usuario or not contrasena:
         return False, "Por favor ingrese usuario y contraseña", None
     
@@ -38,18 +75,66 @@ def iniciar_sesion(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Opt
         return False, "Usuario o contraseña incorrectos", None
     
     if verificar_contrasena(contrasena, usuario['password_hash']):
+        # Un hash con coste menor que el configurado se rehace sin retrasar
+        # el login; los de coste mayor se dejan como están.
+        if (coste_hash(usuario['password_hash']) or 0) < COSTE_BCRYPT:
+            _obtener_pool().submit(_actualizar_coste, usuario, contrasena)
         return True, "Login exitoso", usuario
     else:
         return False, "Usuario o contraseña incorrectos", None
 
-def crear_usuario_predeterminado():
+def registrar_usuario_async(nombre_usuario: str, contrasena: str) -> Future:
+    return _obtener_pool().submit(_registrar_usuario, nombre_usuario, contrasena)
+
+def iniciar_sesion_async(nombre_usuario: str, contrasena: str) -> Future:
+    return _obtener_pool().submit(_iniciar_sesion, nombre_usuario, contrasena)
+
+def registrar_usuario(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[int]]:
+    return registrar_usuario_async(nombre_usuario, contrasena).result()
+
+def iniciar_sesion(nombre_usuario: str, contrasena: str) -> Tuple[bool, str, Optional[dict]]:
+    return iniciar_sesion_async(nombre_usuario, contrasena).result()
+
+def _hash_token(token: str) -> str:
+    # Los tokens tienen 256 bits aleatorios; un SHA-256 basta para no
+    # guardarlos en claro y se comprueba sin bcrypt.
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def crear_sesion(id_usuario: int) -> str:
+    token = secrets.token_urlsafe(32)
+    ahora = time.time()
+    bd.crear_sesion(_hash_token(token), id_usuario, ahora, ahora + DURACION_SESION)
+    return token
+
+def reanudar_sesion(token: Optional[str]) -> Optional[dict]:
+    if not token:
+        return None
+    hash_token = _hash_token(token)
+    ahora = time.time()
+    usuario = bd.obtener_usuario_por_sesion(hash_token, ahora)
+    if usuario:
+        bd.renovar_sesion(hash_token, ahora, ahora + DURACION_SESION)
+    return usuario
+
+def cerrar_sesion(token: Optional[str]):
+    if token:
+        bd.eliminar_sesion(_hash_token(token))
+
+def _crear_usuario_predeterminado():
     nombre_usuario_predeterminado = "admin"
     contrasena_predeterminada = "admin123"
     
     usuario_existente = bd.obtener_usuario_por_nombre(nombre_usuario_predeterminado)
     if not usuario_existente:
-        exito, mensaje, id_usuario = registrar_usuario(nombre_usuario_predeterminado, contrasena_predeterminada)
+        exito, mensaje, id_usuario = _registrar_usuario(nombre_usuario_predeterminado, contrasena_predeterminada)
         if exito:
             print(f"Usuario por defecto creado: {nombre_usuario_predeterminado} / {contrasena_predeterminada}")
             return True
     return False
+
+def crear_usuario_predeterminado():
+    return _obtener_pool().submit(_crear_usuario_predeterminado).result()
+
+def crear_usuario_predeterminado_async() -> Future:
+    # Para no retrasar la primera pantalla con la consulta y el hash.
+    return _obtener_pool().submit(_crear_usuario_predeterminado)
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import tempfile
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import database as bd
+
+PALABRAS = (
+    "hola gracias ayuda cuenta contraseña usuario modelo respuesta pregunta código "
+    "python base datos consulta error servidor archivo configuración instalar "
+    "ejemplo función mensaje historial rápido lento memoria proyecto idea explicar"
+).split()
+
+# bcrypt tarda decenas de milisegundos y varía mucho entre ejecuciones: se
+# mide con un número fijo de repeticiones, independiente de --repeticiones,
+# y su mediana se muestra en --comparar pero no cuenta como regresión.
+REPETICIONES_INICIAR_SESION = 50
+MEDICIONES_SIN_UMBRAL = {'iniciar_sesion'}
+
+class ClienteGroqSimulado:
+    # Sustituto mínimo de groq.Groq: devuelve una respuesta fija, con o sin
+    # streaming, tras una latencia opcional.
+    
+    def __init__(self, latencia: float = 0.0, palabras_respuesta: int = 80):
+        self.latencia = latencia
+        self.respuesta = " ".join(random.Random(0).choice(PALABRAS) for _ in range(palabras_respuesta))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._crear))
+    
+    def _crear(self, model: str, messages: List[Dict], stream: bool = False, **_):
+        if self.latencia:
+            time.sleep(self.latencia)
+        uso = SimpleNamespace(
+            prompt_tokens=sum(bd.estimar_tokens(m['content']) for m in messages),
+            completion_tokens=bd.estimar_tokens(self.respuesta),
+        )
+        if stream:
+            return self._flujo(uso)
+        mensaje = SimpleNamespace(content=self.respuesta)
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje, finish_reason="stop")], usage=uso)
+    
+    def _flujo(self, uso):
+        for palabra in self.respuesta.split(" "):
+            delta = SimpleNamespace(content=palabra + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        yield SimpleNamespace(choices=[], usage=uso)
+
+def texto_aleatorio(rng: random.Random, media_palabras: float) -> str:
+    # Longitudes log-normales: la mayoría de mensajes son cortos y unos pocos
+    # muy largos, como en una conversación real.
+    palabras = max(1, int(rng.lognormvariate(0, 0.6) * media_palabras))
+    return " ".join(rng.choice(PALABRAS) for _ in range(palabras))
+
+def generar_datos_sinteticos(usuarios: int, mensajes_por_usuario: int, semilla: int = 42) -> List[int]:
+    import auth
+    
+    rng = random.Random(semilla)
+    hash_contrasena = auth.generar_hash_contrasena("benchmark")
+    ids = []
+    
+    with bd.obtener_gestor().escritura() as conexion:
+        for i in range(usuarios):
+            cursor = conexion.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (f"bench_{i}", hash_contrasena)
+            )
+            id_usuario = cursor.lastrowid
+            ids.append(id_usuario)
+            
+            filas = []
+            for j in range(mensajes_por_usuario):
+                rol = 'user' if j % 2 == 0 else 'assistant'
+                contenido = texto_aleatorio(rng, 15 if rol == 'user' else 90)
+                filas.append((id_usuario, rol, contenido, bd.estimar_tokens(contenido)))
+            conexion.executemany(
+                "INSERT INTO conversations (user_id, role, content, token_count) VALUES (?, ?, ?, ?)",
+                filas
+            )
+    
+    bd.cache.vaciar()
+    return ids
+
+def medir(funcion: Callable[[int], object], repeticiones: int) -> Dict:
+    tiempos = []
+    for i in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(i)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return resumir_tiempos(tiempos)
+
+def resumir_tiempos(tiempos: List[float]) -> Dict:
+    ordenados = sorted(tiempos)
+    
+    def percentil(p: float) -> float:
+        if len(ordenados) == 1:
+            return ordenados[0]
+        return statistics.quantiles(ordenados, n=100, method='inclusive')[int(p) - 1]
+    
+    return {
+        'n': len(ordenados),
+        'media_ms': statistics.fmean(ordenados),
+        'p50_ms': percentil(50),
+        'p95_ms': percentil(95),
+        'p99_ms': percentil(99),
+        'min_ms': ordenados[0],
+        'max_ms': ordenados[-1],
+    }
+
+def ejecutar(usuarios: int, mensajes: int, repeticiones: int, semilla: int,
+             directorio: Optional[str] = None) -> Dict:
+    from chatbot import ChatBotIA
+    import auth
+    
+    directorio = directorio or tempfile.mkdtemp(prefix="chatbot_bench_")
+    bd.NOMBRE_BD = os.path.join(directorio, "benchmark.db")
+    bd.inicializar_base_datos()
+    
+    inicio = time.perf_counter()
+    ids = generar_datos_sinteticos(usuarios, mensajes, semilla)
+    tiempo_generacion = time.perf_counter() - inicio
+    
+    rng = random.Random(semilla)
+    chatbot = ChatBotIA(compactacion_automatica=False, cliente=ClienteGroqSimulado())
+    # Se mide el coste local; el limitador esperaría por la cuota de la API real.
+    chatbot.limitador = None
+    resultados = {}
+    
+    def usuario_al_azar(_):
+        return ids[rng.randrange(len(ids))]
+    
+    resultados['guardar_mensaje'] = medir(
+        lambda i: bd.guardar_mensaje(usuario_al_azar(i), 'user', texto_aleatorio(rng, 15)),
+        repeticiones,
+    )
+    
+    def historial_en_frio(i):
+        bd.cache.vaciar()
+        bd.obtener_conversaciones_usuario(usuario_al_azar(i))
+    
+    resultados['obtener_conversaciones_usuario_frio'] = medir(historial_en_frio, repeticiones)
+    resultados['obtener_conversaciones_usuario_caliente'] = medir(
+        lambda i: bd.obtener_conversaciones_usuario(ids[0]), repeticiones
+    )
+    
+    def contexto_en_frio(i):
+        bd.cache.vaciar()
+        chatbot.construir_contexto_chat(usuario_al_azar(i))
+    
+    resultados['construir_contexto_chat_frio'] = medir(contexto_en_frio, repeticiones)
+    resultados['construir_contexto_chat_caliente'] = medir(
+        lambda i: chatbot.construir_contexto_chat(ids[0]), repeticiones
+    )
+    resultados['enviar_mensaje'] = medir(
+        lambda i: chatbot.enviar_mensaje(usuario_al_azar(i), texto_aleatorio(rng, 15), usar_cache=False),
+        repeticiones,
+    )
+    resultados['iniciar_sesion'] = medir(
+        lambda i: auth.iniciar_sesion(f"bench_{i % len(ids)}", "benchmark"),
+        REPETICIONES_INICIAR_SESION,
+    )
+    
+    try:
+        import main
+        aplicacion = main.AplicacionChat.__new__(main.AplicacionChat)
+        pagina = bd.obtener_pagina_conversaciones(ids[0], tamano=main.TAMANO_PAGINA_HISTORIAL)
+        resultados['crear_controles_mensajes'] = medir(
+            lambda i: aplicacion.crear_controles_mensajes(pagina), repeticiones
+        )
+    except ImportError as e:
+        print(f"Se omite la medición de la interfaz: {e}")
+    
+    bd.esperar_escrituras()
+    
+    return {
+        'metadatos': {
+            'fecha': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': bd.sqlite3.sqlite_version,
+            'plataforma': platform.platform(),
+            'usuarios': usuarios,
+            'mensajes_por_usuario': mensajes,
+            'repeticiones': repeticiones,
+            'semilla': semilla,
+            'generacion_s': tiempo_generacion,
+        },
+        'resultados': resultados,
+    }
+
+def comparar(actual: Dict, base: Dict, tolerancia: float) -> bool:
+    sin_regresiones = True
+    print(f"{'medición':42} {'base p50':>10} {'actual p50':>11} {'cambio':>8}")
+    for nombre, medida in actual['resultados'].items():
+        anterior = base.get('resultados', {}).get(nombre)
+        if not anterior:
+            print(f"{nombre:42} {'-':>10} {medida['p50_ms']:>10.3f}ms {'nuevo':>8}")
+            continue
+        cambio = (medida['p50_ms'] - anterior['p50_ms']) / anterior['p50_ms'] if anterior['p50_ms'] else 0.0
+        marca = ""
+        if nombre in MEDICIONES_SIN_UMBRAL:
+            marca = "  (informativa)"
+        elif cambio > tolerancia:
+            marca = "  ← regresión"
+            sin_regresiones = False
+        print(f"{nombre:42} {anterior['p50_ms']:>8.3f}ms {medida['p50_ms']:>9.3f}ms {cambio:>+7.1%}{marca}")
+    return sin_regresiones
+
+def main(argumentos: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de la capa de datos, el contexto y la interfaz")
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--mensajes", type=int, default=1000, help="mensajes por usuario")
+    parser.add_argument("--repeticiones", type=int, default=200)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--salida", default="benchmark_resultados.json")
+    parser.add_argument("--comparar", help="resultados anteriores contra los que comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.2,
+                        help="aumento relativo de p50 considerado regresión")
+    args = parser.parse_args(argumentos)
+    
+    resultado = ejecutar(args.usuarios, args.mensajes, args.repeticiones, args.semilla)
+    
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    
+    for nombre, medida in resultado['resultados'].items():
+        print(f"{nombre:42} p50={medida['p50_ms']:.3f}ms p95={medida['p95_ms']:.3f}ms p99={medida['p99_ms']:.3f}ms")
+    print(f"Resultados guardados en {args.salida}")
+    
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        if not comparar(resultado, base, args.tolerancia):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
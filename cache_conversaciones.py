@@ -0,0 +1,173 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+LIMITE_CACHE_BYTES = int(float(os.getenv('CACHE_CONVERSACIONES_MB', '64')) * 1024 * 1024)
+BYTES_POR_MENSAJE = 200
+
+def _tamano_mensaje(mensaje: dict) -> int:
+    return len(mensaje['content']) + BYTES_POR_MENSAJE
+
+class _EntradaUsuario:
+    # 'mensajes' está ordenado por id y contiene todos los mensajes del
+    # usuario con id >= mensajes[0]['id']; si 'completo' es True contiene
+    # todo su historial.
+    __slots__ = ('mensajes', 'completo', 'bytes')
+    
+    def __init__(self, mensajes: List[dict], completo: bool):
+        self.mensajes = mensajes
+        self.completo = completo
+        self.bytes = sum(_tamano_mensaje(m) for m in mensajes)
+
+class CacheConversaciones:
+    
+    def __init__(self, limite_bytes: int = LIMITE_CACHE_BYTES):
+        self.limite_bytes = limite_bytes
+        self._entradas: "OrderedDict[int, _EntradaUsuario]" = OrderedDict()
+        self._versiones: Dict[int, int] = {}
+        self._resumenes: Dict[int, Optional[dict]] = {}
+        self._bytes = 0
+        self._bloqueo = threading.RLock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+    
+    def version(self, id_usuario: int) -> int:
+        with self._bloqueo:
+            return self._versiones.get(id_usuario, 0)
+    
+    def _cambiar_version(self, id_usuario: int):
+        self._versiones[id_usuario] = self._versiones.get(id_usuario, 0) + 1
+    
+    def obtener(self, id_usuario: int, completo: bool = False) -> Optional[List[dict]]:
+        with self._bloqueo:
+            entrada = self._entradas.get(id_usuario)
+            if entrada is None or (completo and not entrada.completo):
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(id_usuario)
+            self.aciertos += 1
+            return entrada.mensajes
+    
+    def obtener_sufijo(self, id_usuario: int) -> Optional[_EntradaUsuario]:
+        with self._bloqueo:
+            entrada = self._entradas.get(id_usuario)
+            if entrada is not None:
+                self._entradas.move_to_end(id_usuario)
+            return entrada
+    
+    def registrar_acierto(self):
+        with self._bloqueo:
+            self.aciertos += 1
+    
+    def registrar_fallo(self):
+        with self._bloqueo:
+            self.fallos += 1
+    
+    def poblar(self, id_usuario: int, mensajes: List[dict], completo: bool, version: int) -> bool:
+        # Solo se guarda si nadie escribió para el usuario desde que se leyó
+        # de SQLite; en caso contrario la lista podría no incluir lo último.
+        entrada = _EntradaUsuario(list(mensajes), completo)
+        with self._bloqueo:
+            if self._versiones.get(id_usuario, 0) != version:
+                return False
+            if entrada.bytes > self.limite_bytes // 2:
+                return False
+            
+            anterior = self._entradas.get(id_usuario)
+            if anterior is not None and not completo and len(anterior.mensajes) >= len(entrada.mensajes):
+                return False
+            self._quitar(id_usuario)
+            self._entradas[id_usuario] = entrada
+            self._bytes += entrada.bytes
+            self._expulsar()
+            return True
+    
+    def agregar(self, id_usuario: int, mensaje: dict):
+        with self._bloqueo:
+            self._cambiar_version(id_usuario)
+            entrada = self._entradas.get(id_usuario)
+            if entrada is None:
+                return
+            entrada.mensajes.append(mensaje)
+            tamano = _tamano_mensaje(mensaje)
+            entrada.bytes += tamano
+            self._bytes += tamano
+            self._entradas.move_to_end(id_usuario)
+            if entrada.bytes > self.limite_bytes // 2:
+                self._recortar(entrada, self.limite_bytes // 4)
+            self._expulsar()
+    
+    def obtener_resumen(self, id_usuario: int):
+        with self._bloqueo:
+            if id_usuario in self._resumenes:
+                self.aciertos += 1
+                return True, self._resumenes[id_usuario]
+            self.fallos += 1
+            return False, None
+    
+    def guardar_resumen(self, id_usuario: int, resumen: Optional[dict], version: int):
+        with self._bloqueo:
+            if self._versiones.get(id_usuario, 0) == version:
+                self._resumenes[id_usuario] = resumen
+    
+    def olvidar_resumen(self, id_usuario: int):
+        with self._bloqueo:
+            self._cambiar_version(id_usuario)
+            self._resumenes.pop(id_usuario, None)
+    
+    def invalidar(self, id_usuario: int):
+        with self._bloqueo:
+            self._cambiar_version(id_usuario)
+            self._quitar(id_usuario)
+            self._resumenes.pop(id_usuario, None)
+    
+    def vaciar(self):
+        with self._bloqueo:
+            for id_usuario in list(self._entradas):
+                self._cambiar_version(id_usuario)
+            self._entradas.clear()
+            self._resumenes.clear()
+            self._bytes = 0
+    
+    def _quitar(self, id_usuario: int):
+        entrada = self._entradas.pop(id_usuario, None)
+        if entrada is not None:
+            self._bytes -= entrada.bytes
+    
+    def _recortar(self, entrada: _EntradaUsuario, objetivo_bytes: int):
+        # Descarta los mensajes más antiguos de un historial que creció
+        # demasiado; el sufijo restante sigue siendo válido.
+        corte = 0
+        liberados = 0
+        while corte < len(entrada.mensajes) - 1 and entrada.bytes - liberados > objetivo_bytes:
+            liberados += _tamano_mensaje(entrada.mensajes[corte])
+            corte += 1
+        if corte:
+            entrada.mensajes = entrada.mensajes[corte:]
+            entrada.completo = False
+            entrada.bytes -= liberados
+            self._bytes -= liberados
+    
+    def _expulsar(self):
+        while self._bytes > self.limite_bytes and self._entradas:
+            id_usuario, entrada = self._entradas.popitem(last=False)
+            self._bytes -= entrada.bytes
+            self._resumenes.pop(id_usuario, None)
+            self.expulsiones += 1
+    
+    def estadisticas(self) -> Dict:
+        with self._bloqueo:
+            consultas = self.aciertos + self.fallos
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+                'expulsiones': self.expulsiones,
+                'usuarios': len(self._entradas),
+                'bytes': self._bytes,
+                'limite_bytes': self.limite_bytes,
+            }
+
+cache = CacheConversaciones()
@@ -0,0 +1,76 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional
+import database as bd
+
+TURNOS_CLAVE_CACHE = int(os.getenv('CACHE_RESPUESTAS_TURNOS', '4'))
+TTL_CACHE_RESPUESTAS = float(os.getenv('CACHE_RESPUESTAS_TTL', '86400'))
+MAX_ENTRADAS_CACHE_RESPUESTAS = int(os.getenv('CACHE_RESPUESTAS_MAX_ENTRADAS', '10000'))
+CACHE_RESPUESTAS_ACTIVA = os.getenv('CACHE_RESPUESTAS', '1') == '1'
+
+_ESPACIOS = re.compile(r"\s+")
+
+def normalizar_texto(texto: str) -> str:
+    return _ESPACIOS.sub(" ", texto).strip().casefold()
+
+class CacheRespuestas:
+    # La clave combina el modelo, los parámetros de muestreo y los últimos
+    # 'turnos' mensajes del contexto (incluido el nuevo) normalizados. Los
+    # mensajes de sistema también entran: el resumen acumulado es privado de
+    # cada usuario y condiciona la respuesta, así que dos usuarios solo
+    # comparten entrada si ninguno tiene resumen o coinciden por completo.
+    
+    def __init__(self, turnos: int = TURNOS_CLAVE_CACHE, ttl: float = TTL_CACHE_RESPUESTAS,
+                 max_entradas: int = MAX_ENTRADAS_CACHE_RESPUESTAS):
+        self.turnos = max(1, turnos)
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._bloqueo = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+    
+    def calcular_clave(self, modelo: str, parametros: Dict, historial_chat: List[Dict]) -> str:
+        sistema = [m for m in historial_chat if m['role'] == 'system']
+        mensajes = [m for m in historial_chat if m['role'] != 'system'][-self.turnos:]
+        contenido = json.dumps(
+            {
+                'modelo': modelo,
+                'parametros': parametros,
+                'sistema': [normalizar_texto(m['content']) for m in sistema],
+                'mensajes': [[m['role'], normalizar_texto(m['content'])] for m in mensajes],
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+    
+    def obtener(self, clave: str) -> Optional[str]:
+        ahora = time.time()
+        respuesta = bd.obtener_respuesta_cache(clave, ahora - self.ttl, ahora)
+        with self._bloqueo:
+            if respuesta is None:
+                self.fallos += 1
+            else:
+                self.aciertos += 1
+        return respuesta
+    
+    def guardar(self, clave: str, modelo: str, respuesta: str):
+        bd.guardar_respuesta_cache(clave, modelo, respuesta, time.time(), self.max_entradas)
+    
+    def purgar_expiradas(self) -> int:
+        return bd.purgar_respuestas_cache(time.time() - self.ttl)
+    
+    def estadisticas(self) -> Dict:
+        with self._bloqueo:
+            consultas = self.aciertos + self.fallos
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+            }
+
+cache_respuestas = CacheRespuestas()
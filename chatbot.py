@@ -1,28 +1,119 @@
 import os
-from typing import List, Dict, Optional
+import time
+import threading
+from typing import List, Dict, Iterator, Optional
 from dotenv import load_dotenv
-from groq import Groq
 import database as bd
+import metricas
+from cache_respuestas import cache_respuestas, CACHE_RESPUESTAS_ACTIVA
+from limitador_groq import LIMITADOR_ACTIVO, obtener_limitador, llamar_con_limite, tokens_de_uso
+from enrutador_modelos import obtener_enrutador
+from clientes_groq import obtener_cliente, calentar
 
 load_dotenv()
 
+URL_BASE_GROQ = os.getenv('GROQ_BASE_URL') or None
+
+PRESUPUESTO_TOKENS_CONTEXTO = int(os.getenv('CONTEXTO_MAX_TOKENS', '6000'))
+PRESUPUESTO_MINIMO_CONTEXTO = 512
+TOKENS_POR_MENSAJE = 4
+
+MENSAJES_RECIENTES_SIN_RESUMIR = int(os.getenv('RESUMEN_MENSAJES_RECIENTES', '20'))
+UMBRAL_COMPACTACION = int(os.getenv('RESUMEN_UMBRAL', '20'))
+TOKENS_POR_LOTE_RESUMEN = 4000
+MAX_TOKENS_RESUMEN = 512
+
+INSTRUCCIONES_RESUMEN = (
+    "Eres un asistente que mantiene la memoria a largo plazo de una conversación. "
+    "Actualiza el resumen existente incorporando los mensajes nuevos. Conserva "
+    "datos del usuario, preferencias, decisiones y temas pendientes. Responde solo "
+    "con el resumen, en el idioma de la conversación y en menos de 300 palabras."
+)
+
+_usuarios_compactando = set()
+_bloqueo_compactacion = threading.Lock()
+
+def precargar_groq():
+    # Importa groq en segundo plano para que el primer ChatBotIA no espere.
+    def importar():
+        try:
+            import groq  # noqa: F401
+        except Exception as e:
+            print(f"No se pudo precargar groq: {e}")
+    threading.Thread(target=importar, name="precarga-groq", daemon=True).start()
+
+def _uso_fragmento(fragmento):
+    # Groq envía el uso en x_groq del último fragmento; otros servidores
+    # compatibles lo envían en 'usage'.
+    uso = getattr(fragmento, 'usage', None)
+    if uso is None:
+        x_groq = getattr(fragmento, 'x_groq', None)
+        uso = getattr(x_groq, 'usage', None) if x_groq is not None else None
+    return uso
+
+def _tokens_prompt(mensajes: List[Dict]) -> int:
+    return sum(bd.estimar_tokens(m['content']) + TOKENS_POR_MENSAJE for m in mensajes)
+
 class ChatBotIA:
     
-    def __init__(self):
-        api_key = os.getenv('GROQ_API_KEY')
-        if not api_key or api_key == 'tu_api_key_aqui':
-            raise ValueError(
-                "Por favor configura tu GROQ_API_KEY en el archivo .env\n"
-                "Obtén una API key gratis en: https://console.groq.com/keys"
-            )
+    def __init__(self, presupuesto_tokens: Optional[int] = None, compactacion_automatica: bool = True,
+                 cliente=None):
+        if cliente is None:
+            api_key = os.getenv('GROQ_API_KEY')
+            if not api_key or api_key == 'tu_api_key_aqui':
+                raise ValueError(
+                    "Por favor configura tu GROQ_API_KEY en el archivo .env\n"
+                    "Obtén una API key gratis en: https://console.groq.com/keys"
+                )
+            # Con el limitador activo los reintentos los gestiona él, que
+            # conoce el presupuesto compartido entre sesiones. groq se importa
+            # al crear el primer cliente compartido.
+            cliente = obtener_cliente(api_key, URL_BASE_GROQ, max_reintentos=0 if LIMITADOR_ACTIVO else 2)
         
-        self.cliente = Groq(api_key=api_key)
-        self.modelo = "llama-3.1-8b-instant"
+        self.cliente = cliente
+        self.limitador = obtener_limitador() if LIMITADOR_ACTIVO else None
+        self.enrutador = obtener_enrutador()
+        # Modelo de referencia para los resúmenes; cada respuesta la sirve el
+        # modelo que elija el enrutador y se guarda en la caché bajo ese modelo.
+        self.modelo = self.enrutador.modelo_preferido
+        self.temperatura = 0.7
+        self.max_tokens = 1024
+        self.presupuesto_tokens = presupuesto_tokens or PRESUPUESTO_TOKENS_CONTEXTO
+        self.compactacion_automatica = compactacion_automatica
+    
+    def calentar_conexion(self):
+        calentar(self.cliente)
+    
+    def presupuesto_contexto(self) -> int:
+        # Con el limitador activo, el contexto más max_tokens no pasa de lo que
+        # puede reservar una petición: un turno con el contexto lleno no vacía
+        # el cubo de tokens que comparten todas las sesiones.
+        if self.limitador is None:
+            return self.presupuesto_tokens
+        disponible = self.limitador.tokens_por_peticion() - self.max_tokens
+        return max(min(self.presupuesto_tokens, disponible), PRESUPUESTO_MINIMO_CONTEXTO)
     
     def construir_contexto_chat(self, id_usuario: int) -> List[Dict]:
-        historial = bd.obtener_conversaciones_usuario(id_usuario)
+        resumen = bd.obtener_resumen_usuario(id_usuario)
         
         historial_chat = []
+        presupuesto = self.presupuesto_contexto()
+        despues_de_id = 0
+        
+        if resumen:
+            historial_chat.append({
+                'role': 'system',
+                'content': f"Resumen de la conversación anterior con este usuario:\n{resumen['summary']}"
+            })
+            presupuesto = max(presupuesto - resumen['token_count'] - TOKENS_POR_MENSAJE, 1)
+            despues_de_id = resumen['last_message_id']
+        
+        historial = bd.obtener_contexto_reciente(
+            id_usuario, presupuesto,
+            tokens_por_mensaje=TOKENS_POR_MENSAJE,
+            despues_de_id=despues_de_id,
+        )
+        
         for mensaje in historial:
             historial_chat.append({
                 'role': mensaje['role'] if mensaje['role'] == 'user' else 'assistant',
@@ -31,39 +122,290 @@ class ChatBotIA:
         
         return historial_chat
     
-    def enviar_mensaje(self, id_usuario: int, mensaje: str) -> str:
-        bd.guardar_mensaje(id_usuario, 'user', mensaje)
+    def _clave_cache(self, modelo: Optional[str], historial_chat: List[Dict]) -> Optional[str]:
+        if modelo is None:
+            return None
+        parametros = {'temperature': self.temperatura, 'max_tokens': self.max_tokens}
+        return cache_respuestas.calcular_clave(modelo, parametros, historial_chat)
+    
+    def _buscar_en_cache(self, historial_chat: List[Dict], tokens_prompt: int) -> Optional[str]:
+        # Se busca la respuesta del modelo que el enrutador elegiría ahora.
+        clave = self._clave_cache(self.enrutador.elegir(tokens_prompt), historial_chat)
+        if clave is None:
+            return None
+        with metricas.tramo('cache_respuestas'):
+            return cache_respuestas.obtener(clave)
+    
+    def _registrar_respuesta(self, id_usuario: int, texto_respuesta: str,
+                             modelo: Optional[str] = None, historial_chat: Optional[List[Dict]] = None):
+        # Con 'modelo' e 'historial_chat' la respuesta se guarda en la caché
+        # bajo el modelo que la generó.
+        metricas.contar('turnos')
+        with metricas.tramo('guardar_respuesta'):
+            bd.guardar_mensaje(id_usuario, 'assistant', texto_respuesta)
         
-        historial_chat = self.construir_contexto_chat(id_usuario)
+        clave_cache = self._clave_cache(modelo, historial_chat) if historial_chat else None
+        if clave_cache and texto_respuesta:
+            try:
+                cache_respuestas.guardar(clave_cache, modelo, texto_respuesta)
+            except Exception as e:
+                print(f"Error al guardar en la caché de respuestas: {e}")
         
-        try:
+        if self.compactacion_automatica:
+            self.programar_compactacion(id_usuario)
+    
+    def _crear_completion(self, clave, mensajes: List[Dict], max_tokens: int, **parametros):
+        # Devuelve la respuesta y los tokens reservados en el limitador, que
+        # se corrigen con _liquidar() cuando se conoce el uso real.
+        if self.limitador is None:
             respuesta = self.cliente.chat.completions.create(
-                model=self.modelo,
-                messages=historial_chat,
-                temperature=0.7,
-                max_tokens=1024,
+                messages=mensajes, max_tokens=max_tokens, **parametros
             )
+            return respuesta, 0
+        reservados = sum(bd.estimar_tokens(m['content']) for m in mensajes) + max_tokens
+        respuesta = llamar_con_limite(
+            self.limitador, self.cliente, clave, reservados,
+            messages=mensajes, max_tokens=max_tokens, **parametros
+        )
+        return respuesta, reservados
+    
+    def _liquidar(self, reservados: int, uso):
+        if self.limitador is not None:
+            self.limitador.liquidar(reservados, tokens_de_uso(uso))
+    
+    def _deltas(self, flujo, reservados: int) -> Iterator[str]:
+        # Texto de un flujo de Groq. Al cerrar el generador (p. ej. al perder
+        # una petición cubierta) se cierra también la conexión y, si no llegó
+        # el uso real, se devuelve la reserva entera al limitador; las
+        # cabeceras de la siguiente respuesta corrigen lo que Groq sí contó.
+        liquidar = metricas.METRICAS_ACTIVAS or reservados
+        liquidado = False
+        try:
+            for fragmento in flujo:
+                if liquidar:
+                    uso = _uso_fragmento(fragmento)
+                    if uso is not None:
+                        self._liquidar(reservados, uso)
+                        metricas.registrar_uso(uso)
+                        liquidado = True
+                if not fragmento.choices:
+                    continue
+                delta = fragmento.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            if reservados and not liquidado and self.limitador is not None:
+                self.limitador.liquidar(reservados, 0)
+            cerrar = getattr(flujo, 'close', None)
+            if cerrar is not None:
+                cerrar()
+    
+    def enviar_mensaje(self, id_usuario: int, mensaje: str, usar_cache: bool = True) -> str:
+        with metricas.tramo('turno'):
+            with metricas.tramo('guardar_mensaje'):
+                bd.guardar_mensaje(id_usuario, 'user', mensaje)
             
-            texto_respuesta = respuesta.choices[0].message.content
+            with metricas.tramo('construir_contexto'):
+                historial_chat = self.construir_contexto_chat(id_usuario)
             
-            bd.guardar_mensaje(id_usuario, 'assistant', texto_respuesta)
+            tokens_prompt = _tokens_prompt(historial_chat)
+            usar_cache = usar_cache and CACHE_RESPUESTAS_ACTIVA
+            if usar_cache:
+                texto_cacheado = self._buscar_en_cache(historial_chat, tokens_prompt)
+                if texto_cacheado is not None:
+                    metricas.contar('aciertos_cache_respuestas')
+                    self._registrar_respuesta(id_usuario, texto_cacheado)
+                    return texto_cacheado
+            
+            def abrir(modelo: str):
+                respuesta, reservados = self._crear_completion(
+                    id_usuario,
+                    historial_chat,
+                    self.max_tokens,
+                    model=modelo,
+                    temperature=self.temperatura,
+                )
+                uso = getattr(respuesta, 'usage', None)
+                self._liquidar(reservados, uso)
+                metricas.registrar_uso(uso)
+                return iter((respuesta,))
             
-            return texto_respuesta
+            try:
+                with metricas.tramo('groq'):
+                    modelo, respuesta, _ = self.enrutador.primera_respuesta(tokens_prompt, abrir)
+                
+                texto_respuesta = respuesta.choices[0].message.content
+                
+                self._registrar_respuesta(
+                    id_usuario, texto_respuesta, modelo, historial_chat if usar_cache else None
+                )
+                
+                return texto_respuesta
+            
+            except Exception as e:
+                metricas.contar('errores_groq')
+                mensaje_error = f"Error al comunicarse con Groq: {str(e)}"
+                print(mensaje_error)
+                return f"Lo siento, ocurrió un error: {str(e)}"
+    
+    def enviar_mensaje_stream(self, id_usuario: int, mensaje: str, usar_cache: bool = True) -> Iterator[str]:
+        # Las etapas se miden sin incluir el tiempo que el consumidor del
+        # generador tarda entre fragmentos.
+        with metricas.tramo('guardar_mensaje'):
+            bd.guardar_mensaje(id_usuario, 'user', mensaje)
+        
+        with metricas.tramo('construir_contexto'):
+            historial_chat = self.construir_contexto_chat(id_usuario)
+        
+        tokens_prompt = _tokens_prompt(historial_chat)
+        usar_cache = usar_cache and CACHE_RESPUESTAS_ACTIVA
+        if usar_cache:
+            texto_cacheado = self._buscar_en_cache(historial_chat, tokens_prompt)
+            if texto_cacheado is not None:
+                metricas.contar('aciertos_cache_respuestas')
+                self._registrar_respuesta(id_usuario, texto_cacheado)
+                yield texto_cacheado
+                return
+        
+        partes = []
+        medir = metricas.METRICAS_ACTIVAS
+        if medir:
+            inicio = time.perf_counter()
+        
+        def abrir(modelo: str):
+            flujo, reservados = self._crear_completion(
+                id_usuario,
+                historial_chat,
+                self.max_tokens,
+                model=modelo,
+                temperature=self.temperatura,
+                stream=True,
+            )
+            return self._deltas(flujo, reservados)
+        
+        resto = None
+        modelo = None
+        try:
+            modelo, primero, resto = self.enrutador.primera_respuesta(tokens_prompt, abrir)
+            if primero is not None:
+                if medir:
+                    metricas.observar('groq_primer_token', time.perf_counter() - inicio)
+                partes.append(primero)
+                yield primero
+            for delta in resto:
+                partes.append(delta)
+                yield delta
         
         except Exception as e:
+            metricas.contar('errores_groq')
             mensaje_error = f"Error al comunicarse con Groq: {str(e)}"
             print(mensaje_error)
-            return f"Lo siento, ocurrió un error: {str(e)}"
+            yield f"Lo siento, ocurrió un error: {str(e)}"
+            return
+        finally:
+            cerrar = getattr(resto, 'close', None)
+            if cerrar is not None:
+                cerrar()
+        
+        if medir:
+            metricas.observar('groq_stream', time.perf_counter() - inicio)
+        self._registrar_respuesta(id_usuario, "".join(partes), modelo, historial_chat if usar_cache else None)
+    
+    def estadisticas_cache_respuestas(self) -> Dict:
+        return cache_respuestas.estadisticas()
+    
+    def estadisticas_modelos(self) -> Dict:
+        return self.enrutador.estadisticas()
+    
+    def necesita_compactacion(self, id_usuario: int) -> bool:
+        resumen = bd.obtener_resumen_usuario(id_usuario)
+        despues_de_id = resumen['last_message_id'] if resumen else 0
+        pendientes = bd.contar_mensajes_posteriores(id_usuario, despues_de_id)
+        return pendientes > MENSAJES_RECIENTES_SIN_RESUMIR + UMBRAL_COMPACTACION
+    
+    def programar_compactacion(self, id_usuario: int):
+        with _bloqueo_compactacion:
+            if id_usuario in _usuarios_compactando:
+                return
+            _usuarios_compactando.add(id_usuario)
+        
+        def tarea():
+            try:
+                if self.necesita_compactacion(id_usuario):
+                    self.compactar_historial(id_usuario)
+            except Exception as e:
+                print(f"Error al compactar historial: {e}")
+            finally:
+                with _bloqueo_compactacion:
+                    _usuarios_compactando.discard(id_usuario)
+        
+        threading.Thread(target=tarea, daemon=True).start()
+    
+    def compactar_historial(self, id_usuario: int) -> bool:
+        id_corte = bd.obtener_id_corte(id_usuario, MENSAJES_RECIENTES_SIN_RESUMIR)
+        if id_corte is None:
+            return False
+        
+        resumen = bd.obtener_resumen_usuario(id_usuario)
+        texto_resumen = resumen['summary'] if resumen else ""
+        despues_de_id = resumen['last_message_id'] if resumen else 0
+        
+        if despues_de_id >= id_corte:
+            return False
+        
+        pendientes = bd.obtener_mensajes_rango(id_usuario, despues_de_id, id_corte)
+        
+        # Se resume por lotes acotados para que un historial muy largo no
+        # exceda el contexto del modelo; cada lote extiende el resumen previo.
+        lote = []
+        tokens_lote = 0
+        for mensaje in pendientes:
+            lote.append(mensaje)
+            tokens_lote += mensaje['token_count']
+            if tokens_lote >= TOKENS_POR_LOTE_RESUMEN:
+                texto_resumen = self._resumir_lote(texto_resumen, lote)
+                if not bd.guardar_resumen_usuario(id_usuario, texto_resumen, lote[-1]['id']):
+                    return False
+                lote = []
+                tokens_lote = 0
+        
+        if lote:
+            texto_resumen = self._resumir_lote(texto_resumen, lote)
+            if not bd.guardar_resumen_usuario(id_usuario, texto_resumen, lote[-1]['id']):
+                return False
+        
+        return True
+    
+    def _resumir_lote(self, resumen_previo: str, mensajes: List[Dict]) -> str:
+        transcripcion = "\n".join(
+            f"{'Usuario' if m['role'] == 'user' else 'Asistente'}: {m['content']}"
+            for m in mensajes
+        )
+        contenido = (
+            f"Resumen actual:\n{resumen_previo or '(vacío)'}\n\n"
+            f"Mensajes nuevos:\n{transcripcion}"
+        )
+        
+        respuesta, reservados = self._crear_completion(
+            'resumen',
+            [
+                {'role': 'system', 'content': INSTRUCCIONES_RESUMEN},
+                {'role': 'user', 'content': contenido},
+            ],
+            MAX_TOKENS_RESUMEN,
+            model=self.modelo,
+            temperature=0.3,
+        )
+        self._liquidar(reservados, getattr(respuesta, 'usage', None))
+        return respuesta.choices[0].message.content.strip()
     
     def limpiar_historial(self, id_usuario: int):
         bd.limpiar_conversaciones_usuario(id_usuario)
     
     def obtener_resumen_conversacion(self, id_usuario: int) -> Dict:
-        cantidad = bd.obtener_cantidad_conversaciones(id_usuario)
-        conversaciones = bd.obtener_conversaciones_usuario(id_usuario, limite=1)
+        estadisticas = bd.obtener_estadisticas_usuario(id_usuario)
         
         return {
-            'total_mensajes': cantidad,
-            'tiene_historial': cantidad > 0,
-            'ultimo_mensaje': conversaciones[-1] if conversaciones else None
+            **estadisticas,
+            'tiene_historial': estadisticas['total_mensajes'] > 0,
         }
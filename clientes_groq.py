@@ -0,0 +1,72 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import metricas
+
+MAX_CONEXIONES = int(os.getenv('GROQ_MAX_CONEXIONES', '20'))
+CONEXIONES_REPOSO = int(os.getenv('GROQ_CONEXIONES_REPOSO', '10'))
+SEGUNDOS_REPOSO = float(os.getenv('GROQ_SEGUNDOS_REPOSO', '60'))
+HTTP2_ACTIVO = os.getenv('GROQ_HTTP2', '1') == '1'
+CALENTAR_AL_ENTRAR = os.getenv('GROQ_CALENTAR', '1') == '1'
+
+_clientes: Dict[Tuple[str, Optional[str], int], object] = {}
+_bloqueo = threading.Lock()
+
+def _http2_disponible() -> bool:
+    # httpx solo negocia HTTP/2 con el paquete h2 instalado (httpx[http2]).
+    if not HTTP2_ACTIVO:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _crear_cliente(api_key: str, base_url: Optional[str], max_reintentos: int):
+    import httpx
+    from groq import Groq, DefaultHttpxClient
+    
+    http = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONEXIONES,
+            max_keepalive_connections=CONEXIONES_REPOSO,
+            keepalive_expiry=SEGUNDOS_REPOSO,
+        ),
+        http2=_http2_disponible(),
+    )
+    return Groq(api_key=api_key, base_url=base_url, max_retries=max_reintentos, http_client=http)
+
+def obtener_cliente(api_key: str, base_url: Optional[str] = None, max_reintentos: int = 2):
+    # Un cliente por configuración para todo el proceso. Es seguro entre
+    # hilos y conserva las conexiones TLS abiertas entre sesiones, así que
+    # el primer mensaje tras un login no paga un handshake nuevo. No guarda
+    # nada del usuario: eso lo recibe ChatBotIA en cada llamada.
+    clave = (api_key, base_url, max_reintentos)
+    with _bloqueo:
+        cliente = _clientes.get(clave)
+        if cliente is None:
+            cliente = _clientes[clave] = _crear_cliente(api_key, base_url, max_reintentos)
+        return cliente
+
+def calentar(cliente):
+    # Abre una conexión con una petición barata (lista de modelos) para que
+    # el primer mensaje encuentre el handshake hecho. No consume cuota de
+    # chat y los errores se ignoran: el mensaje real volverá a intentarlo.
+    def abrir():
+        try:
+            with metricas.tramo('groq_calentar'):
+                cliente.models.list()
+        except Exception as e:
+            print(f"No se pudo calentar la conexión con Groq: {e}")
+    threading.Thread(target=abrir, name="calentar-groq", daemon=True).start()
+
+def cerrar_clientes():
+    with _bloqueo:
+        clientes = list(_clientes.values())
+        _clientes.clear()
+    for cliente in clientes:
+        try:
+            cliente.close()
+        except Exception:
+            pass
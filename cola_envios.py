@@ -0,0 +1,65 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable
+
+# Los turnos pasan casi todo el tiempo esperando a Groq, así que el pool
+# puede ser bastante mayor que el número de núcleos.
+MAX_TRABAJADORES_ENVIO = int(os.getenv('MAX_TRABAJADORES_ENVIO', '32'))
+
+class ColaPorUsuario:
+    # Ejecuta las tareas de cada clave (id de usuario) en orden de llegada y
+    # de una en una, mientras que claves distintas avanzan en paralelo sobre
+    # un pool de hilos compartido.
+    
+    def __init__(self, max_trabajadores: int = MAX_TRABAJADORES_ENVIO):
+        self._ejecutor = ThreadPoolExecutor(
+            max_workers=max_trabajadores, thread_name_prefix="envio"
+        )
+        self._colas: Dict[Hashable, deque] = {}
+        self._activas = set()
+        self._bloqueo = threading.Lock()
+    
+    def encolar(self, clave: Hashable, tarea: Callable[[], None]) -> int:
+        with self._bloqueo:
+            cola = self._colas.setdefault(clave, deque())
+            cola.append(tarea)
+            pendientes = len(cola) + (1 if clave in self._activas else 0)
+            if clave not in self._activas:
+                self._activas.add(clave)
+                self._ejecutor.submit(self._drenar, clave)
+        return pendientes
+    
+    def pendientes(self, clave: Hashable) -> int:
+        with self._bloqueo:
+            cola = self._colas.get(clave)
+            return (len(cola) if cola else 0) + (1 if clave in self._activas else 0)
+    
+    def _drenar(self, clave: Hashable):
+        while True:
+            with self._bloqueo:
+                cola = self._colas.get(clave)
+                if not cola:
+                    self._colas.pop(clave, None)
+                    self._activas.discard(clave)
+                    return
+                tarea = cola.popleft()
+            
+            try:
+                tarea()
+            except Exception as e:
+                print(f"Error al procesar mensaje en cola: {e}")
+    
+    def cerrar(self, esperar: bool = True):
+        self._ejecutor.shutdown(wait=esperar)
+
+_cola_global = None
+_bloqueo_global = threading.Lock()
+
+def obtener_cola_envios() -> ColaPorUsuario:
+    global _cola_global
+    with _bloqueo_global:
+        if _cola_global is None:
+            _cola_global = ColaPorUsuario()
+        return _cola_global
@@ -0,0 +1,116 @@
+import io
+import sys
+import gzip
+import json
+import time
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from typing import Iterable, Iterator, List, Optional
+
+import database as bd
+
+AVISO_CADA = 100000
+# El nivel 9 de gzip por defecto triplica el tiempo de exportación a cambio
+# de un 5% menos de tamaño.
+NIVEL_GZIP = 3
+
+@contextmanager
+def _abrir(ruta: str, modo: str):
+    # '-' es la entrada o salida estándar; con extensión .gz se comprime al
+    # vuelo.
+    if ruta == '-':
+        flujo = sys.stdin.buffer if modo == 'r' else sys.stdout.buffer
+        texto = io.TextIOWrapper(flujo, encoding='utf-8', newline='\n')
+        try:
+            yield texto
+        finally:
+            texto.flush()
+            texto.detach()
+        return
+    if ruta.endswith('.gz'):
+        f = gzip.open(ruta, modo + 't', compresslevel=NIVEL_GZIP, encoding='utf-8', newline='\n')
+    else:
+        f = open(ruta, modo, encoding='utf-8', newline='\n')
+    with f:
+        yield f
+
+def _con_progreso(registros: Iterable[dict], verbo: str) -> Iterator[dict]:
+    inicio = time.perf_counter()
+    total = 0
+    for registro in registros:
+        total += 1
+        if total % AVISO_CADA == 0:
+            transcurrido = time.perf_counter() - inicio
+            print(f"{verbo} {total} registros ({total / transcurrido:.0f}/s)", file=sys.stderr)
+        yield registro
+
+def _leer_registros(f) -> Iterator[dict]:
+    for numero, linea in enumerate(f, 1):
+        if not linea.strip():
+            continue
+        try:
+            yield json.loads(linea)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Línea {numero} no es JSON válido: {e}") from e
+
+def exportar(ruta: str) -> int:
+    codificar = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    total = 0
+    with _abrir(ruta, 'w') as f:
+        for registro in _con_progreso(bd.exportar_registros(), "Exportados"):
+            f.write(codificar(registro))
+            f.write('\n')
+            total += 1
+    return total
+
+def importar(ruta: str, tamano_lote: int, filas_por_transaccion: int) -> dict:
+    with _abrir(ruta, 'r') as f:
+        return bd.importar_registros(
+            _con_progreso(_leer_registros(f), "Leídos"),
+            tamano_lote=tamano_lote,
+            filas_por_transaccion=filas_por_transaccion,
+        )
+
+def main(argumentos: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Exporta o importa usuarios, resúmenes y mensajes en JSONL (un registro por línea)"
+    )
+    parser.add_argument("--bd", help="ruta de la base de datos (por defecto la de la aplicación)")
+    subcomandos = parser.add_subparsers(dest="comando", required=True)
+    
+    parser_exportar = subcomandos.add_parser("exportar", help="escribe todos los datos en un fichero JSONL")
+    parser_exportar.add_argument("salida", help="fichero de salida (.jsonl, .jsonl.gz o - para stdout)")
+    
+    parser_importar = subcomandos.add_parser("importar", help="añade los datos de un fichero JSONL")
+    parser_importar.add_argument("entrada", help="fichero de entrada (.jsonl, .jsonl.gz o - para stdin)")
+    parser_importar.add_argument("--lote", type=int, default=10000, help="filas por executemany")
+    parser_importar.add_argument("--transaccion", type=int, default=200000,
+                                 help="mensajes por transacción")
+    args = parser.parse_args(argumentos)
+    
+    if args.bd:
+        bd.NOMBRE_BD = args.bd
+    inicio = time.perf_counter()
+    try:
+        # Los avisos de inicialización no deben mezclarse con un JSONL
+        # escrito en stdout.
+        with redirect_stdout(sys.stderr):
+            bd.inicializar_base_datos()
+        if args.comando == "exportar":
+            total = exportar(args.salida)
+            resumen = f"{total} registros exportados"
+        else:
+            resultado = importar(args.entrada, args.lote, args.transaccion)
+            resumen = (
+                f"Usuarios: {resultado['usuarios']} (omitidos por nombre repetido: {resultado['usuarios_omitidos']})  "
+                f"mensajes: {resultado['mensajes']} (omitidos: {resultado['mensajes_omitidos']})  "
+                f"resúmenes: {resultado['resumenes']} (omitidos: {resultado['resumenes_omitidos']})"
+            )
+    finally:
+        bd.cerrar_conexiones()
+    
+    print(f"{resumen} en {time.perf_counter() - inicio:.1f}s", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
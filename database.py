@@ -1,47 +1,225 @@
+import os
+import atexit
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Tuple, Optional
+import queue
+import threading
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
+from cache_conversaciones import cache
+from escritura_diferida import ColaEscrituraDiferida, TAMANO_LOTE, INTERVALO_VACIADO
+import migraciones
+from archivo_historial import (
+    ruta_archivo, cache_segmentos, comprimir_mensajes, descomprimir_mensajes, MENSAJES_POR_SEGMENTO
+)
 
 NOMBRE_BD = "chatbot.db"
 
+TAMANO_POOL_LECTURA = int(os.getenv('BD_LECTORES', '4'))
+SENTENCIAS_EN_CACHE = 256
+TAMANO_MMAP = 64 * 1024 * 1024
+TAMANO_CACHE_PAGINAS_KB = 16 * 1024
+TIEMPO_ESPERA_BLOQUEO = 10.0
+
+CARACTERES_POR_TOKEN = migraciones.CARACTERES_POR_TOKEN
+
+ESCRITURA_DIFERIDA = os.getenv('ESCRITURA_DIFERIDA', '0') == '1'
+
+def _configurar_conexion(conexion: sqlite3.Connection, ruta: str):
+    conexion.row_factory = sqlite3.Row
+    # auto_vacuum solo tiene efecto en una base de datos sin tablas y antes
+    # de pasar a WAL; en una existente queda pendiente del próximo VACUUM
+    # (ver activar_vacuum_incremental).
+    conexion.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conexion.execute("PRAGMA journal_mode = WAL")
+    conexion.execute("PRAGMA synchronous = NORMAL")
+    conexion.execute("ATTACH DATABASE ? AS archivo", (ruta_archivo(ruta),))
+    conexion.execute("PRAGMA archivo.auto_vacuum = INCREMENTAL")
+    conexion.execute("PRAGMA archivo.journal_mode = WAL")
+    conexion.execute("PRAGMA archivo.synchronous = NORMAL")
+    conexion.execute(f"PRAGMA mmap_size = {int(TAMANO_MMAP)}")
+    conexion.execute(f"PRAGMA cache_size = -{int(TAMANO_CACHE_PAGINAS_KB)}")
+    conexion.execute("PRAGMA temp_store = MEMORY")
+    conexion.execute("PRAGMA foreign_keys = ON")
+
+def _abrir_conexion(ruta: str) -> sqlite3.Connection:
+    conexion = sqlite3.connect(
+        ruta,
+        timeout=TIEMPO_ESPERA_BLOQUEO,
+        check_same_thread=False,
+        cached_statements=SENTENCIAS_EN_CACHE,
+    )
+    _configurar_conexion(conexion, ruta)
+    return conexion
+
+class GestorConexiones:
+    # Un único escritor serializado con un lock y un pool de lectores
+    # reutilizables. Cada conexión se configura una sola vez al abrirse y
+    # conserva su caché de sentencias preparadas mientras vive.
+    
+    def __init__(self, ruta: str, tamano_pool_lectura: int = TAMANO_POOL_LECTURA):
+        self.ruta = ruta
+        self.tamano_pool_lectura = max(1, tamano_pool_lectura)
+        self._bloqueo_escritura = threading.RLock()
+        self._bloqueo_pool = threading.Lock()
+        self._escritor: Optional[sqlite3.Connection] = None
+        self._lectores_libres: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lectores_abiertos = 0
+        self._local = threading.local()
+        self._cerrado = False
+    
+    def _obtener_escritor(self) -> sqlite3.Connection:
+        if self._escritor is None:
+            self._escritor = _abrir_conexion(self.ruta)
+        return self._escritor
+    
+    def _tomar_lector(self) -> sqlite3.Connection:
+        try:
+            return self._lectores_libres.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._bloqueo_pool:
+            if self._lectores_abiertos < self.tamano_pool_lectura:
+                self._lectores_abiertos += 1
+                crear = True
+            else:
+                crear = False
+        
+        if crear:
+            try:
+                return _abrir_conexion(self.ruta)
+            except Exception:
+                with self._bloqueo_pool:
+                    self._lectores_abiertos -= 1
+                raise
+        return self._lectores_libres.get(timeout=TIEMPO_ESPERA_BLOQUEO)
+    
+    def _devolver_lector(self, conexion: sqlite3.Connection):
+        if self._cerrado:
+            conexion.close()
+            return
+        self._lectores_libres.put(conexion)
+    
+    @contextmanager
+    def lectura(self):
+        # Las lecturas anidadas dentro de una escritura del mismo hilo usan la
+        # conexión del escritor para ver sus propios cambios sin confirmar.
+        if getattr(self._local, 'profundidad_escritura', 0) > 0:
+            yield self._obtener_escritor()
+            return
+        
+        conexion = self._tomar_lector()
+        try:
+            yield conexion
+        finally:
+            if conexion.in_transaction:
+                conexion.rollback()
+            self._devolver_lector(conexion)
+    
+    @contextmanager
+    def escritura(self):
+        with self._bloqueo_escritura:
+            conexion = self._obtener_escritor()
+            profundidad = getattr(self._local, 'profundidad_escritura', 0)
+            self._local.profundidad_escritura = profundidad + 1
+            try:
+                yield conexion
+                if profundidad == 0:
+                    conexion.commit()
+            except Exception:
+                if profundidad == 0:
+                    conexion.rollback()
+                raise
+            finally:
+                self._local.profundidad_escritura = profundidad
+    
+    def cerrar(self):
+        with self._bloqueo_escritura:
+            self._cerrado = True
+            if self._escritor is not None:
+                self._escritor.close()
+                self._escritor = None
+        while True:
+            try:
+                self._lectores_libres.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._bloqueo_pool:
+            self._lectores_abiertos = 0
+
+_gestor: Optional[GestorConexiones] = None
+_bloqueo_gestor = threading.Lock()
+
+def obtener_gestor() -> GestorConexiones:
+    global _gestor
+    gestor = _gestor
+    if gestor is not None and gestor.ruta == NOMBRE_BD and not gestor._cerrado:
+        return gestor
+    
+    with _bloqueo_gestor:
+        if _gestor is None or _gestor.ruta != NOMBRE_BD or _gestor._cerrado:
+            if _gestor is not None:
+                _gestor.cerrar()
+            _gestor = GestorConexiones(NOMBRE_BD)
+        return _gestor
+
+def cerrar_conexiones():
+    global _gestor
+    desactivar_escritura_diferida()
+    with _bloqueo_gestor:
+        if _gestor is not None:
+            _gestor.cerrar()
+            _gestor = None
+
+def estimar_tokens(texto: str) -> int:
+    if not texto:
+        return 0
+    return (len(texto) + CARACTERES_POR_TOKEN - 1) // CARACTERES_POR_TOKEN
+
 def inicializar_base_datos():
-    conexion = sqlite3.connect(NOMBRE_BD)
-    cursor = conexion.cursor()
+    # Con el esquema al día basta un PRAGMA en una conexión de lectura; el
+    # bloqueo de escritura solo se pide si hay migraciones pendientes.
+    with obtener_gestor().lectura() as conexion:
+        al_dia = (
+            migraciones.esta_al_dia(conexion)
+            and migraciones.archivo_creado(conexion)
+            and migraciones.indices_conversaciones_completos(conexion)
+        )
+    if not al_dia:
+        with obtener_gestor().escritura() as conexion:
+            migraciones.aplicar_migraciones(conexion)
+            migraciones.crear_esquema_archivo(conexion)
+            # Por si una importación se interrumpió sin restaurarlos.
+            migraciones.restaurar_indices_conversaciones(conexion)
     
-    with open('database_schema.sql', 'r', encoding='utf-8') as f:
-        esquema = f.read()
-        cursor.executescript(esquema)
+    if ESCRITURA_DIFERIDA:
+        activar_escritura_diferida()
     
-    conexion.commit()
-    conexion.close()
     print("Base de datos inicializada correctamente")
 
 def obtener_conexion():
-    conexion = sqlite3.connect(NOMBRE_BD)
-    conexion.row_factory = sqlite3.Row
-    return conexion
+    return _abrir_conexion(NOMBRE_BD)
 
 def crear_usuario(nombre_usuario: str, hash_contrasena: str) -> Optional[int]:
     try:
-        conexion = obtener_conexion()
-        cursor = conexion.cursor()
-        cursor.execute(
-            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-            (nombre_usuario, hash_contrasena)
-        )
-        id_usuario = cursor.lastrowid
-        conexion.commit()
-        conexion.close()
-        return id_usuario
+        with obtener_gestor().escritura() as conexion:
+            cursor = conexion.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (nombre_usuario, hash_contrasena)
+            )
+            return cursor.lastrowid
     except sqlite3.IntegrityError:
         return None
 
 def obtener_usuario_por_nombre(nombre_usuario: str) -> Optional[dict]:
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (nombre_usuario,))
-    fila = cursor.fetchone()
-    conexion.close()
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT * FROM users WHERE username = ?", (nombre_usuario,)
+        ).fetchone()
     
     if fila:
         return {
@@ -52,12 +230,59 @@ def obtener_usuario_por_nombre(nombre_usuario: str) -> Optional[dict]:
         }
     return None
 
+def actualizar_hash_contrasena(id_usuario: int, hash_anterior: str, hash_nuevo: str) -> bool:
+    # Solo sustituye el hash si no ha cambiado desde que se verificó.
+    with obtener_gestor().escritura() as conexion:
+        cursor = conexion.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+            (hash_nuevo, id_usuario, hash_anterior)
+        )
+        return cursor.rowcount > 0
+
+def crear_sesion(hash_token: str, id_usuario: int, ahora: float, expira: float):
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute(
+            """
+            INSERT INTO sessions (token_hash, user_id, created_at, expires_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (hash_token, id_usuario, ahora, expira, ahora)
+        )
+        conexion.execute("DELETE FROM sessions WHERE expires_at < ?", (ahora,))
+
+def obtener_usuario_por_sesion(hash_token: str, ahora: float) -> Optional[dict]:
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            """
+            SELECT u.id, u.username, u.created_at
+            FROM sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash = ? AND s.expires_at > ?
+            """,
+            (hash_token, ahora)
+        ).fetchone()
+    
+    if fila:
+        return {
+            'id': fila['id'],
+            'username': fila['username'],
+            'created_at': fila['created_at']
+        }
+    return None
+
+def renovar_sesion(hash_token: str, ahora: float, expira: float):
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute(
+            "UPDATE sessions SET last_used_at = ?, expires_at = ? WHERE token_hash = ?",
+            (ahora, expira, hash_token)
+        )
+
+def eliminar_sesion(hash_token: str):
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute("DELETE FROM sessions WHERE token_hash = ?", (hash_token,))
+
 def obtener_todos_usuarios() -> List[dict]:
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
-    cursor.execute("SELECT id, username, created_at FROM users")
-    filas = cursor.fetchall()
-    conexion.close()
+    with obtener_gestor().lectura() as conexion:
+        filas = conexion.execute("SELECT id, username, created_at FROM users").fetchall()
     
     return [
         {
@@ -68,67 +293,1153 @@ def obtener_todos_usuarios() -> List[dict]:
         for fila in filas
     ]
 
+def listar_usuarios(prefijo: str = "", despues_de: Optional[Tuple[str, int]] = None,
+                    tamano: int = 30) -> List[dict]:
+    # Página de usuarios cuyo nombre empieza por 'prefijo' (sin distinguir
+    # mayúsculas), ordenada por nombre. Para la siguiente página se pasa
+    # (username, id) del último usuario devuelto. Recuento de mensajes y
+    # última actividad salen de user_stats.
+    prefijo = prefijo or ""
+    nombre_anterior, id_anterior = despues_de if despues_de is not None else ("", 0)
+    with obtener_gestor().lectura() as conexion:
+        filas = conexion.execute(
+            """
+            WITH pagina AS (
+                SELECT id, username, created_at
+                FROM users
+                WHERE username >= :desde COLLATE NOCASE
+                  AND username < :hasta COLLATE NOCASE
+                  AND (username COLLATE NOCASE, id) > (:nombre, :id)
+                ORDER BY username COLLATE NOCASE, id
+                LIMIT :tamano
+            )
+            SELECT p.id, p.username, p.created_at,
+                   COALESCE(s.message_count, 0) AS message_count,
+                   s.last_timestamp AS last_activity
+            FROM pagina p
+            LEFT JOIN user_stats s ON s.user_id = p.id
+            ORDER BY p.username COLLATE NOCASE, p.id
+            """,
+            {
+                'desde': prefijo,
+                'hasta': prefijo + "\U0010ffff",
+                'nombre': nombre_anterior,
+                'id': id_anterior,
+                'tamano': max(1, int(tamano)),
+            }
+        ).fetchall()
+    
+    return [
+        {
+            'id': fila['id'],
+            'username': fila['username'],
+            'created_at': fila['created_at'],
+            'message_count': fila['message_count'],
+            'last_activity': fila['last_activity'],
+        }
+        for fila in filas
+    ]
+
+def contar_usuarios(prefijo: str = "") -> int:
+    prefijo = prefijo or ""
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT COUNT(*) AS count FROM users "
+            "WHERE username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE",
+            (prefijo, prefijo + "\U0010ffff")
+        ).fetchone()
+    return fila['count']
+
 def eliminar_usuario(id_usuario: int) -> bool:
     try:
-        conexion = obtener_conexion()
-        cursor = conexion.cursor()
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (id_usuario,))
-        cursor.execute("DELETE FROM users WHERE id = ?", (id_usuario,))
-        conexion.commit()
-        conexion.close()
+        esperar_escrituras()
+        with obtener_gestor().escritura() as conexion:
+            # conversations, conversation_summaries y user_stats se borran en
+            # cascada.
+            conexion.execute("DELETE FROM user_stats WHERE user_id = ?", (id_usuario,))
+            conexion.execute("DELETE FROM users WHERE id = ?", (id_usuario,))
+            # El archivo está en otra base de datos y no le llega la cascada.
+            _eliminar_archivo_usuario(conexion, id_usuario)
+            cache.invalidar(id_usuario)
         return True
     except Exception as e:
         print(f"Error al eliminar usuario: {e}")
         return False
 
-def guardar_mensaje(id_usuario: int, rol: str, contenido: str):
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
-    cursor.execute(
-        "INSERT INTO conversations (user_id, role, content) VALUES (?, ?, ?)",
-        (id_usuario, rol, contenido)
-    )
-    conexion.commit()
-    conexion.close()
+_cola_diferida: Optional[ColaEscrituraDiferida] = None
+_bloqueo_ids = threading.Lock()
+_ultimo_id_mensaje = 0
+
+def activar_escritura_diferida(tamano_lote: int = TAMANO_LOTE, intervalo: float = INTERVALO_VACIADO):
+    # En modo diferido los ids se asignan en el proceso para que la caché y
+    # el contexto vean el mensaje antes de que llegue a disco; por eso este
+    # modo supone un único proceso escritor sobre la base de datos.
+    global _cola_diferida, _ultimo_id_mensaje
+    with _bloqueo_ids:
+        if _cola_diferida is not None:
+            return
+        with obtener_gestor().escritura() as conexion:
+            fila = conexion.execute(
+                """
+                SELECT MAX(
+                    COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'conversations'), 0),
+                    COALESCE((SELECT MAX(id) FROM conversations), 0)
+                )
+                """
+            ).fetchone()
+        _ultimo_id_mensaje = fila[0]
+        _cola_diferida = ColaEscrituraDiferida(
+            _escribir_lote_mensajes,
+            _escribir_mensaje,
+            tamano_lote=tamano_lote,
+            intervalo=intervalo,
+            al_descartar=lambda fila, e: cache.invalidar(fila[1]),
+        )
+
+def desactivar_escritura_diferida():
+    global _cola_diferida
+    with _bloqueo_ids:
+        cola = _cola_diferida
+        _cola_diferida = None
+    if cola is not None:
+        cola.cerrar()
+
+atexit.register(desactivar_escritura_diferida)
+
+def esperar_escrituras(timeout: Optional[float] = None) -> bool:
+    cola = _cola_diferida
+    if cola is None:
+        return True
+    return cola.esperar(timeout=timeout)
+
+def _sincronizar_usuario(id_usuario: int):
+    # Antes de leer de SQLite se vacían los mensajes del usuario que siguen
+    # en la cola diferida, para no devolver un historial incompleto.
+    cola = _cola_diferida
+    if cola is not None and cola.tiene_pendientes(id_usuario):
+        cola.esperar()
+
+_SQL_INSERTAR_MENSAJE_CON_ID = (
+    "INSERT INTO conversations (id, user_id, role, content, token_count, timestamp) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+def _escribir_lote_mensajes(filas: List[Tuple]):
+    with obtener_gestor().escritura() as conexion:
+        conexion.executemany(_SQL_INSERTAR_MENSAJE_CON_ID, filas)
+
+def _escribir_mensaje(fila: Tuple):
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute(_SQL_INSERTAR_MENSAJE_CON_ID, fila)
+
+def guardar_mensaje(id_usuario: int, rol: str, contenido: str, durable: bool = False):
+    global _ultimo_id_mensaje
+    tokens = estimar_tokens(contenido)
+    
+    cola = _cola_diferida
+    if cola is not None:
+        with _bloqueo_ids:
+            if _cola_diferida is cola:
+                _ultimo_id_mensaje += 1
+                id_mensaje = _ultimo_id_mensaje
+                marca_tiempo = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                secuencia = cola.encolar(
+                    id_usuario, (id_mensaje, id_usuario, rol, contenido, tokens, marca_tiempo)
+                )
+                cache.agregar(id_usuario, {
+                    'id': id_mensaje,
+                    'role': rol,
+                    'content': contenido,
+                    'token_count': tokens,
+                    'timestamp': marca_tiempo
+                })
+            else:
+                cola = None
+        if cola is not None:
+            if durable:
+                cola.esperar(secuencia)
+            return
+    
+    try:
+        with obtener_gestor().escritura() as conexion:
+            fila = conexion.execute(
+                "INSERT INTO conversations (user_id, role, content, token_count) VALUES (?, ?, ?, ?) "
+                "RETURNING id, timestamp",
+                (id_usuario, rol, contenido, tokens)
+            ).fetchone()
+            cache.agregar(id_usuario, {
+                'id': fila['id'],
+                'role': rol,
+                'content': contenido,
+                'token_count': tokens,
+                'timestamp': fila['timestamp']
+            })
+    except Exception:
+        cache.invalidar(id_usuario)
+        raise
+
+def _fila_a_mensaje(fila) -> dict:
+    return {
+        'id': fila['id'],
+        'role': fila['role'],
+        'content': fila['content'],
+        'token_count': fila['token_count'] if fila['token_count'] is not None else estimar_tokens(fila['content']),
+        'timestamp': fila['timestamp']
+    }
 
 def obtener_conversaciones_usuario(id_usuario: int, limite: Optional[int] = None) -> List[dict]:
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
+    mensajes = cache.obtener(id_usuario, completo=True)
     
-    consulta = """
-        SELECT role, content, timestamp 
-        FROM conversations 
-        WHERE user_id = ? 
-        ORDER BY timestamp ASC
-    """
+    if mensajes is None:
+        _sincronizar_usuario(id_usuario)
+        version = cache.version(id_usuario)
+        with obtener_gestor().lectura() as conexion:
+            mensajes = list(_mensajes_asc(conexion, id_usuario))
+        cache.poblar(id_usuario, mensajes, True, version)
     
     if limite:
-        consulta += f" LIMIT {limite}"
+        mensajes = mensajes[:int(limite)]
     
-    cursor.execute(consulta, (id_usuario,))
-    filas = cursor.fetchall()
-    conexion.close()
+    return [
+        {
+            'role': mensaje['role'],
+            'content': mensaje['content'],
+            'timestamp': mensaje['timestamp']
+        }
+        for mensaje in mensajes
+    ]
+
+def obtener_pagina_conversaciones(id_usuario: int, antes_de_id: Optional[int] = None,
+                                  tamano: int = 50) -> List[dict]:
+    # Paginación por clave sobre (user_id, id), de la más nueva a la más
+    # antigua: para la siguiente página se pasa el id del último mensaje
+    # devuelto como antes_de_id.
+    tamano = max(1, int(tamano))
+    
+    entrada = cache.obtener_sufijo(id_usuario)
+    if entrada is not None:
+        pagina = []
+        for mensaje in reversed(entrada.mensajes):
+            if antes_de_id is not None and mensaje['id'] >= antes_de_id:
+                continue
+            pagina.append(mensaje)
+            if len(pagina) == tamano:
+                break
+        if len(pagina) == tamano or entrada.completo:
+            cache.registrar_acierto()
+            return [dict(mensaje) for mensaje in pagina]
+    
+    cache.registrar_fallo()
+    _sincronizar_usuario(id_usuario)
+    if antes_de_id is None:
+        consulta = """
+            SELECT id, role, content, token_count, timestamp
+            FROM conversations
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """
+        parametros: Tuple = (id_usuario, tamano)
+    else:
+        consulta = """
+            SELECT id, role, content, token_count, timestamp
+            FROM conversations
+            WHERE user_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """
+        parametros = (id_usuario, antes_de_id, tamano)
+    
+    with obtener_gestor().lectura() as conexion:
+        filas = conexion.execute(consulta, parametros).fetchall()
+        pagina = [_fila_a_mensaje(fila) for fila in filas]
+        if len(pagina) < tamano:
+            # La tabla caliente se ha agotado; el resto sale del archivo.
+            tope = pagina[-1]['id'] if pagina else antes_de_id
+            pagina.extend(islice(
+                _mensajes_archivados(conexion, id_usuario, antes_de_id=tope), tamano - len(pagina)
+            ))
+    
+    return pagina
+
+def _llenar_ventana(mensajes_desc: Iterable[dict], presupuesto_tokens: int,
+                    tokens_por_mensaje: int, despues_de_id: int) -> Tuple[List[dict], bool]:
+    # Devuelve la ventana (del más nuevo al más antiguo) y si se detuvo por
+    # presupuesto o por llegar a despues_de_id, es decir, si está completa.
+    ventana = []
+    usados = 0
+    for mensaje in mensajes_desc:
+        if mensaje['id'] <= despues_de_id:
+            return ventana, True
+        tokens = mensaje['token_count'] + tokens_por_mensaje
+        if ventana and usados + tokens > presupuesto_tokens:
+            return ventana, True
+        usados += tokens
+        ventana.append(mensaje)
+    return ventana, False
+
+def _filas_desc(cursor) -> Iterable[dict]:
+    while True:
+        filas = cursor.fetchmany(64)
+        if not filas:
+            return
+        for fila in filas:
+            yield _fila_a_mensaje(fila)
+
+_SIN_TOPE = 2 ** 63 - 1
+
+def _mensajes_segmento(conexion, id_segmento: int, codec: str) -> List[dict]:
+    mensajes = cache_segmentos.obtener(id_segmento)
+    if mensajes is None:
+        fila = conexion.execute(
+            "SELECT data FROM archivo.archived_segments WHERE id = ?", (id_segmento,)
+        ).fetchone()
+        mensajes = descomprimir_mensajes(codec, fila['data']) if fila else []
+        cache_segmentos.guardar(id_segmento, mensajes)
+    return mensajes
+
+def _mensajes_archivados(conexion, id_usuario: int, despues_de_id: int = 0,
+                         antes_de_id: Optional[int] = None, descendente: bool = True) -> Iterable[dict]:
+    # Mensajes archivados con despues_de_id < id < antes_de_id. Los segmentos
+    # de un usuario no se solapan, así que basta recorrerlos por last_id y
+    # solo se descomprimen los que se llegan a leer.
+    tope = antes_de_id if antes_de_id is not None else _SIN_TOPE
+    segmentos = conexion.execute(
+        f"""
+        SELECT id, codec
+        FROM archivo.archived_segments
+        WHERE user_id = ? AND last_id > ? AND first_id < ?
+        ORDER BY last_id {'DESC' if descendente else 'ASC'}
+        """,
+        (id_usuario, despues_de_id, tope)
+    ).fetchall()
+    for segmento in segmentos:
+        mensajes = _mensajes_segmento(conexion, segmento['id'], segmento['codec'])
+        for mensaje in (reversed(mensajes) if descendente else mensajes):
+            if despues_de_id < mensaje['id'] < tope:
+                yield dict(mensaje)
+
+def _mensajes_desc(conexion, id_usuario: int, despues_de_id: int = 0,
+                   antes_de_id: Optional[int] = None) -> Iterable[dict]:
+    # Del más nuevo al más antiguo: primero la tabla caliente y después el
+    # archivo, que solo contiene mensajes anteriores a los que siguen en la
+    # tabla. El tope por id descarta los duplicados que deja un archivado
+    # interrumpido entre las dos bases de datos.
+    tope = antes_de_id if antes_de_id is not None else _SIN_TOPE
+    cursor = conexion.execute(
+        """
+        SELECT id, role, content, token_count, timestamp
+        FROM conversations
+        WHERE user_id = ? AND id > ? AND id < ?
+        ORDER BY id DESC
+        """,
+        (id_usuario, despues_de_id, tope)
+    )
+    try:
+        for mensaje in _filas_desc(cursor):
+            tope = mensaje['id']
+            yield mensaje
+    finally:
+        cursor.close()
+    yield from _mensajes_archivados(conexion, id_usuario, despues_de_id, tope, descendente=True)
+
+def _mensajes_asc(conexion, id_usuario: int, despues_de_id: int = 0,
+                  hasta_id: Optional[int] = None) -> Iterable[dict]:
+    # Del más antiguo al más nuevo: archivo y después tabla caliente.
+    limite = hasta_id if hasta_id is not None else _SIN_TOPE - 1
+    ultimo = despues_de_id
+    for mensaje in _mensajes_archivados(conexion, id_usuario, despues_de_id, limite + 1, descendente=False):
+        ultimo = mensaje['id']
+        yield mensaje
+    cursor = conexion.execute(
+        """
+        SELECT id, role, content, token_count, timestamp
+        FROM conversations
+        WHERE user_id = ? AND id > ? AND id <= ?
+        ORDER BY id ASC
+        """,
+        (id_usuario, ultimo, limite)
+    )
+    try:
+        for mensaje in _filas_desc(cursor):
+            yield mensaje
+    finally:
+        cursor.close()
+
+def _contar_archivados(conexion, id_usuario: int, despues_de_id: int = 0) -> int:
+    fila = conexion.execute(
+        """
+        SELECT COALESCE(SUM(message_count), 0) AS total
+        FROM archivo.archived_segments
+        WHERE user_id = ? AND first_id > ?
+        """,
+        (id_usuario, despues_de_id)
+    ).fetchone()
+    total = fila['total']
+    # Como mucho un segmento contiene el corte y hay que abrirlo.
+    parcial = conexion.execute(
+        "SELECT id, codec FROM archivo.archived_segments WHERE user_id = ? AND first_id <= ? AND last_id > ?",
+        (id_usuario, despues_de_id, despues_de_id)
+    ).fetchone()
+    if parcial:
+        total += sum(
+            1 for mensaje in _mensajes_segmento(conexion, parcial['id'], parcial['codec'])
+            if mensaje['id'] > despues_de_id
+        )
+    return total
+
+def obtener_contexto_reciente(id_usuario: int, presupuesto_tokens: int,
+                              tokens_por_mensaje: int = 0, despues_de_id: int = 0) -> List[dict]:
+    # Recorre el historial del más reciente al más antiguo y se detiene al
+    # agotar el presupuesto, así que el coste depende del tamaño de la ventana
+    # y no del historial. Primero se intenta con la caché; si la parte cacheada
+    # no alcanza, se lee de SQLite sobre el índice de user_id.
+    ventana = None
+    entrada = cache.obtener_sufijo(id_usuario)
+    if entrada is not None:
+        candidata, completa = _llenar_ventana(
+            reversed(entrada.mensajes), presupuesto_tokens, tokens_por_mensaje, despues_de_id
+        )
+        if completa or entrada.completo:
+            ventana = candidata
+            cache.registrar_acierto()
+    
+    if ventana is None:
+        cache.registrar_fallo()
+        _sincronizar_usuario(id_usuario)
+        version = cache.version(id_usuario)
+        with obtener_gestor().lectura() as conexion:
+            mensajes_desc = _mensajes_desc(conexion, id_usuario, despues_de_id)
+            ventana, completa = _llenar_ventana(
+                mensajes_desc, presupuesto_tokens, tokens_por_mensaje, despues_de_id
+            )
+            mensajes_desc.close()
+        cache.poblar(id_usuario, ventana[::-1], not completa and despues_de_id == 0, version)
+    
+    mensajes = [dict(mensaje, token_count=mensaje['token_count'] + tokens_por_mensaje) for mensaje in ventana]
+    mensajes.reverse()
+    return mensajes
+
+def obtener_mensajes_rango(id_usuario: int, despues_de_id: int, hasta_id: int) -> List[dict]:
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        mensajes = list(_mensajes_asc(conexion, id_usuario, despues_de_id, hasta_id))
     
     return [
         {
-            'role': fila['role'],
-            'content': fila['content'],
-            'timestamp': fila['timestamp']
+            'id': mensaje['id'],
+            'role': mensaje['role'],
+            'content': mensaje['content'],
+            'token_count': mensaje['token_count']
         }
-        for fila in filas
+        for mensaje in mensajes
     ]
 
+def contar_mensajes_posteriores(id_usuario: int, despues_de_id: int) -> int:
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT COUNT(*) as count FROM conversations WHERE user_id = ? AND id > ?",
+            (id_usuario, despues_de_id)
+        ).fetchone()
+        return fila['count'] + _contar_archivados(conexion, id_usuario, despues_de_id)
+
+def obtener_id_corte(id_usuario: int, mensajes_recientes: int) -> Optional[int]:
+    # Id del mensaje más nuevo que queda fuera de los N más recientes.
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT id FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (id_usuario, mensajes_recientes)
+        ).fetchone()
+        if fila:
+            return fila['id']
+        mensajes_desc = _mensajes_desc(conexion, id_usuario)
+        mensaje = next(islice(mensajes_desc, mensajes_recientes, None), None)
+        mensajes_desc.close()
+    return mensaje['id'] if mensaje else None
+
+def obtener_resumen_usuario(id_usuario: int) -> Optional[dict]:
+    encontrado, resumen = cache.obtener_resumen(id_usuario)
+    if encontrado:
+        return resumen
+    
+    version = cache.version(id_usuario)
+    resumen = _leer_resumen_usuario(id_usuario)
+    cache.guardar_resumen(id_usuario, resumen, version)
+    return resumen
+
+def _leer_resumen_usuario(id_usuario: int) -> Optional[dict]:
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT summary, last_message_id, token_count, updated_at "
+            "FROM conversation_summaries WHERE user_id = ?",
+            (id_usuario,)
+        ).fetchone()
+    
+    if fila:
+        return {
+            'summary': fila['summary'],
+            'last_message_id': fila['last_message_id'],
+            'token_count': fila['token_count'],
+            'updated_at': fila['updated_at']
+        }
+    return None
+
+def guardar_resumen_usuario(id_usuario: int, resumen: str, id_ultimo_mensaje: int) -> bool:
+    # Solo se guarda si el mensaje de corte sigue existiendo; así un resumen
+    # calculado en segundo plano no revive una conversación ya limpiada.
+    with obtener_gestor().escritura() as conexion:
+        cursor = conexion.execute(
+            """
+            INSERT INTO conversation_summaries (user_id, summary, last_message_id, token_count, updated_at)
+            SELECT ?, ?, ?, ?, CURRENT_TIMESTAMP
+            WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ? AND user_id = ?)
+               OR EXISTS (SELECT 1 FROM archivo.archived_segments
+                          WHERE user_id = ? AND first_id <= ? AND last_id >= ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary,
+                last_message_id = excluded.last_message_id,
+                token_count = excluded.token_count,
+                updated_at = excluded.updated_at
+            """,
+            (id_usuario, resumen, id_ultimo_mensaje, estimar_tokens(resumen),
+             id_ultimo_mensaje, id_usuario, id_usuario, id_ultimo_mensaje, id_ultimo_mensaje)
+        )
+        cache.olvidar_resumen(id_usuario)
+        return cursor.rowcount > 0
+
+_PALABRAS_BUSQUEDA = re.compile(r"\w+", re.UNICODE)
+
+def _consulta_fts(texto: str) -> Optional[str]:
+    # Cada palabra se cita para que la sintaxis de FTS5 del usuario no se
+    # interprete; la última admite prefijo para buscar mientras se escribe.
+    palabras = _PALABRAS_BUSQUEDA.findall(texto or "")
+    if not palabras:
+        return None
+    terminos = [f'"{p}"' for p in palabras]
+    terminos[-1] += "*"
+    return " ".join(terminos)
+
+def buscar_conversaciones(texto: str, id_usuario: Optional[int] = None,
+                          pagina: int = 0, tamano: int = 20,
+                          marcas: Tuple[str, str] = ('[', ']')) -> List[dict]:
+    # Sin id_usuario busca en todos los usuarios (uso de administración).
+    consulta = _consulta_fts(texto)
+    if consulta is None:
+        return []
+    
+    if id_usuario is not None:
+        _sincronizar_usuario(id_usuario)
+        expresion = f'owner : "u{int(id_usuario)}" AND content : ({consulta})'
+    else:
+        esperar_escrituras()
+        expresion = f"content : ({consulta})"
+    
+    with obtener_gestor().lectura() as conexion:
+        # Los mensajes archivados siguen en el índice pero no en la vista de
+        # contenido, así que snippet() solo se pide para los de la tabla
+        # caliente; el resto se completa desde su segmento.
+        filas = conexion.execute(
+            """
+            SELECT conversations_fts.rowid AS id, c.user_id, u.username, c.role, c.timestamp,
+                   CASE WHEN c.id IS NOT NULL
+                        THEN snippet(conversations_fts, 0, ?, ?, '…', 12) END AS fragmento,
+                   bm25(conversations_fts, 1.0, 0.0) AS rango
+            FROM conversations_fts
+            LEFT JOIN conversations c ON c.id = conversations_fts.rowid
+            LEFT JOIN users u ON u.id = c.user_id
+            WHERE conversations_fts MATCH ?
+            ORDER BY rango
+            LIMIT ? OFFSET ?
+            """,
+            (marcas[0], marcas[1], expresion, int(tamano), int(pagina) * int(tamano))
+        ).fetchall()
+        
+        resultados = []
+        for fila in filas:
+            if fila['user_id'] is not None:
+                resultados.append({
+                    'id': fila['id'],
+                    'user_id': fila['user_id'],
+                    'username': fila['username'],
+                    'role': fila['role'],
+                    'timestamp': fila['timestamp'],
+                    'snippet': fila['fragmento'],
+                    'rank': fila['rango']
+                })
+                continue
+            archivado = _mensaje_archivado(conexion, fila['id'], id_usuario)
+            if archivado is None:
+                continue
+            dueno, mensaje = archivado
+            usuario = conexion.execute("SELECT username FROM users WHERE id = ?", (dueno,)).fetchone()
+            resultados.append({
+                'id': mensaje['id'],
+                'user_id': dueno,
+                'username': usuario['username'] if usuario else None,
+                'role': mensaje['role'],
+                'timestamp': mensaje['timestamp'],
+                'snippet': _fragmento(mensaje['content'], texto, marcas),
+                'rank': fila['rango']
+            })
+    
+    return resultados
+
+def _mensaje_archivado(conexion, id_mensaje: int,
+                       id_usuario: Optional[int] = None) -> Optional[Tuple[int, dict]]:
+    # Los rangos de ids de segmentos de usuarios distintos se solapan, así
+    # que sin usuario hay que mirar dentro de cada candidato.
+    if id_usuario is not None:
+        segmentos = conexion.execute(
+            """
+            SELECT id, user_id, codec FROM archivo.archived_segments
+            WHERE user_id = ? AND last_id >= ? AND first_id <= ?
+            """,
+            (id_usuario, id_mensaje, id_mensaje)
+        ).fetchall()
+    else:
+        segmentos = conexion.execute(
+            "SELECT id, user_id, codec FROM archivo.archived_segments "
+            "WHERE first_id <= ? AND last_id >= ?",
+            (id_mensaje, id_mensaje)
+        ).fetchall()
+    for segmento in segmentos:
+        for mensaje in _mensajes_segmento(conexion, segmento['id'], segmento['codec']):
+            if mensaje['id'] == id_mensaje:
+                return segmento['user_id'], dict(mensaje)
+    return None
+
+def _sin_diacriticos(palabra: str) -> str:
+    return "".join(
+        c for c in unicodedata.normalize('NFKD', palabra) if not unicodedata.combining(c)
+    ).casefold()
+
+def _fragmento(contenido: str, texto: str, marcas: Tuple[str, str], palabras_max: int = 12) -> str:
+    # Equivalente aproximado de snippet() para un mensaje archivado: unas
+    # pocas palabras alrededor de la primera coincidencia, marcadas igual.
+    terminos = [_sin_diacriticos(p) for p in _PALABRAS_BUSQUEDA.findall(texto or "")]
+    exactos, prefijo = set(terminos[:-1]), terminos[-1] if terminos else ""
+    
+    def coincide(palabra: str) -> bool:
+        normal = _sin_diacriticos(palabra)
+        return normal in exactos or (bool(prefijo) and normal.startswith(prefijo))
+    
+    palabras = list(_PALABRAS_BUSQUEDA.finditer(contenido))
+    if not palabras:
+        return contenido
+    primera = next((i for i, p in enumerate(palabras) if coincide(p.group())), 0)
+    inicio = max(0, min(primera - palabras_max // 4, len(palabras) - palabras_max))
+    fin = min(len(palabras), inicio + palabras_max)
+    
+    partes = ["…" if inicio else ""]
+    posicion = palabras[inicio].start()
+    for coincidencia in palabras[inicio:fin]:
+        partes.append(contenido[posicion:coincidencia.start()])
+        palabra = coincidencia.group()
+        partes.append(f"{marcas[0]}{palabra}{marcas[1]}" if coincide(palabra) else palabra)
+        posicion = coincidencia.end()
+    partes.append("…" if fin < len(palabras) else contenido[posicion:])
+    return "".join(partes)
+
+def obtener_mensajes_alrededor(id_usuario: int, id_mensaje: int, antes: int = 25,
+                               despues: int = 25) -> List[dict]:
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        mensajes_desc = _mensajes_desc(conexion, id_usuario, antes_de_id=id_mensaje + 1)
+        anteriores = list(islice(mensajes_desc, int(antes) + 1))
+        mensajes_desc.close()
+        mensajes_asc = _mensajes_asc(conexion, id_usuario, despues_de_id=id_mensaje)
+        posteriores = list(islice(mensajes_asc, int(despues)))
+        mensajes_asc.close()
+    
+    return anteriores[::-1] + posteriores
+
 def limpiar_conversaciones_usuario(id_usuario: int):
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
-    cursor.execute("DELETE FROM conversations WHERE user_id = ?", (id_usuario,))
-    conexion.commit()
-    conexion.close()
+    esperar_escrituras()
+    with obtener_gestor().escritura() as conexion:
+        # Sin la fila de estadísticas el trigger de borrado no tiene nada
+        # que actualizar por cada mensaje.
+        conexion.execute("DELETE FROM user_stats WHERE user_id = ?", (id_usuario,))
+        conexion.execute("DELETE FROM conversations WHERE user_id = ?", (id_usuario,))
+        conexion.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (id_usuario,))
+        _eliminar_archivo_usuario(conexion, id_usuario)
+        cache.invalidar(id_usuario)
 
 def obtener_cantidad_conversaciones(id_usuario: int) -> int:
-    conexion = obtener_conexion()
-    cursor = conexion.cursor()
-    cursor.execute("SELECT COUNT(*) as count FROM conversations WHERE user_id = ?", (id_usuario,))
-    fila = cursor.fetchone()
-    conexion.close()
-    return fila['count']
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT message_count FROM user_stats WHERE user_id = ?", (id_usuario,)
+        ).fetchone()
+    return fila['message_count'] if fila else 0
+
+def obtener_estadisticas_usuario(id_usuario: int) -> dict:
+    # Lectura de user_stats más el último mensaje por su id; no depende del
+    # tamaño del historial.
+    _sincronizar_usuario(id_usuario)
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            """
+            SELECT s.message_count, s.user_message_count, s.assistant_message_count,
+                   s.token_count, s.first_message_id, s.first_timestamp,
+                   s.last_message_id, s.last_timestamp,
+                   c.role, c.content, c.timestamp
+            FROM user_stats s
+            LEFT JOIN conversations c ON c.id = s.last_message_id
+            WHERE s.user_id = ?
+            """,
+            (id_usuario,)
+        ).fetchone()
+        ultimo = None
+        if fila and fila['last_message_id'] is not None:
+            if fila['role'] is not None:
+                ultimo = {'role': fila['role'], 'content': fila['content'], 'timestamp': fila['timestamp']}
+            else:
+                # Todo el historial está archivado.
+                mensajes = _mensajes_archivados(conexion, id_usuario, antes_de_id=fila['last_message_id'] + 1)
+                mensaje = next(mensajes, None)
+                mensajes.close()
+                if mensaje:
+                    ultimo = {'role': mensaje['role'], 'content': mensaje['content'], 'timestamp': mensaje['timestamp']}
+    
+    if not fila:
+        return {
+            'total_mensajes': 0, 'mensajes_usuario': 0, 'mensajes_asistente': 0, 'total_tokens': 0,
+            'primer_mensaje_id': None, 'primer_mensaje_fecha': None,
+            'ultimo_mensaje_id': None, 'ultimo_mensaje_fecha': None, 'ultimo_mensaje': None,
+        }
+    return {
+        'total_mensajes': fila['message_count'],
+        'mensajes_usuario': fila['user_message_count'],
+        'mensajes_asistente': fila['assistant_message_count'],
+        'total_tokens': fila['token_count'],
+        'primer_mensaje_id': fila['first_message_id'],
+        'primer_mensaje_fecha': fila['first_timestamp'],
+        'ultimo_mensaje_id': fila['last_message_id'],
+        'ultimo_mensaje_fecha': fila['last_timestamp'],
+        'ultimo_mensaje': ultimo,
+    }
+
+def _eliminar_archivo_usuario(conexion, id_usuario: int):
+    segmentos = conexion.execute(
+        "SELECT id, codec FROM archivo.archived_segments WHERE user_id = ?", (id_usuario,)
+    ).fetchall()
+    ids = [segmento['id'] for segmento in segmentos]
+    if ids:
+        # Los mensajes archivados siguen en el índice de texto completo y
+        # ningún trigger los quita.
+        for segmento in segmentos:
+            conexion.executemany(
+                "INSERT INTO conversations_fts(conversations_fts, rowid, content, owner) "
+                "VALUES ('delete', ?, ?, ?)",
+                [(m['id'], m['content'], f"u{id_usuario}")
+                 for m in _mensajes_segmento(conexion, segmento['id'], segmento['codec'])]
+            )
+        conexion.execute("DELETE FROM archivo.archived_segments WHERE user_id = ?", (id_usuario,))
+        cache_segmentos.olvidar(ids)
+
+def _liberar_paginas(esquema: str, paginas_por_paso: int = 1000) -> int:
+    # Devuelve al sistema las páginas libres por tandas, soltando el bloqueo
+    # de escritura entre una y otra para no frenar los mensajes nuevos.
+    liberadas = 0
+    while True:
+        with obtener_gestor().escritura() as conexion:
+            if conexion.execute(f"PRAGMA {esquema}.auto_vacuum").fetchone()[0] != 2:
+                return liberadas
+            libres = conexion.execute(f"PRAGMA {esquema}.freelist_count").fetchone()[0]
+            if not libres:
+                return liberadas
+            paso = min(libres, paginas_por_paso)
+            # execute() solo avanza un paso del PRAGMA (una página);
+            # executescript() lo ejecuta completo.
+            conexion.executescript(f"PRAGMA {esquema}.incremental_vacuum({paso});")
+        liberadas += paso
+
+def _archivar_usuario(id_usuario: int, antes_de: str, mantener: int, resultado: dict):
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT MAX(id) AS id FROM conversations WHERE user_id = ? AND timestamp < ?",
+            (id_usuario, antes_de)
+        ).fetchone()
+        limite = fila['id']
+        if limite is None:
+            return
+        fila = conexion.execute(
+            "SELECT id FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (id_usuario, max(0, int(mantener)))
+        ).fetchone()
+        if fila is None:
+            return
+        # Se archiva un prefijo del historial, así que todo lo archivado de un
+        # usuario queda por debajo de lo que sigue en la tabla caliente.
+        limite = min(limite, fila['id'])
+    
+    archivado = False
+    while True:
+        with obtener_gestor().escritura() as conexion:
+            filas = conexion.execute(
+                """
+                SELECT id, role, content, token_count, timestamp
+                FROM conversations
+                WHERE user_id = ? AND id <= ?
+                ORDER BY id ASC
+                LIMIT ?
+                """,
+                (id_usuario, limite, MENSAJES_POR_SEGMENTO)
+            ).fetchall()
+            if not filas:
+                break
+            mensajes = [_fila_a_mensaje(fila) for fila in filas]
+            codec, datos = comprimir_mensajes(mensajes)
+            bytes_originales = sum(len(m['content'].encode('utf-8')) for m in mensajes)
+            conexion.execute(
+                """
+                INSERT INTO archivo.archived_segments
+                    (user_id, first_id, last_id, message_count, token_count,
+                     first_timestamp, last_timestamp, codec, raw_bytes, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (id_usuario, mensajes[0]['id'], mensajes[-1]['id'], len(mensajes),
+                 sum(m['token_count'] for m in mensajes), mensajes[0]['timestamp'],
+                 mensajes[-1]['timestamp'], codec, bytes_originales, datos)
+            )
+            # Archivar no cambia el historial del usuario: las estadísticas
+            # que el trigger de borrado descuenta se dejan como estaban.
+            # Tampoco salen del índice de texto completo.
+            estadisticas = conexion.execute(
+                "SELECT * FROM user_stats WHERE user_id = ?", (id_usuario,)
+            ).fetchone()
+            with migraciones.sin_borrado_fts(conexion):
+                conexion.execute(
+                    "DELETE FROM conversations WHERE user_id = ? AND id <= ?",
+                    (id_usuario, mensajes[-1]['id'])
+                )
+            if estadisticas:
+                columnas = estadisticas.keys()
+                conexion.execute(
+                    f"INSERT OR REPLACE INTO user_stats ({', '.join(columnas)}) "
+                    f"VALUES ({', '.join('?' * len(columnas))})",
+                    tuple(estadisticas)
+                )
+        archivado = True
+        resultado['segmentos'] += 1
+        resultado['mensajes'] += len(mensajes)
+        resultado['bytes_originales'] += bytes_originales
+        resultado['bytes_comprimidos'] += len(datos)
+    if archivado:
+        resultado['usuarios'] += 1
+
+def archivar_mensajes_antiguos(dias: float, mantener: int, id_usuario: Optional[int] = None) -> dict:
+    # Mueve a segmentos comprimidos del archivo los mensajes con más de 'dias'
+    # días, salvo los 'mantener' más recientes de cada usuario. Cada segmento
+    # se escribe y se borra de la tabla caliente en una transacción corta.
+    # Los mensajes, ids y resúmenes no cambian, así que las cachés siguen
+    # siendo válidas; la búsqueda de texto solo cubre la tabla caliente.
+    esperar_escrituras()
+    antes_de = (datetime.utcnow() - timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
+    resultado = {
+        'usuarios': 0, 'segmentos': 0, 'mensajes': 0,
+        'bytes_originales': 0, 'bytes_comprimidos': 0, 'paginas_liberadas': 0,
+    }
+    
+    if id_usuario is not None:
+        usuarios = [id_usuario]
+    else:
+        with obtener_gestor().lectura() as conexion:
+            usuarios = [fila['id'] for fila in conexion.execute("SELECT id FROM users ORDER BY id")]
+    
+    for usuario in usuarios:
+        _archivar_usuario(usuario, antes_de, mantener, resultado)
+    
+    if resultado['mensajes']:
+        resultado['paginas_liberadas'] = _liberar_paginas('main')
+        with obtener_gestor().escritura() as conexion:
+            conexion.execute("PRAGMA optimize")
+    return resultado
+
+def activar_vacuum_incremental():
+    # Una base de datos creada antes del archivo tiene auto_vacuum = NONE;
+    # cambiarlo exige reescribirla entera con VACUUM, que bloquea las
+    # escrituras mientras dura.
+    esperar_escrituras()
+    with obtener_gestor().escritura() as conexion:
+        if conexion.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        conexion.commit()
+        conexion.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conexion.execute("VACUUM")
+
+def exportar_registros() -> Iterator[dict]:
+    # Recorre usuarios, resúmenes y mensajes (incluidos los archivados) con
+    # cursores, sin cargar tablas enteras en memoria. Todo se lee dentro de
+    # una transacción de lectura para que la copia sea coherente aunque la
+    # aplicación siga escribiendo. El resumen va antes que los mensajes para
+    # que la importación sepa qué id tiene que traducir.
+    esperar_escrituras()
+    with obtener_gestor().lectura() as conexion:
+        conexion.execute("BEGIN")
+        usuarios = conexion.execute(
+            "SELECT id, username, password_hash, created_at FROM users ORDER BY id"
+        )
+        for usuario in usuarios:
+            id_usuario = usuario['id']
+            yield {
+                'tipo': 'usuario',
+                'id': id_usuario,
+                'username': usuario['username'],
+                'password_hash': usuario['password_hash'],
+                'created_at': usuario['created_at'],
+            }
+            resumen = conexion.execute(
+                "SELECT summary, last_message_id, token_count, updated_at "
+                "FROM conversation_summaries WHERE user_id = ?",
+                (id_usuario,)
+            ).fetchone()
+            if resumen:
+                yield {
+                    'tipo': 'resumen',
+                    'user_id': id_usuario,
+                    'summary': resumen['summary'],
+                    'last_message_id': resumen['last_message_id'],
+                    'token_count': resumen['token_count'],
+                    'updated_at': resumen['updated_at'],
+                }
+            for mensaje in _mensajes_asc(conexion, id_usuario):
+                mensaje['tipo'] = 'mensaje'
+                mensaje['user_id'] = id_usuario
+                yield mensaje
+
+class _Importacion:
+    # Estado de una importación: usuarios ya traducidos (id del fichero ->
+    # id nuevo, None si se omitió), el lote de mensajes pendiente y los
+    # resúmenes que esperan a que llegue su mensaje de corte.
+    
+    def __init__(self, conexion: sqlite3.Connection, tamano_lote: int, filas_por_transaccion: int):
+        self.conexion = conexion
+        self.tamano_lote = max(1, tamano_lote)
+        self.filas_por_transaccion = max(self.tamano_lote, filas_por_transaccion)
+        self.usuarios: Dict[int, Optional[int]] = {}
+        self.lote: List[Tuple] = []
+        self.resumenes_pendientes: Dict[int, dict] = {}
+        self.resumenes_listos: List[Tuple] = []
+        self.siguiente_id = 0
+        self.filas_en_transaccion = 0
+        self.primer_id: Optional[int] = None
+        self.ultimo_id: Optional[int] = None
+        self.resultado = {
+            'usuarios': 0, 'usuarios_omitidos': 0,
+            'mensajes': 0, 'mensajes_omitidos': 0,
+            'resumenes': 0, 'resumenes_omitidos': 0,
+        }
+    
+    def _comenzar(self):
+        # Los ids de mensaje se asignan aquí para poder traducir el corte de
+        # los resúmenes sin leerlos de vuelta; se recalculan en cada
+        # transacción por si otro proceso escribió entre medias.
+        self.conexion.execute("BEGIN IMMEDIATE")
+        fila = self.conexion.execute(
+            """
+            SELECT MAX(
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'conversations'), 0),
+                COALESCE((SELECT MAX(id) FROM conversations), 0)
+            )
+            """
+        ).fetchone()
+        self.siguiente_id = fila[0] + 1
+        self.filas_en_transaccion = 0
+    
+    def _asegurar_transaccion(self):
+        if not self.conexion.in_transaction:
+            self._comenzar()
+    
+    def _vaciar_lote(self):
+        if self.lote:
+            self.conexion.executemany(_SQL_INSERTAR_MENSAJE_CON_ID, self.lote)
+            self.filas_en_transaccion += len(self.lote)
+            self.resultado['mensajes'] += len(self.lote)
+            self.lote = []
+        if self.resumenes_listos:
+            self.conexion.executemany(
+                """
+                INSERT INTO conversation_summaries (user_id, summary, last_message_id, token_count, updated_at)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                ON CONFLICT(user_id) DO NOTHING
+                """,
+                self.resumenes_listos
+            )
+            self.resultado['resumenes'] += len(self.resumenes_listos)
+            self.resumenes_listos = []
+        if self.filas_en_transaccion >= self.filas_por_transaccion:
+            self.conexion.commit()
+    
+    def usuario(self, registro: dict):
+        self._asegurar_transaccion()
+        fila = self.conexion.execute(
+            """
+            INSERT INTO users (username, password_hash, created_at)
+            VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            ON CONFLICT(username) DO NOTHING
+            RETURNING id
+            """,
+            (registro['username'], registro['password_hash'], registro.get('created_at'))
+        ).fetchone()
+        # Un nombre que ya existe no se mezcla con el usuario del fichero:
+        # se omite con todo su historial.
+        self.usuarios[registro['id']] = fila['id'] if fila else None
+        self.resultado['usuarios' if fila else 'usuarios_omitidos'] += 1
+    
+    def resumen(self, registro: dict):
+        id_usuario = self.usuarios.get(registro['user_id'])
+        if id_usuario is None:
+            self.resultado['resumenes_omitidos'] += 1
+            return
+        self.resumenes_pendientes[id_usuario] = registro
+    
+    def mensaje(self, registro: dict):
+        id_usuario = self.usuarios.get(registro['user_id'])
+        if id_usuario is None:
+            self.resultado['mensajes_omitidos'] += 1
+            return
+        self._asegurar_transaccion()
+        id_mensaje = self.siguiente_id
+        self.siguiente_id += 1
+        if self.primer_id is None:
+            self.primer_id = id_mensaje
+        self.ultimo_id = id_mensaje
+        
+        contenido = registro['content']
+        tokens = registro.get('token_count')
+        self.lote.append((
+            id_mensaje, id_usuario, registro['role'], contenido,
+            tokens if tokens is not None else estimar_tokens(contenido),
+            registro.get('timestamp') or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+        
+        resumen = self.resumenes_pendientes.get(id_usuario)
+        if resumen is not None and resumen['last_message_id'] == registro.get('id'):
+            del self.resumenes_pendientes[id_usuario]
+            self.resumenes_listos.append((
+                id_usuario, resumen['summary'], id_mensaje,
+                resumen.get('token_count') or estimar_tokens(resumen['summary']),
+                resumen.get('updated_at'),
+            ))
+        
+        if len(self.lote) >= self.tamano_lote:
+            self._vaciar_lote()
+    
+    def terminar(self):
+        if self.conexion.in_transaction:
+            self._vaciar_lote()
+            self.conexion.commit()
+        # Resúmenes cuyo mensaje de corte no apareció: se regenerarán.
+        self.resultado['resumenes_omitidos'] += len(self.resumenes_pendientes)
+        self.resumenes_pendientes.clear()
+
+def importar_registros(registros: Iterable[dict], tamano_lote: int = 10000,
+                       filas_por_transaccion: int = 200000) -> dict:
+    # Inserta con executemany por lotes y confirma cada 'filas_por_transaccion'
+    # mensajes. Mientras dura, conversations no tiene índices secundarios ni
+    # trigger de FTS; al terminar se indexan solo los mensajes nuevos y se
+    # recrean los índices de una pasada. Está pensada para ejecutarse con la
+    # aplicación parada.
+    esperar_escrituras()
+    with obtener_gestor().escritura() as conexion:
+        conexion.commit()
+        migraciones.suspender_indices_conversaciones(conexion)
+        conexion.commit()
+        importacion = _Importacion(conexion, tamano_lote, filas_por_transaccion)
+        try:
+            for registro in registros:
+                tipo = registro.get('tipo')
+                if tipo == 'mensaje':
+                    importacion.mensaje(registro)
+                elif tipo == 'usuario':
+                    importacion.usuario(registro)
+                elif tipo == 'resumen':
+                    importacion.resumen(registro)
+            importacion.terminar()
+        finally:
+            if conexion.in_transaction:
+                conexion.rollback()
+            if importacion.primer_id is not None:
+                conexion.execute(
+                    """
+                    INSERT INTO conversations_fts(rowid, content, owner)
+                    SELECT id, content, 'u' || user_id FROM conversations
+                    WHERE id BETWEEN ? AND ?
+                    """,
+                    (importacion.primer_id, importacion.ultimo_id)
+                )
+                migraciones.sumar_estadisticas_mensajes(
+                    conexion, importacion.primer_id, importacion.ultimo_id
+                )
+            migraciones.restaurar_indices_conversaciones(
+                conexion, reconstruir_fts=False, recalcular_estadisticas=False
+            )
+            conexion.commit()
+        conexion.execute("PRAGMA optimize")
+    return importacion.resultado
+
+def obtener_respuesta_cache(clave: str, creada_despues_de: float, ahora: float) -> Optional[str]:
+    with obtener_gestor().lectura() as conexion:
+        fila = conexion.execute(
+            "SELECT response FROM response_cache WHERE cache_key = ? AND created_at >= ?",
+            (clave, creada_despues_de)
+        ).fetchone()
+    
+    if not fila:
+        return None
+    
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute(
+            "UPDATE response_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?",
+            (ahora, clave)
+        )
+    return fila['response']
+
+def guardar_respuesta_cache(clave: str, modelo: str, respuesta: str, ahora: float, max_entradas: int):
+    with obtener_gestor().escritura() as conexion:
+        conexion.execute(
+            """
+            INSERT INTO response_cache (cache_key, model, response, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET
+                response = excluded.response,
+                created_at = excluded.created_at,
+                last_used_at = excluded.last_used_at
+            """,
+            (clave, modelo, respuesta, ahora, ahora)
+        )
+        total = conexion.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        if total > max_entradas:
+            conexion.execute(
+                """
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache ORDER BY last_used_at ASC LIMIT ?
+                )
+                """,
+                (total - max_entradas,)
+            )
+
+def purgar_respuestas_cache(creada_antes_de: float) -> int:
+    with obtener_gestor().escritura() as conexion:
+        cursor = conexion.execute(
+            "DELETE FROM response_cache WHERE created_at < ?", (creada_antes_de,)
+        )
+        return cursor.rowcount
+
+def guardar_metricas(ahora: float, filas: List[Tuple], registradas_antes_de: float):
+    with obtener_gestor().escritura() as conexion:
+        if filas:
+            conexion.executemany(
+                """
+                INSERT INTO metrics (recorded_at, kind, name, count, total, p50, p95, p99)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [(ahora,) + tuple(fila) for fila in filas]
+            )
+        conexion.execute("DELETE FROM metrics WHERE recorded_at < ?", (registradas_antes_de,))
+
+def estadisticas_cache() -> dict:
+    return cache.estadisticas()
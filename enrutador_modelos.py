@@ -0,0 +1,257 @@
+import os
+import time
+import queue
+import random
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import metricas
+
+# "modelo[:tokens_de_contexto]" separados por comas, del más barato al más
+# caro. El primero es el preferido cuando las latencias son parecidas.
+MODELOS_GROQ = os.getenv('GROQ_MODELOS', 'llama-3.1-8b-instant:131072')
+COBERTURA_ACTIVA = os.getenv('GROQ_COBERTURA', '0') == '1'
+PENALIZACION_ORDEN = float(os.getenv('GROQ_PENALIZACION_ORDEN', '0.5'))
+EXPLORACION = 0.05
+SUAVIZADO = 0.2
+LATENCIA_INICIAL = 1.0
+PLAZO_INICIAL = 2.0
+PLAZO_MINIMO = 0.25
+MUESTRAS_PARA_P95 = 20
+CONTEXTO_POR_DEFECTO = 8192
+
+def parsear_modelos(texto: str) -> List[Tuple[str, int]]:
+    modelos = []
+    for parte in texto.split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        nombre, _, contexto = parte.partition(':')
+        modelos.append((nombre.strip(), int(contexto) if contexto.strip() else CONTEXTO_POR_DEFECTO))
+    return modelos
+
+class EstadisticasModelo:
+    __slots__ = ('nombre', 'contexto', 'latencia', 'tasa_error', 'recientes', 'peticiones', 'errores')
+    
+    def __init__(self, nombre: str, contexto: int):
+        self.nombre = nombre
+        self.contexto = contexto
+        self.latencia: Optional[float] = None
+        self.tasa_error = 0.0
+        self.recientes = deque(maxlen=200)
+        self.peticiones = 0
+        self.errores = 0
+    
+    def p95(self) -> Optional[float]:
+        if len(self.recientes) < MUESTRAS_PARA_P95:
+            return None
+        ordenadas = sorted(self.recientes)
+        return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * 0.95))]
+
+class EnrutadorModelos:
+    # Elige modelo por petición según el tamaño del prompt (debe caber en su
+    # contexto) y la latencia hasta el primer token esperada, que incluye el
+    # coste de reintentar tras un error. Con cobertura activa, si el primer
+    # intento no produce nada antes del p95 del modelo se lanza otro en el
+    # siguiente modelo y gana el que responda antes.
+    
+    def __init__(self, modelos: List[Tuple[str, int]], cobertura: bool = COBERTURA_ACTIVA,
+                 penalizacion_orden: float = PENALIZACION_ORDEN):
+        if not modelos:
+            raise ValueError("Hay que configurar al menos un modelo en GROQ_MODELOS")
+        self._modelos = [EstadisticasModelo(nombre, contexto) for nombre, contexto in modelos]
+        self._por_nombre = {m.nombre: m for m in self._modelos}
+        self.cobertura = cobertura and len(self._modelos) > 1
+        self.penalizacion_orden = penalizacion_orden
+        self._bloqueo = threading.Lock()
+        self._rng = random.Random()
+        self.coberturas = 0
+        self.coberturas_ganadas = 0
+    
+    @property
+    def modelo_preferido(self) -> str:
+        return self._modelos[0].nombre
+    
+    def _puntuacion(self, indice: int, modelo: EstadisticasModelo) -> float:
+        latencia = modelo.latencia if modelo.latencia is not None else LATENCIA_INICIAL
+        esperada = latencia / max(0.05, 1.0 - modelo.tasa_error)
+        return esperada * (1.0 + self.penalizacion_orden * indice)
+    
+    def elegir(self, tokens_prompt: int, excluir: Iterable[str] = ()) -> Optional[str]:
+        excluir = set(excluir)
+        with self._bloqueo:
+            candidatos = [
+                (i, m) for i, m in enumerate(self._modelos)
+                if m.nombre not in excluir and m.contexto >= tokens_prompt
+            ]
+            if not candidatos:
+                # Si nada cabe se intenta con el de más contexto.
+                candidatos = [
+                    (i, m) for i, m in enumerate(self._modelos) if m.nombre not in excluir
+                ]
+                candidatos = sorted(candidatos, key=lambda c: -c[1].contexto)[:1]
+            if not candidatos:
+                return None
+            if len(candidatos) > 1 and self._rng.random() < EXPLORACION:
+                return self._rng.choice(candidatos)[1].nombre
+            return min(candidatos, key=lambda c: self._puntuacion(*c))[1].nombre
+    
+    def plazo_cobertura(self, nombre: str) -> float:
+        with self._bloqueo:
+            p95 = self._por_nombre[nombre].p95()
+        return PLAZO_INICIAL if p95 is None else max(PLAZO_MINIMO, p95)
+    
+    def registrar_exito(self, nombre: str, segundos: float):
+        with self._bloqueo:
+            modelo = self._por_nombre.get(nombre)
+            if modelo is None:
+                return
+            modelo.peticiones += 1
+            modelo.recientes.append(segundos)
+            modelo.latencia = segundos if modelo.latencia is None else (
+                SUAVIZADO * segundos + (1 - SUAVIZADO) * modelo.latencia
+            )
+            modelo.tasa_error *= (1 - SUAVIZADO)
+    
+    def registrar_error(self, nombre: str):
+        with self._bloqueo:
+            modelo = self._por_nombre.get(nombre)
+            if modelo is None:
+                return
+            modelo.peticiones += 1
+            modelo.errores += 1
+            modelo.tasa_error = SUAVIZADO + (1 - SUAVIZADO) * modelo.tasa_error
+    
+    def primera_respuesta(self, tokens_prompt: int,
+                          abrir: Callable[[str], Iterator]) -> Tuple[str, object, Iterator]:
+        # 'abrir(modelo)' devuelve un iterador; la respuesta es válida desde
+        # que produce su primer elemento. Devuelve (modelo, primer elemento,
+        # iterador para el resto). Los intentos perdedores se cierran.
+        modelo = self.elegir(tokens_prompt)
+        if not self.cobertura:
+            return self._intento_directo(modelo, abrir)
+        
+        resultados: "queue.Queue" = queue.Queue()
+        ganador = threading.Event()
+        lanzados = []
+        
+        def lanzar(nombre: str):
+            lanzados.append(nombre)
+            threading.Thread(
+                target=self._intento, args=(nombre, abrir, resultados, ganador),
+                name=f"intento-{nombre}", daemon=True,
+            ).start()
+        
+        lanzar(modelo)
+        plazo = self.plazo_cobertura(modelo)
+        activos = 1
+        ultimo_error = None
+        
+        while True:
+            try:
+                nombre, error, primero, iterador = resultados.get(timeout=plazo)
+            except queue.Empty:
+                # El primer intento no ha respondido antes de su p95.
+                siguiente = self.elegir(tokens_prompt, excluir=lanzados)
+                plazo = None
+                if siguiente is not None:
+                    with self._bloqueo:
+                        self.coberturas += 1
+                    metricas.contar('coberturas')
+                    lanzar(siguiente)
+                    activos += 1
+                continue
+            
+            activos -= 1
+            if error is None:
+                if nombre != modelo:
+                    with self._bloqueo:
+                        self.coberturas_ganadas += 1
+                    metricas.contar('coberturas_ganadas')
+                return nombre, primero, iterador
+            
+            ultimo_error = error
+            if activos == 0:
+                # Sin nadie en vuelo, se pasa al siguiente modelo sin esperar.
+                siguiente = self.elegir(tokens_prompt, excluir=lanzados)
+                if siguiente is None:
+                    raise ultimo_error
+                lanzar(siguiente)
+                activos += 1
+                plazo = None
+    
+    def _intento_directo(self, nombre: str, abrir: Callable[[str], Iterator]):
+        inicio = time.perf_counter()
+        try:
+            iterador = iter(abrir(nombre))
+            primero = next(iterador)
+        except StopIteration:
+            self.registrar_exito(nombre, time.perf_counter() - inicio)
+            return nombre, None, iter(())
+        except Exception:
+            self.registrar_error(nombre)
+            raise
+        self.registrar_exito(nombre, time.perf_counter() - inicio)
+        return nombre, primero, iterador
+    
+    def _intento(self, nombre: str, abrir: Callable[[str], Iterator],
+                 resultados: "queue.Queue", ganador: threading.Event):
+        inicio = time.perf_counter()
+        iterador = None
+        try:
+            iterador = iter(abrir(nombre))
+            try:
+                primero = next(iterador)
+            except StopIteration:
+                primero, iterador = None, iter(())
+        except Exception as e:
+            self.registrar_error(nombre)
+            resultados.put((nombre, e, None, None))
+            return
+        
+        self.registrar_exito(nombre, time.perf_counter() - inicio)
+        with self._bloqueo:
+            gana = not ganador.is_set()
+            ganador.set()
+        if gana:
+            resultados.put((nombre, None, primero, iterador))
+        else:
+            # Cerrar el iterador que devolvió 'abrir' es lo que libera lo que
+            # reservó (en ChatBotIA._deltas, la reserva del limitador), así
+            # que se cierra aunque no vaya a leerse nada más.
+            cerrar = getattr(iterador, 'close', None)
+            if cerrar is not None:
+                try:
+                    cerrar()
+                except Exception:
+                    pass
+    
+    def estadisticas(self) -> Dict:
+        with self._bloqueo:
+            return {
+                'cobertura': self.cobertura,
+                'coberturas': self.coberturas,
+                'coberturas_ganadas': self.coberturas_ganadas,
+                'modelos': {
+                    m.nombre: {
+                        'contexto': m.contexto,
+                        'latencia_s': m.latencia,
+                        'p95_s': m.p95(),
+                        'tasa_error': m.tasa_error,
+                        'peticiones': m.peticiones,
+                        'errores': m.errores,
+                    }
+                    for m in self._modelos
+                },
+            }
+
+_enrutador_global = None
+_bloqueo_global = threading.Lock()
+
+def obtener_enrutador() -> EnrutadorModelos:
+    global _enrutador_global
+    with _bloqueo_global:
+        if _enrutador_global is None:
+            _enrutador_global = EnrutadorModelos(parsear_modelos(MODELOS_GROQ))
+        return _enrutador_global
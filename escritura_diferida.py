@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+TAMANO_LOTE = 256
+INTERVALO_VACIADO = 0.05
+
+class ColaEscrituraDiferida:
+    # Un único hilo escritor agrupa los INSERT encolados y los confirma con
+    # executemany en una sola transacción por ventana de vaciado. La ventana
+    # se cierra al llegar a tamano_lote filas o tras intervalo segundos desde
+    # la primera fila pendiente, lo que ocurra antes.
+    
+    def __init__(self, escribir_lote: Callable[[List[Tuple]], None],
+                 escribir_fila: Callable[[Tuple], None],
+                 tamano_lote: int = TAMANO_LOTE,
+                 intervalo: float = INTERVALO_VACIADO,
+                 al_descartar: Optional[Callable[[Tuple, Exception], None]] = None):
+        self._escribir_lote = escribir_lote
+        self._escribir_fila = escribir_fila
+        self._al_descartar = al_descartar
+        self.tamano_lote = max(1, tamano_lote)
+        self.intervalo = intervalo
+        
+        self._pendientes: List[Tuple[int, Tuple]] = []
+        self._pendientes_por_usuario: Counter = Counter()
+        self._condicion = threading.Condition()
+        self._encoladas = 0
+        self._persistidas = 0
+        self._primera_pendiente: Optional[float] = None
+        self._cerrando = False
+        self.lotes_escritos = 0
+        self.filas_escritas = 0
+        
+        self._hilo = threading.Thread(target=self._bucle, name="escritura-diferida", daemon=True)
+        self._hilo.start()
+    
+    def encolar(self, id_usuario: int, fila: Tuple) -> int:
+        with self._condicion:
+            if self._cerrando:
+                raise RuntimeError("La cola de escritura diferida está cerrada")
+            self._encoladas += 1
+            self._pendientes.append((id_usuario, fila))
+            self._pendientes_por_usuario[id_usuario] += 1
+            if self._primera_pendiente is None:
+                self._primera_pendiente = time.monotonic()
+            if len(self._pendientes) == 1 or len(self._pendientes) >= self.tamano_lote:
+                self._condicion.notify_all()
+            return self._encoladas
+    
+    def tiene_pendientes(self, id_usuario: Optional[int] = None) -> bool:
+        with self._condicion:
+            if id_usuario is None:
+                return self._persistidas < self._encoladas
+            return self._pendientes_por_usuario[id_usuario] > 0
+    
+    def esperar(self, secuencia: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        # Barrera de vaciado: vuelve cuando todo lo encolado hasta 'secuencia'
+        # (por defecto, todo lo encolado hasta ahora) está confirmado.
+        with self._condicion:
+            objetivo = self._encoladas if secuencia is None else secuencia
+            if self._persistidas >= objetivo:
+                return True
+            if self._pendientes:
+                self._primera_pendiente = 0.0
+            self._condicion.notify_all()
+            return self._condicion.wait_for(lambda: self._persistidas >= objetivo, timeout)
+    
+    def cerrar(self, timeout: Optional[float] = None):
+        with self._condicion:
+            self._cerrando = True
+            self._condicion.notify_all()
+        self._hilo.join(timeout)
+    
+    def _bucle(self):
+        while True:
+            with self._condicion:
+                while True:
+                    if self._pendientes:
+                        espera = self._primera_pendiente + self.intervalo - time.monotonic()
+                        if self._cerrando or len(self._pendientes) >= self.tamano_lote or espera <= 0:
+                            break
+                        self._condicion.wait(espera)
+                    elif self._cerrando:
+                        return
+                    else:
+                        self._condicion.wait()
+                
+                lote = self._pendientes[:self.tamano_lote]
+                del self._pendientes[:self.tamano_lote]
+                self._primera_pendiente = time.monotonic() if self._pendientes else None
+            
+            self._escribir(lote)
+            
+            with self._condicion:
+                for id_usuario, _ in lote:
+                    self._pendientes_por_usuario[id_usuario] -= 1
+                    if self._pendientes_por_usuario[id_usuario] <= 0:
+                        del self._pendientes_por_usuario[id_usuario]
+                self._persistidas += len(lote)
+                self.lotes_escritos += 1
+                self.filas_escritas += len(lote)
+                self._condicion.notify_all()
+    
+    def _escribir(self, lote: List[Tuple[int, Tuple]]):
+        filas = [fila for _, fila in lote]
+        try:
+            self._escribir_lote(filas)
+            return
+        except Exception as e:
+            print(f"Error al escribir lote de {len(filas)} mensajes, se reintenta fila a fila: {e}")
+        
+        for fila in filas:
+            try:
+                self._escribir_fila(fila)
+            except Exception as e:
+                print(f"Mensaje descartado al escribir en diferido: {e}")
+                if self._al_descartar:
+                    self._al_descartar(fila, e)
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import database as bd
+import servidor_simulado
+from benchmark import texto_aleatorio, resumir_tiempos
+
+PREFIJO_ERROR = "Lo siento, ocurrió un error"
+LIMITE_SIN_CUOTA = 10 ** 9
+
+class Registro:
+    # Acumula tiempos por operación desde varios hilos.
+    
+    def __init__(self):
+        self._bloqueo = threading.Lock()
+        self.tiempos: Dict[str, List[float]] = {}
+        self.errores: Dict[str, int] = {}
+    
+    def anotar(self, operacion: str, milisegundos: float):
+        with self._bloqueo:
+            self.tiempos.setdefault(operacion, []).append(milisegundos)
+    
+    def fallo(self, operacion: str):
+        with self._bloqueo:
+            self.errores[operacion] = self.errores.get(operacion, 0) + 1
+
+def _cronometrar(registro: Registro, operacion: str, funcion, *args):
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    registro.anotar(operacion, (time.perf_counter() - inicio) * 1000)
+    return resultado
+
+def simular_usuario(indice: int, chatbot, mensajes: int, registro: Registro,
+                    semilla: int, prefijo: str, pausa: float):
+    import auth
+    
+    rng = random.Random(semilla + indice)
+    nombre = f"{prefijo}_{indice}"
+    contrasena = "carga1234"
+    
+    exito, _, id_usuario = _cronometrar(registro, 'registrar', auth.registrar_usuario, nombre, contrasena)
+    if not exito:
+        registro.fallo('registrar')
+        return
+    
+    exito, _, usuario = _cronometrar(registro, 'iniciar_sesion', auth.iniciar_sesion, nombre, contrasena)
+    if not exito:
+        registro.fallo('iniciar_sesion')
+        return
+    id_usuario = usuario['id']
+    
+    for _ in range(mensajes):
+        inicio = time.perf_counter()
+        primer_fragmento = None
+        partes = []
+        for fragmento in chatbot.enviar_mensaje_stream(id_usuario, texto_aleatorio(rng, 15), usar_cache=False):
+            if primer_fragmento is None:
+                primer_fragmento = time.perf_counter()
+            partes.append(fragmento)
+        fin = time.perf_counter()
+        
+        if "".join(partes).startswith(PREFIJO_ERROR):
+            registro.fallo('enviar')
+        else:
+            registro.anotar('primer_token', ((primer_fragmento or fin) - inicio) * 1000)
+            registro.anotar('enviar', (fin - inicio) * 1000)
+        if pausa:
+            time.sleep(rng.uniform(0, 2 * pausa))
+    
+    _cronometrar(registro, 'limpiar', chatbot.limpiar_historial, id_usuario)
+
+def ejecutar(usuarios: int, mensajes: int, concurrencia: int, url: str, semilla: int,
+             pausa: float = 0.0, directorio: Optional[str] = None) -> Dict:
+    # ChatBotIA lee GROQ_BASE_URL al importarse, así que se fija antes.
+    os.environ['GROQ_BASE_URL'] = url
+    os.environ.setdefault('GROQ_API_KEY', "simulado")
+    from chatbot import ChatBotIA
+    
+    directorio = directorio or tempfile.mkdtemp(prefix="chatbot_carga_")
+    bd.NOMBRE_BD = os.path.join(directorio, "carga.db")
+    bd.inicializar_base_datos()
+    
+    chatbot = ChatBotIA()
+    registro = Registro()
+    prefijo = f"carga{int(time.time())}"
+    
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix="usuario") as ejecutor:
+        futuros = [
+            ejecutor.submit(simular_usuario, i, chatbot, mensajes, registro, semilla, prefijo, pausa)
+            for i in range(usuarios)
+        ]
+        for futuro in futuros:
+            try:
+                futuro.result()
+            except Exception as e:
+                print(f"Usuario simulado abortado: {e}")
+                registro.fallo('usuario')
+    duracion = time.perf_counter() - inicio
+    bd.esperar_escrituras()
+    
+    resultados = {nombre: resumir_tiempos(tiempos) for nombre, tiempos in registro.tiempos.items()}
+    turnos = len(registro.tiempos.get('enviar', []))
+    operaciones = sum(len(t) for nombre, t in registro.tiempos.items() if nombre != 'primer_token')
+    
+    return {
+        'metadatos': {
+            'fecha': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'url': url,
+            'usuarios': usuarios,
+            'mensajes_por_usuario': mensajes,
+            'concurrencia': concurrencia,
+            'semilla': semilla,
+        },
+        'duracion_s': duracion,
+        'turnos_por_segundo': turnos / duracion if duracion else 0.0,
+        'operaciones_por_segundo': operaciones / duracion if duracion else 0.0,
+        'errores': registro.errores,
+        'resultados': resultados,
+    }
+
+def main(argumentos: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Generador de carga: usuarios simulados que se registran, inician sesión, "
+                    "envían mensajes y limpian su historial en paralelo"
+    )
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--mensajes", type=int, default=5, help="mensajes por usuario")
+    parser.add_argument("--concurrencia", type=int, default=20, help="usuarios activos a la vez")
+    parser.add_argument("--pausa", type=float, default=0.0, help="pausa media entre mensajes de un usuario (s)")
+    parser.add_argument("--url", help="servidor compatible ya en marcha; si se omite se inicia uno simulado")
+    parser.add_argument("--salida", help="fichero JSON donde guardar los resultados")
+    servidor_simulado.argumentos_configuracion(parser)
+    args = parser.parse_args(argumentos)
+    
+    servidor = None
+    url = args.url
+    if not url:
+        servidor = servidor_simulado.iniciar_en_segundo_plano(servidor_simulado.configuracion_desde_argumentos(args))
+        url = servidor_simulado.url_base(servidor)
+        # Sin --limite-rpm/--limite-tpm el simulador no aplica cuota y el
+        # limitador del cliente recibe una tan alta que nunca espera: se mide
+        # la aplicación y no la cuota gratuita de Groq. Con ellos, servidor y
+        # limitador usan la misma.
+        os.environ.setdefault('GROQ_LIMITE_RPM', str(args.limite_rpm or LIMITE_SIN_CUOTA))
+        os.environ.setdefault('GROQ_LIMITE_TPM', str(args.limite_tpm or LIMITE_SIN_CUOTA))
+    
+    semilla = args.semilla if args.semilla is not None else 42
+    try:
+        resultado = ejecutar(args.usuarios, args.mensajes, args.concurrencia, url, semilla, args.pausa)
+    finally:
+        if servidor:
+            servidor.shutdown()
+            servidor.server_close()
+        bd.cerrar_conexiones()
+    
+    for nombre, medida in resultado['resultados'].items():
+        print(f"{nombre:16} n={medida['n']:<6} p50={medida['p50_ms']:.1f}ms "
+              f"p95={medida['p95_ms']:.1f}ms p99={medida['p99_ms']:.1f}ms")
+    print(f"Duración: {resultado['duracion_s']:.2f}s  "
+          f"turnos/s: {resultado['turnos_por_segundo']:.2f}  "
+          f"operaciones/s: {resultado['operaciones_por_segundo']:.2f}")
+    if resultado['errores']:
+        print(f"Errores: {resultado['errores']}")
+    
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import os
+import re
+import time
+import random
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+
+import metricas
+
+LIMITADOR_ACTIVO = os.getenv('GROQ_LIMITADOR', '1') == '1'
+LIMITE_PETICIONES_MINUTO = int(os.getenv('GROQ_LIMITE_RPM', '30'))
+LIMITE_TOKENS_MINUTO = int(os.getenv('GROQ_LIMITE_TPM', '6000'))
+MAX_REINTENTOS = int(os.getenv('GROQ_MAX_REINTENTOS', '5'))
+# Parte del límite de tokens por minuto que puede reservar una sola petición;
+# el resto queda para las demás sesiones.
+FRACCION_TOKENS_PETICION = float(os.getenv('GROQ_FRACCION_TPM_PETICION', '0.5'))
+ESPERA_BASE = 0.5
+ESPERA_MAXIMA = 30.0
+
+_DURACION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_SEGUNDOS_POR_UNIDAD = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+T = TypeVar('T')
+
+def parsear_duracion(texto: Optional[str]) -> Optional[float]:
+    # Formato de x-ratelimit-reset-*: "7.66s", "2m59.56s", "250ms", "1h2m".
+    if not texto:
+        return None
+    try:
+        return float(texto)
+    except ValueError:
+        pass
+    partes = _DURACION.findall(texto)
+    if not partes:
+        return None
+    return sum(float(valor) * _SEGUNDOS_POR_UNIDAD[unidad] for valor, unidad in partes)
+
+def _entero(texto: Optional[str]) -> Optional[int]:
+    try:
+        return int(float(texto)) if texto is not None else None
+    except ValueError:
+        return None
+
+def segundos_retry_after(cabeceras) -> Optional[float]:
+    if cabeceras is None:
+        return None
+    try:
+        return float(cabeceras.get('retry-after-ms')) / 1000
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(cabeceras.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def tokens_de_uso(uso) -> Optional[int]:
+    if uso is None:
+        return None
+    if isinstance(uso, dict):
+        prompt, completion = uso.get('prompt_tokens'), uso.get('completion_tokens')
+    else:
+        prompt, completion = getattr(uso, 'prompt_tokens', None), getattr(uso, 'completion_tokens', None)
+    if prompt is None and completion is None:
+        return None
+    return (prompt or 0) + (completion or 0)
+
+class CuboTokens:
+    # Se rellena de forma continua a 'capacidad' unidades por 'periodo'. El
+    # nivel puede quedar negativo cuando el consumo real supera lo reservado.
+    
+    def __init__(self, capacidad: float, periodo: float = 60.0):
+        self.periodo = periodo
+        self.capacidad = float(max(1, capacidad))
+        self.ritmo = self.capacidad / periodo
+        self.nivel = self.capacidad
+        self.actualizado = time.monotonic()
+    
+    def _rellenar(self, ahora: float):
+        self.nivel = min(self.capacidad, self.nivel + (ahora - self.actualizado) * self.ritmo)
+        self.actualizado = ahora
+    
+    def espera(self, cantidad: float, ahora: float) -> float:
+        self._rellenar(ahora)
+        # Una petición mayor que la capacidad pasa cuando el cubo está lleno.
+        cantidad = min(cantidad, self.capacidad)
+        if self.nivel >= cantidad:
+            return 0.0
+        return (cantidad - self.nivel) / self.ritmo
+    
+    def consumir(self, cantidad: float):
+        self.nivel -= min(cantidad, self.capacidad)
+    
+    def ajustar(self, cantidad: float):
+        self.nivel = min(self.capacidad, self.nivel + cantidad)
+    
+    def cambiar_capacidad(self, capacidad: float):
+        if capacidad > 0 and capacidad != self.capacidad:
+            self.capacidad = float(capacidad)
+            self.ritmo = self.capacidad / self.periodo
+            self.nivel = min(self.nivel, self.capacidad)
+    
+    def limitar(self, restantes: float, ahora: float):
+        # El servidor conoce el consumo de todos los procesos; solo se usa
+        # para bajar el nivel local, nunca para subirlo.
+        self._rellenar(ahora)
+        self.nivel = min(self.nivel, restantes)
+
+class LimitadorGroq:
+    # Presupuesto compartido de peticiones y tokens por minuto. Las peticiones
+    # esperan en una cola por clave (id de usuario) y las claves se atienden
+    # por turnos, así que un usuario con muchas peticiones no deja sin turno
+    # a los demás.
+    
+    def __init__(self, peticiones_minuto: int = LIMITE_PETICIONES_MINUTO,
+                 tokens_minuto: int = LIMITE_TOKENS_MINUTO, max_reintentos: int = MAX_REINTENTOS):
+        self._peticiones = CuboTokens(peticiones_minuto)
+        self._tokens = CuboTokens(tokens_minuto)
+        self.max_reintentos = max_reintentos
+        self._colas: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._bloqueado_hasta = 0.0
+        self._condicion = threading.Condition()
+        self.esperas = 0
+        self.segundos_esperando = 0.0
+        self.reintentos = 0
+        self.limitadas = 0
+    
+    def _es_turno(self, clave: Hashable, turno: object) -> bool:
+        primera = next(iter(self._colas))
+        return primera == clave and self._colas[clave][0] is turno
+    
+    def adquirir(self, clave: Hashable, tokens: int):
+        turno = object()
+        inicio = time.monotonic()
+        with self._condicion:
+            self._colas.setdefault(clave, deque()).append(turno)
+            try:
+                while True:
+                    if not self._es_turno(clave, turno):
+                        self._condicion.wait()
+                        continue
+                    ahora = time.monotonic()
+                    espera = max(
+                        self._bloqueado_hasta - ahora,
+                        self._peticiones.espera(1, ahora),
+                        self._tokens.espera(tokens, ahora),
+                    )
+                    if espera <= 0:
+                        self._peticiones.consumir(1)
+                        self._tokens.consumir(tokens)
+                        break
+                    self._condicion.wait(espera)
+            finally:
+                cola = self._colas[clave]
+                cola.remove(turno)
+                if cola:
+                    self._colas.move_to_end(clave)
+                else:
+                    del self._colas[clave]
+                esperado = time.monotonic() - inicio
+                if esperado > 0.001:
+                    self.esperas += 1
+                    self.segundos_esperando += esperado
+                self._condicion.notify_all()
+        if metricas.METRICAS_ACTIVAS:
+            metricas.observar('limitador_espera', time.monotonic() - inicio)
+    
+    def tokens_por_peticion(self) -> int:
+        with self._condicion:
+            return int(self._tokens.capacidad * FRACCION_TOKENS_PETICION)
+    
+    def liquidar(self, reservados: int, consumidos: Optional[int]):
+        # Corrige la reserva con el uso real que devolvió la API.
+        if consumidos is None:
+            return
+        with self._condicion:
+            self._tokens.ajustar(reservados - consumidos)
+            self._condicion.notify_all()
+    
+    def actualizar(self, cabeceras):
+        if cabeceras is None:
+            return
+        ahora = time.monotonic()
+        limite_tokens = _entero(cabeceras.get('x-ratelimit-limit-tokens'))
+        restantes_tokens = _entero(cabeceras.get('x-ratelimit-remaining-tokens'))
+        restantes_peticiones = _entero(cabeceras.get('x-ratelimit-remaining-requests'))
+        with self._condicion:
+            if limite_tokens:
+                self._tokens.cambiar_capacidad(limite_tokens)
+            if restantes_tokens is not None:
+                self._tokens.limitar(restantes_tokens, ahora)
+            if restantes_peticiones is not None:
+                self._peticiones.limitar(restantes_peticiones, ahora)
+                if restantes_peticiones <= 0:
+                    reinicio = parsear_duracion(cabeceras.get('x-ratelimit-reset-requests'))
+                    if reinicio:
+                        self._bloqueado_hasta = max(self._bloqueado_hasta, ahora + reinicio)
+            self._condicion.notify_all()
+    
+    def pausar(self, segundos: float):
+        # Tras un 429 nadie envía hasta que pase 'segundos'.
+        with self._condicion:
+            self._bloqueado_hasta = max(self._bloqueado_hasta, time.monotonic() + segundos)
+            self._condicion.notify_all()
+    
+    def _espera_reintento(self, error: Exception, intento: int):
+        # Devuelve (segundos, es_429) si el error es reintentable, o None.
+        from groq import APIConnectionError
+        
+        estado = getattr(error, 'status_code', None)
+        respuesta = getattr(error, 'response', None)
+        cabeceras = getattr(respuesta, 'headers', None)
+        
+        if cabeceras is not None and cabeceras.get('x-should-retry') == 'false':
+            return None
+        if not (estado == 429 or (estado is not None and estado >= 500) or estado == 408
+                or isinstance(error, (APIConnectionError, TimeoutError))):
+            return None
+        
+        self.actualizar(cabeceras)
+        retry_after = segundos_retry_after(cabeceras)
+        if retry_after is not None:
+            # Se respeta el mínimo indicado y se reparte un poco la vuelta de
+            # todas las sesiones que recibieron el mismo 429.
+            espera = retry_after + random.uniform(0, min(1.0, retry_after * 0.1))
+        else:
+            espera = random.uniform(0, min(ESPERA_MAXIMA, ESPERA_BASE * 2 ** intento))
+        return espera, estado == 429
+    
+    def ejecutar(self, clave: Hashable, tokens: int, llamada: Callable[[], T]) -> T:
+        intento = 0
+        while True:
+            self.adquirir(clave, tokens)
+            try:
+                return llamada()
+            except Exception as e:
+                # Un intento fallido no llega a usar su reserva; sin
+                # devolverla, cada reintento descontaría otra vez la
+                # estimación completa del cubo compartido. Si la API sí
+                # contó algo, sus cabeceras lo corrigen en actualizar().
+                with self._condicion:
+                    self._tokens.ajustar(tokens)
+                    self._condicion.notify_all()
+                reintento = self._espera_reintento(e, intento)
+                if reintento is None or intento >= self.max_reintentos:
+                    raise
+                espera, es_429 = reintento
+                intento += 1
+                with self._condicion:
+                    self.reintentos += 1
+                    if es_429:
+                        self.limitadas += 1
+                metricas.contar('reintentos_groq')
+                if es_429:
+                    self.pausar(espera)
+                else:
+                    time.sleep(espera)
+    
+    def estadisticas(self) -> Dict:
+        with self._condicion:
+            ahora = time.monotonic()
+            self._peticiones._rellenar(ahora)
+            self._tokens._rellenar(ahora)
+            return {
+                'peticiones_disponibles': self._peticiones.nivel,
+                'tokens_disponibles': self._tokens.nivel,
+                'limite_tokens_minuto': self._tokens.capacidad,
+                'en_espera': sum(len(cola) for cola in self._colas.values()),
+                'esperas': self.esperas,
+                'segundos_esperando': self.segundos_esperando,
+                'reintentos': self.reintentos,
+                'limitadas': self.limitadas,
+            }
+
+def llamar_con_limite(limitador: LimitadorGroq, cliente, clave: Hashable, tokens: int, **parametros):
+    # Usa with_raw_response para leer las cabeceras de límite de cada
+    # respuesta; los clientes sustitutos sin ese atributo se llaman tal cual.
+    completions = cliente.chat.completions
+    crudo = getattr(completions, 'with_raw_response', None)
+    
+    def llamada():
+        if crudo is None:
+            return completions.create(**parametros)
+        respuesta = crudo.create(**parametros)
+        limitador.actualizar(respuesta.headers)
+        return respuesta.parse()
+    
+    return limitador.ejecutar(clave, tokens, llamada)
+
+_limitador_global = None
+_bloqueo_global = threading.Lock()
+
+def obtener_limitador() -> LimitadorGroq:
+    global _limitador_global
+    with _bloqueo_global:
+        if _limitador_global is None:
+            _limitador_global = LimitadorGroq()
+        return _limitador_global
@@ -1,8 +1,31 @@
+import time
+INICIO_ARRANQUE = time.perf_counter()
+import os
+import argparse
+import threading
 import flet as ft
-from typing import Optional
+from typing import List, Optional, Tuple
 import database as bd
 import auth
-from chatbot import ChatBotIA
+import metricas
+import clientes_groq
+from admision import obtener_control_admision
+from chatbot import ChatBotIA, precargar_groq
+from cola_envios import obtener_cola_envios
+FIN_IMPORTACIONES = time.perf_counter()
+
+FPS_STREAMING = 20
+MAX_MENSAJES_EN_COLA = 5
+TAMANO_PAGINA_HISTORIAL = 50
+TAMANO_PAGINA_BUSQUEDA = 20
+TAMANO_PAGINA_USUARIOS = 30
+MARCAS_BUSQUEDA = ("\x02", "\x03")
+UMBRAL_SCROLL_HISTORIAL = 200
+CLAVE_TOKEN_SESION = "chatbot.token_sesion"
+INFORME_ARRANQUE = os.getenv('INFORME_ARRANQUE', '0') == '1'
+
+# En modo web solo la primera sesión mide el arranque del proceso.
+_arranque_medido = threading.Event()
 
 class AplicacionChat:
     
@@ -10,6 +33,20 @@ class AplicacionChat:
         self.pagina = pagina
         self.usuario_actual: Optional[dict] = None
         self.chatbot: Optional[ChatBotIA] = None
+        self.sesion_chat = 0
+        self.mensajes_pendientes = 0
+        self.bloqueo_envios = threading.Lock()
+        self.bloqueo_historial = threading.Lock()
+        self.id_mensaje_mas_antiguo: Optional[int] = None
+        self.hay_mas_historial = False
+        self.en_vista_busqueda = False
+        self.token_sesion: Optional[str] = None
+        self.marcas_arranque: Optional[List[Tuple[str, float]]] = None
+        if not _arranque_medido.is_set():
+            self.marcas_arranque = [
+                ("importaciones", FIN_IMPORTACIONES),
+                ("flet listo", time.perf_counter()),
+            ]
         
         self.pagina.title = "Chatbot Multi-Usuario"
         self.pagina.theme_mode = ft.ThemeMode.DARK
@@ -24,11 +61,63 @@ class AplicacionChat:
         
         try:
             bd.inicializar_base_datos()
-            auth.crear_usuario_predeterminado()
+            auth.crear_usuario_predeterminado_async()
+            metricas.iniciar_exportacion()
         except Exception as e:
             print(f"Error al inicializar base de datos: {e}")
+        self.marcar_arranque("base de datos")
         
-        self.mostrar_pantalla_login()
+        if self.reanudar_sesion_guardada():
+            self.terminar_arranque("pantalla chat")
+        else:
+            self.mostrar_pantalla_login()
+            self.terminar_arranque("pantalla login")
+            # El cliente de Groq se importa mientras el usuario escribe.
+            precargar_groq()
+    
+    def marcar_arranque(self, etapa: str):
+        if self.marcas_arranque is not None:
+            self.marcas_arranque.append((etapa, time.perf_counter()))
+    
+    def terminar_arranque(self, pantalla: str):
+        # Se llama al pintar la primera pantalla; los tiempos se cuentan desde
+        # que empieza a ejecutarse main.py.
+        if self.marcas_arranque is None:
+            return
+        self.marcar_arranque(pantalla)
+        marcas, self.marcas_arranque = self.marcas_arranque, None
+        _arranque_medido.set()
+        total = marcas[-1][1] - INICIO_ARRANQUE
+        metricas.observar(f"arranque_{pantalla.replace(' ', '_')}", total)
+        if INFORME_ARRANQUE:
+            anterior = INICIO_ARRANQUE
+            print("Tiempos de arranque:")
+            for etapa, instante in marcas:
+                print(f"  {etapa:22} +{(instante - anterior) * 1000:8.1f} ms  {(instante - INICIO_ARRANQUE) * 1000:8.1f} ms")
+                anterior = instante
+    
+    def reanudar_sesion_guardada(self) -> bool:
+        # Un token válido en el almacenamiento del cliente abre el chat sin
+        # pedir la contraseña ni pasar por bcrypt.
+        try:
+            token = self.pagina.client_storage.get(CLAVE_TOKEN_SESION)
+            usuario = auth.reanudar_sesion(token)
+        except Exception as e:
+            print(f"No se pudo reanudar la sesión: {e}")
+            return False
+        if not usuario:
+            return False
+        self.usuario_actual = usuario
+        self.token_sesion = token
+        self.mostrar_pantalla_chat()
+        return True
+    
+    def guardar_token_sesion(self, id_usuario: int):
+        try:
+            self.token_sesion = auth.crear_sesion(id_usuario)
+            self.pagina.client_storage.set(CLAVE_TOKEN_SESION, self.token_sesion)
+        except Exception as e:
+            print(f"No se pudo guardar la sesión: {e}")
     
     def mostrar_pantalla_login(self):
         self.pagina.controls.clear()
@@ -60,6 +149,18 @@ class AplicacionChat:
         
         self.mensaje_login = ft.Text("", size=14)
         
+        self.boton_login = ft.ElevatedButton(
+            "Iniciar Sesión",
+            width=320,
+            height=50,
+            on_click=lambda _: self.iniciar_sesion(),
+            style=ft.ButtonStyle(
+                shape=ft.RoundedRectangleBorder(radius=12),
+                bgcolor="#6C63FF",
+                color="white",
+            ),
+        )
+        
         contenedor_login = ft.Container(
             content=ft.Column(
                 [
@@ -87,17 +188,7 @@ class AplicacionChat:
                     self.mensaje_login,
                     ft.Container(height=20),
                     ft.Container(
-                        content=ft.ElevatedButton(
-                            "Iniciar Sesión",
-                            width=320,
-                            height=50,
-                            on_click=lambda _: self.iniciar_sesion(),
-                            style=ft.ButtonStyle(
-                                shape=ft.RoundedRectangleBorder(radius=12),
-                                bgcolor="#6C63FF",
-                                color="white",
-                            ),
-                        ),
+                        content=self.boton_login,
                         shadow=ft.BoxShadow(
                             spread_radius=1,
                             blur_radius=15,
@@ -181,6 +272,18 @@ class AplicacionChat:
         
         self.mensaje_registro = ft.Text("", size=14)
         
+        self.boton_registro = ft.ElevatedButton(
+            "Registrarse",
+            width=320,
+            height=50,
+            on_click=lambda _: self.registrar(),
+            style=ft.ButtonStyle(
+                shape=ft.RoundedRectangleBorder(radius=12),
+                bgcolor="#FF6584",
+                color="white",
+            ),
+        )
+        
         contenedor_registro = ft.Container(
             content=ft.Column(
                 [
@@ -202,17 +305,7 @@ class AplicacionChat:
                     self.mensaje_registro,
                     ft.Container(height=20),
                     ft.Container(
-                        content=ft.ElevatedButton(
-                            "Registrarse",
-                            width=320,
-                            height=50,
-                            on_click=lambda _: self.registrar(),
-                            style=ft.ButtonStyle(
-                                shape=ft.RoundedRectangleBorder(radius=12),
-                                bgcolor="#FF6584",
-                                color="white",
-                            ),
-                        ),
+                        content=self.boton_registro,
                         shadow=ft.BoxShadow(
                             spread_radius=1,
                             blur_radius=15,
@@ -246,10 +339,30 @@ class AplicacionChat:
         nombre_usuario = self.campo_usuario.value
         contrasena = self.campo_contrasena.value
         
-        exito, mensaje, usuario = auth.iniciar_sesion(nombre_usuario, contrasena)
+        if self.boton_login.disabled:
+            return
+        
+        # bcrypt corre en el pool de auth; la respuesta se procesa en un hilo
+        # de Flet para no ocupar a los trabajadores de bcrypt.
+        self.boton_login.disabled = True
+        self.mensaje_login.value = "Verificando..."
+        self.mensaje_login.color = "#8b8b8b"
+        self.pagina.update()
+        
+        futuro = auth.iniciar_sesion_async(nombre_usuario, contrasena)
+        futuro.add_done_callback(lambda f: self.pagina.run_thread(self.al_verificar_login, f))
+    
+    def al_verificar_login(self, futuro):
+        try:
+            exito, mensaje, usuario = futuro.result()
+        except Exception as e:
+            exito, mensaje, usuario = False, f"Error al iniciar sesión: {e}", None
+        
+        self.boton_login.disabled = False
         
         if exito:
             self.usuario_actual = usuario
+            self.guardar_token_sesion(usuario['id'])
             self.mensaje_login.value = ""
             self.mostrar_pantalla_chat()
         else:
@@ -262,20 +375,34 @@ class AplicacionChat:
         contrasena = self.campo_reg_contrasena.value
         contrasena_confirmar = self.campo_reg_confirmar.value
         
+        if self.boton_registro.disabled:
+            return
+        
         if contrasena != contrasena_confirmar:
             self.mensaje_registro.value = "Las contraseñas no coinciden"
             self.mensaje_registro.color = "#FF6584"
             self.pagina.update()
             return
         
-        exito, mensaje, id_usuario = auth.registrar_usuario(nombre_usuario, contrasena)
+        self.boton_registro.disabled = True
+        self.pagina.update()
+        
+        futuro = auth.registrar_usuario_async(nombre_usuario, contrasena)
+        futuro.add_done_callback(lambda f: self.pagina.run_thread(self.al_registrar, f))
+    
+    def al_registrar(self, futuro):
+        try:
+            exito, mensaje, id_usuario = futuro.result()
+        except Exception as e:
+            exito, mensaje, id_usuario = False, f"Error al registrar: {e}", None
+        
+        self.boton_registro.disabled = False
         
         if exito:
             self.mensaje_registro.value = f"{mensaje}. Redirigiendo al login..."
             self.mensaje_registro.color = "#00FF88"
             self.pagina.update()
             
-            import time
             time.sleep(1.5)
             self.mostrar_pantalla_login()
         else:
@@ -302,12 +429,15 @@ class AplicacionChat:
             self.pagina.update()
             self.cerrar_sesion()
             return
+        if clientes_groq.CALENTAR_AL_ENTRAR:
+            self.chatbot.calentar_conexion()
         
         self.lista_chat = ft.ListView(
             expand=True,
             spacing=15,
             padding=20,
-            auto_scroll=True,
+            on_scroll=self.al_desplazar_chat,
+            on_scroll_interval=100,
         )
         
         self.cargar_historial_chat()
@@ -335,6 +465,13 @@ class AplicacionChat:
         
         self.texto_estado = ft.Text("", size=12, italic=True, color="#8b8b8b")
         
+        self.boton_recientes = ft.TextButton(
+            "⬇ Volver a los mensajes recientes",
+            visible=False,
+            on_click=lambda _: self.volver_a_recientes(),
+            style=ft.ButtonStyle(color="#6C63FF"),
+        )
+        
         barra_superior = ft.Container(
             content=ft.Row(
                 [
@@ -351,6 +488,12 @@ class AplicacionChat:
                         color="white",
                     ),
                     ft.Container(expand=True),
+                    ft.IconButton(
+                        icon=ft.Icons.SEARCH_ROUNDED,
+                        tooltip="Buscar en la conversación",
+                        icon_color="#6C63FF",
+                        on_click=lambda _: self.mostrar_busqueda(),
+                    ),
                     ft.IconButton(
                         icon=ft.Icons.PEOPLE_OUTLINE,
                         tooltip="Gestionar Usuarios",
@@ -389,6 +532,7 @@ class AplicacionChat:
         area_entrada = ft.Container(
             content=ft.Column(
                 [
+                    self.boton_recientes,
                     self.texto_estado,
                     ft.Row(
                         [
@@ -430,46 +574,110 @@ class AplicacionChat:
         
         self.pagina.add(disposicion_principal)
         self.pagina.update()
+        # El historial se cargó antes de que la lista estuviera en la página,
+        # así que no se pudo desplazar. Sin animación, para no pasar por la
+        # zona de UMBRAL_SCROLL_HISTORIAL y cargar otra página de golpe.
+        self.desplazar_al_final(duracion=0)
     
-    def mostrar_gestion_usuarios(self):
-        usuarios = bd.obtener_todos_usuarios()
+    def crear_tarjeta_usuario(self, usuario: dict, al_eliminar) -> ft.Container:
+        fecha = usuario['created_at'].split(' ')[0] if ' ' in usuario['created_at'] else usuario['created_at']
+        actividad = usuario['last_activity'].split(' ')[0] if usuario['last_activity'] else "sin mensajes"
         
-        lista_usuarios = ft.Column(
-            spacing=10,
-            scroll=ft.ScrollMode.AUTO,
+        return ft.Container(
+            content=ft.Row(
+                [
+                    ft.Icon(ft.Icons.PERSON, color="#6C63FF"),
+                    ft.Column(
+                        [
+                            ft.Text(usuario['username'], weight=ft.FontWeight.BOLD, size=16),
+                            ft.Text(f"ID: {usuario['id']} | Creado: {fecha}", size=12, color="#8b8b8b"),
+                            ft.Text(
+                                f"{usuario['message_count']} mensajes | Última actividad: {actividad}",
+                                size=12,
+                                color="#8b8b8b",
+                            ),
+                        ],
+                        spacing=2,
+                    ),
+                    ft.Container(expand=True),
+                    ft.IconButton(
+                        icon=ft.Icons.DELETE_OUTLINE,
+                        icon_color="#FF6584",
+                        tooltip="Eliminar usuario",
+                        on_click=lambda e, uid=usuario['id'], uname=usuario['username']: self.confirmar_eliminar_usuario(
+                            uid, uname, al_eliminar
+                        ),
+                    ),
+                ],
+                alignment=ft.MainAxisAlignment.START,
+            ),
+            padding=15,
+            bgcolor="#1a1a2e",
+            border_radius=12,
+            border=ft.border.all(1, "#6C63FF"),
+            key=f"u{usuario['id']}",
         )
+    
+    def mostrar_gestion_usuarios(self):
+        # Solo se consulta y se pinta una página de usuarios cada vez; la
+        # lista crece con "Más usuarios" y al eliminar se quita la tarjeta
+        # afectada sin reconstruir el diálogo.
+        campo_filtro = ft.TextField(
+            hint_text="Buscar por nombre de usuario...",
+            autofocus=True,
+            border_radius=12,
+            filled=True,
+            bgcolor="#1a1a2e",
+            border_color="#6C63FF",
+            prefix_icon=ft.Icons.SEARCH,
+            on_change=lambda _: filtrar(),
+        )
+        texto_total = ft.Text("", size=12, color="#8b8b8b")
+        lista_usuarios = ft.ListView(spacing=10, expand=True)
+        boton_mas = ft.TextButton(
+            "Más usuarios",
+            visible=False,
+            on_click=lambda _: cargar_pagina(),
+            style=ft.ButtonStyle(color="#6C63FF"),
+        )
+        estado = {'prefijo': "", 'ultimo': None, 'total': 0}
         
-        for usuario in usuarios:
-            fecha = usuario['created_at'].split(' ')[0] if ' ' in usuario['created_at'] else usuario['created_at']
-            
-            tarjeta_usuario = ft.Container(
-                content=ft.Row(
-                    [
-                        ft.Icon(ft.Icons.PERSON, color="#6C63FF"),
-                        ft.Column(
-                            [
-                                ft.Text(usuario['username'], weight=ft.FontWeight.BOLD, size=16),
-                                ft.Text(f"ID: {usuario['id']} | Creado: {fecha}", size=12, color="#8b8b8b"),
-                            ],
-                            spacing=2,
-                        ),
-                        ft.Container(expand=True),
-                        ft.IconButton(
-                            icon=ft.Icons.DELETE_OUTLINE,
-                            icon_color="#FF6584",
-                            tooltip="Eliminar usuario",
-                            on_click=lambda e, uid=usuario['id'], uname=usuario['username']: self.confirmar_eliminar_usuario(uid, uname),
-                        ),
-                    ],
-                    alignment=ft.MainAxisAlignment.START,
-                ),
-                padding=15,
-                bgcolor="#1a1a2e",
-                border_radius=12,
-                border=ft.border.all(1, "#6C63FF"),
+        def actualizar_total():
+            mostrados = len(lista_usuarios.controls)
+            texto_total.value = (
+                f"{estado['total']} usuarios" if mostrados >= estado['total']
+                else f"Mostrando {mostrados} de {estado['total']} usuarios"
             )
-            
-            lista_usuarios.controls.append(tarjeta_usuario)
+        
+        def cargar_pagina():
+            usuarios = bd.listar_usuarios(
+                estado['prefijo'], despues_de=estado['ultimo'], tamano=TAMANO_PAGINA_USUARIOS
+            )
+            for usuario in usuarios:
+                lista_usuarios.controls.append(self.crear_tarjeta_usuario(usuario, al_eliminar))
+            if usuarios:
+                estado['ultimo'] = (usuarios[-1]['username'], usuarios[-1]['id'])
+            boton_mas.visible = len(usuarios) == TAMANO_PAGINA_USUARIOS
+            actualizar_total()
+            self.pagina.update()
+        
+        def filtrar():
+            prefijo = (campo_filtro.value or "").strip()
+            if prefijo == estado['prefijo'] and lista_usuarios.controls:
+                return
+            estado['prefijo'] = prefijo
+            estado['ultimo'] = None
+            estado['total'] = bd.contar_usuarios(prefijo)
+            lista_usuarios.controls.clear()
+            cargar_pagina()
+        
+        def al_eliminar(id_usuario: int):
+            clave = f"u{id_usuario}"
+            lista_usuarios.controls = [c for c in lista_usuarios.controls if c.key != clave]
+            estado['total'] = max(0, estado['total'] - 1)
+            actualizar_total()
+            lista_usuarios.update()
+            texto_total.update()
         
         def cerrar_dialogo(e):
             self.pagina.close(dialogo)
@@ -483,9 +691,12 @@ class AplicacionChat:
                 ],
             ),
             content=ft.Container(
-                content=lista_usuarios,
+                content=ft.Column(
+                    [campo_filtro, texto_total, lista_usuarios, boton_mas],
+                    spacing=10,
+                ),
                 width=500,
-                height=400,
+                height=450,
             ),
             actions=[
                 ft.TextButton(
@@ -497,11 +708,163 @@ class AplicacionChat:
             actions_alignment=ft.MainAxisAlignment.END,
         )
         
+        self.pagina.overlay.append(dialogo)
+        dialogo.open = True
+        filtrar()
+    
+    def mostrar_busqueda(self):
+        campo_busqueda = ft.TextField(
+            hint_text="Buscar en tu historial...",
+            autofocus=True,
+            border_radius=12,
+            filled=True,
+            bgcolor="#1a1a2e",
+            border_color="#6C63FF",
+            prefix_icon=ft.Icons.SEARCH,
+            on_submit=lambda _: buscar(),
+        )
+        lista_resultados = ft.ListView(spacing=6, expand=True)
+        texto_sin_resultados = ft.Text("", size=13, color="#8b8b8b", italic=True)
+        boton_mas = ft.TextButton(
+            "Más resultados",
+            visible=False,
+            on_click=lambda _: buscar(pagina_siguiente=True),
+            style=ft.ButtonStyle(color="#6C63FF"),
+        )
+        estado = {'pagina': 0, 'texto': ""}
+        
+        def ir_a_mensaje(id_mensaje: int):
+            self.pagina.close(dialogo)
+            self.saltar_a_mensaje(id_mensaje)
+        
+        def buscar(pagina_siguiente: bool = False):
+            if pagina_siguiente:
+                estado['pagina'] += 1
+            else:
+                estado['pagina'] = 0
+                estado['texto'] = campo_busqueda.value or ""
+                lista_resultados.controls.clear()
+            
+            resultados = bd.buscar_conversaciones(
+                estado['texto'],
+                self.usuario_actual['id'],
+                pagina=estado['pagina'],
+                tamano=TAMANO_PAGINA_BUSQUEDA,
+                marcas=MARCAS_BUSQUEDA,
+            )
+            
+            for resultado in resultados:
+                lista_resultados.controls.append(
+                    ft.ListTile(
+                        leading=ft.Icon(
+                            ft.Icons.PERSON if resultado['role'] == 'user' else ft.Icons.SMART_TOY,
+                            color="#6C63FF" if resultado['role'] == 'user' else "#00FF88",
+                        ),
+                        title=self.crear_texto_fragmento(resultado['snippet']),
+                        subtitle=ft.Text(resultado['timestamp'], size=11, color="#8b8b8b"),
+                        on_click=lambda e, mid=resultado['id']: ir_a_mensaje(mid),
+                    )
+                )
+            
+            boton_mas.visible = len(resultados) == TAMANO_PAGINA_BUSQUEDA
+            texto_sin_resultados.value = (
+                "Sin resultados" if not lista_resultados.controls and estado['texto'].strip() else ""
+            )
+            self.pagina.update()
+        
+        dialogo = ft.AlertDialog(
+            modal=True,
+            title=ft.Row(
+                [
+                    ft.Icon(ft.Icons.SEARCH, color="#6C63FF"),
+                    ft.Text("Buscar mensajes", weight=ft.FontWeight.BOLD),
+                ],
+            ),
+            content=ft.Container(
+                content=ft.Column(
+                    [campo_busqueda, texto_sin_resultados, lista_resultados, boton_mas],
+                    spacing=10,
+                ),
+                width=500,
+                height=450,
+            ),
+            actions=[
+                ft.TextButton(
+                    "Cerrar",
+                    on_click=lambda _: self.pagina.close(dialogo),
+                    style=ft.ButtonStyle(color="#6C63FF"),
+                ),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        
         self.pagina.overlay.append(dialogo)
         dialogo.open = True
         self.pagina.update()
     
-    def confirmar_eliminar_usuario(self, id_usuario: int, nombre_usuario: str):
+    def crear_texto_fragmento(self, fragmento: str) -> ft.Text:
+        inicio, fin = MARCAS_BUSQUEDA
+        partes = []
+        for i, trozo in enumerate(fragmento.replace(fin, inicio).split(inicio)):
+            if not trozo:
+                continue
+            if i % 2:
+                partes.append(ft.TextSpan(
+                    trozo, ft.TextStyle(weight=ft.FontWeight.BOLD, color="#FFAB73")
+                ))
+            else:
+                partes.append(ft.TextSpan(trozo))
+        return ft.Text(spans=partes, size=13, max_lines=3)
+    
+    def saltar_a_mensaje(self, id_mensaje: int):
+        # Solo se cargan los mensajes alrededor del resultado; el resto del
+        # historial sigue disponible con el scroll hacia arriba o volviendo a
+        # los mensajes recientes.
+        mitad = TAMANO_PAGINA_HISTORIAL // 2
+        mensajes = bd.obtener_mensajes_alrededor(
+            self.usuario_actual['id'], id_mensaje, antes=mitad, despues=mitad
+        )
+        if not mensajes:
+            return
+        
+        self.vaciar_lista_chat()
+        self.id_mensaje_mas_antiguo = mensajes[0]['id']
+        self.hay_mas_historial = True
+        self.en_vista_busqueda = True
+        self.boton_recientes.visible = True
+        
+        self.agregar_mensajes_a_interfaz(mensajes, desplazar=False)
+        clave = f"m{id_mensaje}"
+        for control in self.lista_chat.controls:
+            if control.key == clave:
+                control.border = ft.border.all(2, "#FFAB73")
+                break
+        self.pagina.update()
+        self.lista_chat.scroll_to(key=clave, duration=300)
+    
+    def volver_a_recientes(self):
+        self.en_vista_busqueda = False
+        self.boton_recientes.visible = False
+        self.vaciar_lista_chat()
+        self.cargar_historial_chat()
+        self.pagina.update()
+        self.desplazar_al_final()
+    
+    def vaciar_lista_chat(self):
+        # Las burbujas de las respuestas en curso dejan de estar en la página;
+        # con la sesión nueva esas respuestas se terminan de guardar pero ya
+        # no se pintan ni cuentan como pendientes.
+        with self.bloqueo_envios:
+            self.sesion_chat += 1
+            self.mensajes_pendientes = 0
+        self.lista_chat.controls.clear()
+        self.texto_estado.value = ""
+        self.boton_enviar.disabled = False
+    
+    def respuesta_visible(self, texto_respuesta: ft.Text, sesion: Optional[int]) -> bool:
+        return (sesion is None or sesion == self.sesion_chat) and texto_respuesta.page is not None
+    
+    def confirmar_eliminar_usuario(self, id_usuario: int, nombre_usuario: str, al_eliminar=None):
         def eliminar_usuario_confirmado(e):
             if bd.eliminar_usuario(id_usuario):
                 self.pagina.close(dialogo_confirmacion)
@@ -512,11 +875,8 @@ class AplicacionChat:
                 self.pagina.snack_bar.open = True
                 self.pagina.update()
                 
-                for overlay in self.pagina.overlay:
-                    if isinstance(overlay, ft.AlertDialog) and overlay.open:
-                        self.pagina.close(overlay)
-                
-                self.mostrar_gestion_usuarios()
+                if al_eliminar:
+                    al_eliminar(id_usuario)
             else:
                 self.pagina.close(dialogo_confirmacion)
                 self.pagina.snack_bar = ft.SnackBar(
@@ -552,100 +912,224 @@ class AplicacionChat:
         if not self.usuario_actual:
             return
         
-        conversaciones = bd.obtener_conversaciones_usuario(self.usuario_actual['id'])
+        pagina = bd.obtener_pagina_conversaciones(
+            self.usuario_actual['id'], tamano=TAMANO_PAGINA_HISTORIAL
+        )
+        self.hay_mas_historial = len(pagina) == TAMANO_PAGINA_HISTORIAL
+        self.id_mensaje_mas_antiguo = pagina[-1]['id'] if pagina else None
+        
+        self.agregar_mensajes_a_interfaz(reversed(pagina))
+    
+    def cargar_historial_anterior(self):
+        if not self.usuario_actual or not self.hay_mas_historial:
+            return
+        if not self.bloqueo_historial.acquire(blocking=False):
+            return
         
-        for mensaje in conversaciones:
-            self.agregar_mensaje_a_interfaz(mensaje['role'], mensaje['content'], guardar=False)
+        try:
+            pagina = bd.obtener_pagina_conversaciones(
+                self.usuario_actual['id'],
+                antes_de_id=self.id_mensaje_mas_antiguo,
+                tamano=TAMANO_PAGINA_HISTORIAL,
+            )
+            self.hay_mas_historial = len(pagina) == TAMANO_PAGINA_HISTORIAL
+            if not pagina:
+                return
+            
+            clave_ancla = f"m{self.id_mensaje_mas_antiguo}"
+            self.id_mensaje_mas_antiguo = pagina[-1]['id']
+            
+            self.lista_chat.controls[0:0] = self.crear_controles_mensajes(reversed(pagina))
+            self.lista_chat.update()
+            self.lista_chat.scroll_to(key=clave_ancla, duration=0)
+        finally:
+            self.bloqueo_historial.release()
+    
+    def al_desplazar_chat(self, e: ft.OnScrollEvent):
+        if not self.hay_mas_historial or e.pixels is None or e.min_scroll_extent is None:
+            return
+        if e.pixels - e.min_scroll_extent <= UMBRAL_SCROLL_HISTORIAL:
+            self.cargar_historial_anterior()
+    
+    def desplazar_al_final(self, duracion: int = 150):
+        if self.lista_chat.page:
+            self.lista_chat.scroll_to(offset=-1, duration=duracion)
     
-    def agregar_mensaje_a_interfaz(self, rol: str, contenido: str, guardar: bool = True):
+    def crear_controles_mensajes(self, mensajes) -> List[ft.Container]:
+        return [
+            self.crear_control_mensaje(m['role'], m['content'], clave=f"m{m['id']}")[0]
+            for m in mensajes
+        ]
+    
+    def agregar_mensajes_a_interfaz(self, mensajes, desplazar: bool = True):
+        # Camino en bloque: se construyen todos los controles, se añaden en
+        # una sola operación y se envía un único update al cliente.
+        self.lista_chat.controls.extend(self.crear_controles_mensajes(mensajes))
+        if self.lista_chat.page:
+            self.lista_chat.update()
+            if desplazar:
+                self.desplazar_al_final()
+    
+    def agregar_mensaje_a_interfaz(self, rol: str, contenido: str, guardar: bool = True,
+                                   clave: Optional[str] = None) -> ft.Text:
+        contenedor_mensaje, texto_mensaje = self.crear_control_mensaje(rol, contenido, clave)
+        self.lista_chat.controls.append(contenedor_mensaje)
+        self.pagina.update()
+        self.desplazar_al_final()
+        return texto_mensaje
+    
+    def crear_control_mensaje(self, rol: str, contenido: str,
+                              clave: Optional[str] = None) -> Tuple[ft.Container, ft.Text]:
+        # Plantilla ligera: un Container con fondo plano y dos Text, sin
+        # gradientes ni sombras, para que el historial largo cueste poco en
+        # el cliente.
         es_usuario = rol == 'user'
+        texto_mensaje = ft.Text(contenido, selectable=True, color="white", size=14)
         
         contenedor_mensaje = ft.Container(
             content=ft.Column(
                 [
-                    ft.Row(
-                        [
-                            ft.Container(
-                                content=ft.Icon(
-                                    ft.Icons.PERSON if es_usuario else ft.Icons.SMART_TOY,
-                                    size=20,
-                                    color="white",
-                                ),
-                                bgcolor="#6C63FF" if es_usuario else "#00FF88",
-                                border_radius=50,
-                                padding=6,
-                            ),
-                            ft.Text(
-                                "Tú" if es_usuario else "Asistente IA",
-                                weight=ft.FontWeight.BOLD,
-                                size=15,
-                                color="white",
-                            ),
-                        ],
-                        spacing=8,
-                    ),
-                    ft.Container(
-                        content=ft.Text(contenido, selectable=True, color="white", size=14),
-                        padding=15,
-                        gradient=ft.LinearGradient(
-                            begin=ft.alignment.top_left,
-                            end=ft.alignment.bottom_right,
-                            colors=["#6C63FF", "#5a54d6"] if es_usuario else ["#00C9A7", "#00B894"],
-                        ) if es_usuario else None,
-                        bgcolor=None if es_usuario else "#1a1a2e",
-                        border_radius=15,
-                        shadow=ft.BoxShadow(
-                            spread_radius=0,
-                            blur_radius=8,
-                            color=ft.Colors.with_opacity(0.2, "#6C63FF" if es_usuario else "#00FF88"),
-                            offset=ft.Offset(0, 2),
-                        ),
+                    ft.Text(
+                        "Tú" if es_usuario else "Asistente IA",
+                        weight=ft.FontWeight.BOLD,
+                        size=13,
+                        color="white" if es_usuario else "#00FF88",
                     ),
+                    texto_mensaje,
                 ],
-                spacing=8,
+                spacing=4,
+                tight=True,
             ),
-            padding=ft.padding.only(left=20 if es_usuario else 0, right=0 if es_usuario else 20),
+            padding=12,
+            bgcolor="#6C63FF" if es_usuario else "#1a1a2e",
+            border_radius=15,
+            margin=ft.margin.only(left=20 if es_usuario else 0, right=0 if es_usuario else 20),
+            key=clave,
         )
         
-        self.lista_chat.controls.append(contenedor_mensaje)
-        self.pagina.update()
+        return contenedor_mensaje, texto_mensaje
     
     def enviar_mensaje(self):
         mensaje = self.campo_mensaje.value.strip()
         
-        if not mensaje:
+        if not mensaje or self.boton_enviar.disabled:
             return
         
+        admision = obtener_control_admision()
+        if not admision.reservar_turno():
+            # El texto se queda en el campo para reenviarlo después.
+            metricas.contar('turnos_rechazados')
+            self.texto_estado.value = "⏳ Hay demasiadas peticiones en curso, inténtalo en unos segundos"
+            self.pagina.update()
+            return
+        
+        if self.en_vista_busqueda:
+            self.volver_a_recientes()
+        
         self.campo_mensaje.value = ""
         self.campo_mensaje.focus()
         
-        self.boton_enviar.disabled = True
-        self.texto_estado.value = "📤 Enviando mensaje..."
-        self.pagina.update()
-        
         self.agregar_mensaje_a_interfaz('user', mensaje, guardar=False)
+        texto_respuesta = self.agregar_mensaje_a_interfaz('assistant', "…", guardar=False)
         
-        self.texto_estado.value = "🤖 El asistente está escribiendo..."
+        sesion = self.sesion_chat
+        chatbot = self.chatbot
+        id_usuario = self.usuario_actual['id']
+        inicio = time.perf_counter() if metricas.METRICAS_ACTIVAS else None
+        
+        def procesar():
+            if inicio is not None:
+                metricas.observar('ui_cola', time.perf_counter() - inicio)
+            try:
+                self.mostrar_respuesta_stream(
+                    texto_respuesta,
+                    chatbot.enviar_mensaje_stream(id_usuario, mensaje),
+                    sesion,
+                    inicio,
+                )
+            except Exception as e:
+                texto_respuesta.value = f"Error: {str(e)}"
+                if self.respuesta_visible(texto_respuesta, sesion):
+                    texto_respuesta.update()
+            finally:
+                admision.liberar_turno()
+                if inicio is not None:
+                    metricas.observar('ui_turno', time.perf_counter() - inicio)
+                with self.bloqueo_envios:
+                    vigente = sesion == self.sesion_chat
+                    if vigente:
+                        self.mensajes_pendientes -= 1
+                if vigente:
+                    self.actualizar_estado_envio()
+        
+        with self.bloqueo_envios:
+            self.mensajes_pendientes += 1
+        obtener_cola_envios().encolar(id_usuario, procesar)
+        self.actualizar_estado_envio()
+    
+    def actualizar_estado_envio(self):
+        pendientes = self.mensajes_pendientes
+        if pendientes <= 0:
+            self.texto_estado.value = ""
+        else:
+            en_cola = pendientes - 1
+            self.texto_estado.value = "🤖 El asistente está escribiendo..." + (
+                f" ({en_cola} en cola)" if en_cola else ""
+            )
+        self.boton_enviar.disabled = pendientes >= MAX_MENSAJES_EN_COLA
         self.pagina.update()
+    
+    def mostrar_respuesta_stream(self, texto_respuesta: ft.Text, fragmentos, sesion: Optional[int] = None,
+                                 inicio: Optional[float] = None):
+        # Las actualizaciones se agrupan a FPS_STREAMING por segundo; el primer
+        # fragmento se pinta de inmediato. Si la sesión cambió, el flujo se
+        # consume igualmente para que la respuesta quede guardada. 'inicio' es
+        # el instante del envío, para medir el tiempo hasta el primer pintado.
+        intervalo = 1.0 / FPS_STREAMING
+        partes = []
+        ultimo_pintado = 0.0
+        pendiente = False
+        
+        def visible():
+            return self.respuesta_visible(texto_respuesta, sesion)
         
+        fragmentos = iter(fragmentos)
         try:
-            respuesta = self.chatbot.enviar_mensaje(self.usuario_actual['id'], mensaje)
-            self.agregar_mensaje_a_interfaz('assistant', respuesta, guardar=False)
-            self.texto_estado.value = ""
-        except Exception as e:
-            mensaje_error = f"Error: {str(e)}"
-            self.agregar_mensaje_a_interfaz('assistant', mensaje_error, guardar=False)
-            self.texto_estado.value = ""
+            for fragmento in fragmentos:
+                partes.append(fragmento)
+                pendiente = True
+                ahora = time.monotonic()
+                if ahora - ultimo_pintado >= intervalo and visible():
+                    texto_respuesta.value = "".join(partes)
+                    with metricas.tramo('ui_pintado'):
+                        texto_respuesta.update()
+                    if inicio is not None and not ultimo_pintado:
+                        metricas.observar('ui_primer_pintado', time.perf_counter() - inicio)
+                    ultimo_pintado = ahora
+                    pendiente = False
+        finally:
+            # Si falla un pintado, el resto del flujo se lee igualmente:
+            # enviar_mensaje_stream guarda la respuesta al agotarse.
+            for _ in fragmentos:
+                pass
         
-        self.boton_enviar.disabled = False
-        self.pagina.update()
+        if pendiente and visible():
+            texto_respuesta.value = "".join(partes)
+            with metricas.tramo('ui_pintado'):
+                texto_respuesta.update()
+        if visible():
+            self.desplazar_al_final()
     
     def limpiar_conversacion(self):
         def confirmar_limpiar(e):
             if e.control.text == "Sí":
                 if self.chatbot:
                     self.chatbot.limpiar_historial(self.usuario_actual['id'])
-                self.lista_chat.controls.clear()
+                self.vaciar_lista_chat()
+                self.id_mensaje_mas_antiguo = None
+                self.hay_mas_historial = False
+                self.en_vista_busqueda = False
+                self.boton_recientes.visible = False
                 self.pagina.update()
             self.pagina.close(dialogo)
         
@@ -665,12 +1149,74 @@ class AplicacionChat:
         self.pagina.update()
     
     def cerrar_sesion(self):
+        bd.esperar_escrituras()
+        try:
+            auth.cerrar_sesion(self.token_sesion)
+            self.pagina.client_storage.remove(CLAVE_TOKEN_SESION)
+        except Exception as e:
+            print(f"Error al cerrar la sesión guardada: {e}")
+        self.token_sesion = None
+        self.sesion_chat += 1
+        self.mensajes_pendientes = 0
+        self.id_mensaje_mas_antiguo = None
+        self.hay_mas_historial = False
+        self.en_vista_busqueda = False
         self.usuario_actual = None
         self.chatbot = None
         self.mostrar_pantalla_login()
 
+def mostrar_servidor_completo(pagina: ft.Page):
+    pagina.title = "Chatbot IA"
+    pagina.bgcolor = "#0f0c29"
+    pagina.add(
+        ft.Container(
+            content=ft.Text(
+                "El servidor ha alcanzado el máximo de sesiones. Inténtalo de nuevo en unos minutos.",
+                color="white",
+                size=16,
+                text_align=ft.TextAlign.CENTER,
+            ),
+            alignment=ft.alignment.center,
+            expand=True,
+        )
+    )
+
 def main(pagina: ft.Page):
-    AplicacionChat(pagina)
+    # Flet llama a main una vez por sesión (cada pestaña en modo web) y cada
+    # AplicacionChat guarda solo el estado de su página.
+    admision = obtener_control_admision()
+    if not admision.entrar_sesion():
+        metricas.contar('sesiones_rechazadas')
+        mostrar_servidor_completo(pagina)
+        return
+    
+    aplicacion = AplicacionChat(pagina)
+    liberada = threading.Event()
+    
+    def al_cerrar(_):
+        if liberada.is_set():
+            return
+        liberada.set()
+        # Las respuestas en curso se terminan de guardar pero ya no se pintan.
+        with aplicacion.bloqueo_envios:
+            aplicacion.sesion_chat += 1
+        admision.salir_sesion()
+    
+    pagina.on_close = al_cerrar
 
 if __name__ == "__main__":
-    ft.app(target=main)
+    parser = argparse.ArgumentParser(description="Chatbot IA con Flet")
+    parser.add_argument("--web", action="store_true",
+                        help="servidor web multisesión sin abrir ventana ni navegador")
+    parser.add_argument("--host", default=os.getenv('WEB_HOST', "127.0.0.1"))
+    parser.add_argument("--puerto", type=int, default=int(os.getenv('WEB_PUERTO', '8550')))
+    args = parser.parse_args()
+    try:
+        if args.web:
+            ft.app(target=main, view=None, host=args.host, port=args.puerto)
+        else:
+            ft.app(target=main)
+    finally:
+        metricas.detener_exportacion()
+        clientes_groq.cerrar_clientes()
+        bd.cerrar_conexiones()
@@ -0,0 +1,252 @@
+import os
+import time
+import atexit
+import bisect
+import threading
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
+
+METRICAS_ACTIVAS = os.getenv('METRICAS', '0') == '1'
+INTERVALO_EXPORTACION = float(os.getenv('METRICAS_INTERVALO', '60'))
+RETENCION_METRICAS_HORAS = float(os.getenv('METRICAS_RETENCION_HORAS', '168'))
+ARCHIVO_METRICAS = os.getenv('METRICAS_ARCHIVO') or None
+PUERTO_METRICAS = int(os.getenv('METRICAS_PUERTO', '0'))
+
+# Límites superiores de los cubos, en segundos.
+CUBOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIJO = "chatbot"
+
+class Histograma:
+    # Acumulados desde el arranque (para Prometheus) y del intervalo en curso
+    # (para la tabla de SQLite).
+    __slots__ = ('cubos', 'cuenta', 'suma', 'cubos_intervalo', 'cuenta_intervalo', 'suma_intervalo')
+    
+    def __init__(self):
+        self.cubos = [0] * (len(CUBOS) + 1)
+        self.cuenta = 0
+        self.suma = 0.0
+        self.cubos_intervalo = [0] * (len(CUBOS) + 1)
+        self.cuenta_intervalo = 0
+        self.suma_intervalo = 0.0
+    
+    def observar(self, segundos: float):
+        indice = bisect.bisect_left(CUBOS, segundos)
+        self.cubos[indice] += 1
+        self.cuenta += 1
+        self.suma += segundos
+        self.cubos_intervalo[indice] += 1
+        self.cuenta_intervalo += 1
+        self.suma_intervalo += segundos
+    
+    def cerrar_intervalo(self) -> Tuple[List[int], int, float]:
+        resultado = (self.cubos_intervalo, self.cuenta_intervalo, self.suma_intervalo)
+        self.cubos_intervalo = [0] * (len(CUBOS) + 1)
+        self.cuenta_intervalo = 0
+        self.suma_intervalo = 0.0
+        return resultado
+
+def cuantil(cubos: List[int], cuenta: int, q: float) -> Optional[float]:
+    # Interpolación lineal dentro del cubo, como histogram_quantile().
+    if not cuenta:
+        return None
+    objetivo = q * cuenta
+    acumulado = 0
+    for indice, valor in enumerate(cubos):
+        if acumulado + valor >= objetivo and valor:
+            if indice == len(CUBOS):
+                return CUBOS[-1]
+            inferior = CUBOS[indice - 1] if indice else 0.0
+            return inferior + (CUBOS[indice] - inferior) * (objetivo - acumulado) / valor
+        acumulado += valor
+    return CUBOS[-1]
+
+class RegistroMetricas:
+    
+    def __init__(self):
+        self._bloqueo = threading.Lock()
+        self._histogramas: Dict[str, Histograma] = {}
+        self._contadores: Dict[str, float] = {}
+        self._contadores_exportados: Dict[str, float] = {}
+    
+    def observar(self, etapa: str, segundos: float):
+        with self._bloqueo:
+            histograma = self._histogramas.get(etapa)
+            if histograma is None:
+                histograma = self._histogramas[etapa] = Histograma()
+            histograma.observar(segundos)
+    
+    def contar(self, nombre: str, valor: float = 1):
+        with self._bloqueo:
+            self._contadores[nombre] = self._contadores.get(nombre, 0) + valor
+    
+    def texto_prometheus(self) -> str:
+        with self._bloqueo:
+            histogramas = {
+                etapa: (list(h.cubos), h.cuenta, h.suma) for etapa, h in self._histogramas.items()
+            }
+            contadores = dict(self._contadores)
+        
+        lineas = [
+            f"# HELP {PREFIJO}_etapa_segundos Duración de cada etapa de un turno de chat.",
+            f"# TYPE {PREFIJO}_etapa_segundos histogram",
+        ]
+        for etapa, (cubos, cuenta, suma) in sorted(histogramas.items()):
+            acumulado = 0
+            for limite, valor in zip(CUBOS, cubos):
+                acumulado += valor
+                lineas.append(f'{PREFIJO}_etapa_segundos_bucket{{etapa="{etapa}",le="{limite:g}"}} {acumulado}')
+            lineas.append(f'{PREFIJO}_etapa_segundos_bucket{{etapa="{etapa}",le="+Inf"}} {cuenta}')
+            lineas.append(f'{PREFIJO}_etapa_segundos_sum{{etapa="{etapa}"}} {suma:.6f}')
+            lineas.append(f'{PREFIJO}_etapa_segundos_count{{etapa="{etapa}"}} {cuenta}')
+        for nombre, valor in sorted(contadores.items()):
+            lineas.append(f"# TYPE {PREFIJO}_{nombre}_total counter")
+            lineas.append(f"{PREFIJO}_{nombre}_total {valor:g}")
+        return "\n".join(lineas) + "\n"
+    
+    def cerrar_intervalo(self) -> List[Tuple[str, str, int, float, Optional[float], Optional[float], Optional[float]]]:
+        # Filas (tipo, nombre, cuenta, suma, p50, p95, p99) con lo ocurrido
+        # desde la llamada anterior.
+        filas = []
+        with self._bloqueo:
+            for etapa, histograma in self._histogramas.items():
+                cubos, cuenta, suma = histograma.cerrar_intervalo()
+                if cuenta:
+                    filas.append(('etapa', etapa, cuenta, suma,
+                                  cuantil(cubos, cuenta, 0.5), cuantil(cubos, cuenta, 0.95), cuantil(cubos, cuenta, 0.99)))
+            for nombre, valor in self._contadores.items():
+                delta = valor - self._contadores_exportados.get(nombre, 0)
+                if delta:
+                    filas.append(('contador', nombre, 1, delta, None, None, None))
+                self._contadores_exportados[nombre] = valor
+        return filas
+
+class _Tramo:
+    __slots__ = ('etapa', 'inicio')
+    
+    def __init__(self, etapa: str):
+        self.etapa = etapa
+    
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+    
+    def __exit__(self, *_):
+        registro.observar(self.etapa, time.perf_counter() - self.inicio)
+        return False
+
+_TRAMO_NULO = nullcontext()
+
+registro: Optional[RegistroMetricas] = RegistroMetricas() if METRICAS_ACTIVAS else None
+
+# Con las métricas desactivadas las funciones públicas son no-ops sin
+# reloj ni bloqueos; los puntos de medida manuales comprueban
+# METRICAS_ACTIVAS antes de llamar a time.perf_counter().
+if METRICAS_ACTIVAS:
+    def tramo(etapa: str):
+        return _Tramo(etapa)
+    
+    def observar(etapa: str, segundos: float):
+        registro.observar(etapa, segundos)
+    
+    def contar(nombre: str, valor: float = 1):
+        registro.contar(nombre, valor)
+else:
+    def tramo(etapa: str):
+        return _TRAMO_NULO
+    
+    def observar(etapa: str, segundos: float):
+        pass
+    
+    def contar(nombre: str, valor: float = 1):
+        pass
+
+def registrar_uso(uso):
+    # Campos de uso que devuelve Groq (objeto del SDK o diccionario).
+    if uso is None:
+        return
+    if isinstance(uso, dict):
+        prompt, completion = uso.get('prompt_tokens'), uso.get('completion_tokens')
+    else:
+        prompt, completion = getattr(uso, 'prompt_tokens', None), getattr(uso, 'completion_tokens', None)
+    if prompt:
+        contar('tokens_prompt', prompt)
+    if completion:
+        contar('tokens_completion', completion)
+
+_exportador: Optional[threading.Thread] = None
+_detener_exportacion = threading.Event()
+_bloqueo_exportacion = threading.Lock()
+
+def exportar():
+    # Escribe el archivo de texto de Prometheus y añade el intervalo a la
+    # tabla 'metrics', descartando las filas más antiguas que la retención.
+    if registro is None:
+        return
+    import database as bd
+    
+    if ARCHIVO_METRICAS:
+        temporal = ARCHIVO_METRICAS + ".tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.write(registro.texto_prometheus())
+        os.replace(temporal, ARCHIVO_METRICAS)
+    
+    filas = registro.cerrar_intervalo()
+    ahora = time.time()
+    bd.guardar_metricas(ahora, filas, ahora - RETENCION_METRICAS_HORAS * 3600)
+
+def _bucle_exportacion():
+    while not _detener_exportacion.wait(INTERVALO_EXPORTACION):
+        try:
+            exportar()
+        except Exception as e:
+            print(f"Error al exportar métricas: {e}")
+
+def _servir_prometheus(puerto: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+            datos = registro.texto_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+        
+        def log_message(self, formato, *args):
+            pass
+    
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas-http", daemon=True).start()
+    print(f"Métricas en http://127.0.0.1:{servidor.server_address[1]}/metrics")
+
+def iniciar_exportacion():
+    global _exportador
+    if registro is None:
+        return
+    with _bloqueo_exportacion:
+        if _exportador is not None:
+            return
+        _exportador = threading.Thread(target=_bucle_exportacion, name="metricas", daemon=True)
+        _exportador.start()
+    if PUERTO_METRICAS:
+        _servir_prometheus(PUERTO_METRICAS)
+    atexit.register(detener_exportacion)
+
+def detener_exportacion():
+    global _exportador
+    with _bloqueo_exportacion:
+        if _exportador is None:
+            return
+        _detener_exportacion.set()
+        _exportador.join(timeout=5)
+        _exportador = None
+    try:
+        exportar()
+    except Exception as e:
+        print(f"Error al exportar métricas: {e}")
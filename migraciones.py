@@ -0,0 +1,459 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from archivo_historial import descomprimir_mensajes
+
+RUTA_ESQUEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database_schema.sql')
+
+CARACTERES_POR_TOKEN = 4
+
+def _ejecutar_script(conexion: sqlite3.Connection, script: str):
+    # executescript() confirma la transacción en curso, así que las
+    # sentencias se ejecutan una a una dentro de la de la migración.
+    sentencia = ""
+    for linea in script.splitlines(keepends=True):
+        sentencia += linea
+        if sqlite3.complete_statement(sentencia):
+            conexion.execute(sentencia)
+            sentencia = ""
+    if sentencia.strip() and sqlite3.complete_statement(sentencia + ";"):
+        conexion.execute(sentencia)
+
+def _columnas(conexion: sqlite3.Connection, tabla: str) -> set:
+    return {fila[1] for fila in conexion.execute(f"PRAGMA table_info({tabla})")}
+
+def _m001_esquema_base(conexion: sqlite3.Connection):
+    with open(RUTA_ESQUEMA, 'r', encoding='utf-8') as f:
+        _ejecutar_script(conexion, f.read())
+
+def _m002_tokens_por_mensaje(conexion: sqlite3.Connection):
+    if 'token_count' not in _columnas(conexion, 'conversations'):
+        conexion.execute("ALTER TABLE conversations ADD COLUMN token_count INTEGER")
+    conexion.execute(
+        "UPDATE conversations SET token_count = (length(content) + ? - 1) / ? "
+        "WHERE token_count IS NULL",
+        (CARACTERES_POR_TOKEN, CARACTERES_POR_TOKEN)
+    )
+
+def _m003_resumenes(conexion: sqlite3.Connection):
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            token_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+    """)
+
+def _m004_indices_por_usuario(conexion: sqlite3.Connection):
+    # (user_id, timestamp) sirve 'WHERE user_id = ? ORDER BY timestamp' sin
+    # ordenar en un B-tree temporal. El índice global por timestamp no lo usa
+    # ninguna consulta y solo encarece cada INSERT.
+    _ejecutar_script(conexion, """
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_timestamp
+            ON conversations(user_id, timestamp);
+        DROP INDEX IF EXISTS idx_conversations_timestamp;
+    """)
+
+def _m005_integridad_referencial(conexion: sqlite3.Connection):
+    # Con foreign_keys activado, los mensajes huérfanos que dejaron versiones
+    # anteriores harían fallar foreign_key_check; se eliminan una sola vez.
+    _ejecutar_script(conexion, """
+        DELETE FROM conversations WHERE user_id NOT IN (SELECT id FROM users);
+        DELETE FROM conversation_summaries WHERE user_id NOT IN (SELECT id FROM users);
+    """)
+
+def _m006_cache_respuestas(conexion: sqlite3.Connection):
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+            ON response_cache(last_used_at);
+    """)
+
+INDICES_CONVERSACIONES = {
+    'idx_conversations_user_id':
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)",
+}
+
+TRIGGER_FTS_INSERCION = """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, content, owner)
+            VALUES (new.id, new.content, 'u' || new.user_id);
+        END;
+"""
+
+TRIGGER_FTS_BORRADO = """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, content, owner)
+            VALUES ('delete', old.id, old.content, 'u' || old.user_id);
+        END;
+"""
+
+def _m007_busqueda_texto_completo(conexion: sqlite3.Connection):
+    # Tabla FTS5 de contenido externo sobre una vista que añade el dueño como
+    # columna indexada ('u<id>'), para filtrar por usuario dentro del propio
+    # índice en lugar de después de recorrer todas las coincidencias.
+    _ejecutar_script(conexion, """
+        CREATE VIEW IF NOT EXISTS conversations_fts_source AS
+            SELECT id, content, 'u' || user_id AS owner FROM conversations;
+        
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            content,
+            owner,
+            content='conversations_fts_source',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+    
+    """ + TRIGGER_FTS_INSERCION + TRIGGER_FTS_BORRADO + """
+        INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild');
+    """)
+
+def _m008_metricas(conexion: sqlite3.Connection):
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recorded_at REAL NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total REAL NOT NULL,
+            p50 REAL,
+            p95 REAL,
+            p99 REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_metrics_recorded_at ON metrics(recorded_at);
+    """)
+
+def _m009_sesiones(conexion: sqlite3.Connection):
+    # Solo se guarda el SHA-256 del token; el token en claro queda en el
+    # cliente.
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id);
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at);
+    """)
+
+def archivo_creado(conexion: sqlite3.Connection) -> bool:
+    return conexion.execute(
+        "SELECT 1 FROM archivo.sqlite_master WHERE type = 'table' AND name = 'archived_segments'"
+    ).fetchone() is not None
+
+def crear_esquema_archivo(conexion: sqlite3.Connection):
+    # El archivo es una base de datos adjunta como 'archivo' (ver
+    # database._abrir_conexion). Se crea también fuera de las migraciones si
+    # el fichero de archivo se ha borrado o movido.
+    if archivo_creado(conexion):
+        return
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS archivo.archived_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            token_count INTEGER NOT NULL,
+            first_timestamp TEXT,
+            last_timestamp TEXT,
+            codec TEXT NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archivo.idx_archived_segments_user_last
+            ON archived_segments(user_id, last_id);
+    """)
+
+def _m010_archivo(conexion: sqlite3.Connection):
+    crear_esquema_archivo(conexion)
+
+def _m011_indice_nombres_usuario(conexion: sqlite3.Connection):
+    # El índice único de username es binario; la búsqueda por prefijo de la
+    # gestión de usuarios no distingue mayúsculas.
+    conexion.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)"
+    )
+
+# Suma una fila de estadísticas a la existente: recuentos y tokens se
+# acumulan y el primer y último mensaje se quedan con el extremo.
+_SUMAR_ESTADISTICAS = """
+        ON CONFLICT(user_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            user_message_count = user_message_count + excluded.user_message_count,
+            assistant_message_count = assistant_message_count + excluded.assistant_message_count,
+            token_count = token_count + excluded.token_count,
+            first_message_id = CASE WHEN first_message_id IS NULL OR excluded.first_message_id < first_message_id
+                                    THEN excluded.first_message_id ELSE first_message_id END,
+            first_timestamp = CASE WHEN first_message_id IS NULL OR excluded.first_message_id < first_message_id
+                                   THEN excluded.first_timestamp ELSE first_timestamp END,
+            last_message_id = CASE WHEN last_message_id IS NULL OR excluded.last_message_id > last_message_id
+                                   THEN excluded.last_message_id ELSE last_message_id END,
+            last_timestamp = CASE WHEN last_message_id IS NULL OR excluded.last_message_id > last_message_id
+                                  THEN excluded.last_timestamp ELSE last_timestamp END
+"""
+
+TRIGGERS_ESTADISTICAS = {
+    'conversations_stats_ai': """
+        CREATE TRIGGER IF NOT EXISTS conversations_stats_ai AFTER INSERT ON conversations BEGIN
+            INSERT INTO user_stats (user_id, message_count, user_message_count, assistant_message_count,
+                                    token_count, first_message_id, first_timestamp,
+                                    last_message_id, last_timestamp)
+            VALUES (new.user_id, 1, new.role = 'user', new.role = 'assistant',
+                    COALESCE(new.token_count, 0), new.id, new.timestamp, new.id, new.timestamp)
+    """ + _SUMAR_ESTADISTICAS + """;
+        END;
+    """,
+    # Al borrar el primer o el último mensaje se busca el siguiente sobre
+    # idx_conversations_user_id, que es (user_id, id).
+    'conversations_stats_ad': """
+        CREATE TRIGGER IF NOT EXISTS conversations_stats_ad AFTER DELETE ON conversations BEGIN
+            UPDATE user_stats SET
+                message_count = message_count - 1,
+                user_message_count = user_message_count - (old.role = 'user'),
+                assistant_message_count = assistant_message_count - (old.role = 'assistant'),
+                token_count = token_count - COALESCE(old.token_count, 0),
+                first_message_id = CASE WHEN first_message_id = old.id
+                    THEN (SELECT MIN(id) FROM conversations WHERE user_id = old.user_id)
+                    ELSE first_message_id END,
+                first_timestamp = CASE WHEN first_message_id = old.id
+                    THEN (SELECT timestamp FROM conversations WHERE user_id = old.user_id ORDER BY id LIMIT 1)
+                    ELSE first_timestamp END,
+                last_message_id = CASE WHEN last_message_id = old.id
+                    THEN (SELECT MAX(id) FROM conversations WHERE user_id = old.user_id)
+                    ELSE last_message_id END,
+                last_timestamp = CASE WHEN last_message_id = old.id
+                    THEN (SELECT timestamp FROM conversations WHERE user_id = old.user_id ORDER BY id DESC LIMIT 1)
+                    ELSE last_timestamp END
+            WHERE user_id = old.user_id;
+        END;
+    """,
+}
+
+def sumar_estadisticas_mensajes(conexion: sqlite3.Connection, desde_id: int = 0, hasta_id: int = 2 ** 63 - 1):
+    # Acumula en user_stats los mensajes de la tabla caliente con id en el
+    # rango, para cargas hechas sin los triggers.
+    conexion.execute("""
+        INSERT INTO user_stats (user_id, message_count, user_message_count, assistant_message_count,
+                                token_count, first_message_id, first_timestamp,
+                                last_message_id, last_timestamp)
+        SELECT a.user_id, a.total, a.de_usuario, a.de_asistente, a.tokens,
+               a.primero, p.timestamp, a.ultimo, u.timestamp
+        FROM (
+            SELECT user_id, COUNT(*) AS total, SUM(role = 'user') AS de_usuario,
+                   SUM(role = 'assistant') AS de_asistente,
+                   COALESCE(SUM(token_count), 0) AS tokens,
+                   MIN(id) AS primero, MAX(id) AS ultimo
+            FROM conversations
+            WHERE id BETWEEN ? AND ?
+            GROUP BY user_id
+        ) a
+        JOIN conversations p ON p.id = a.primero
+        JOIN conversations u ON u.id = a.ultimo
+        WHERE true
+    """ + _SUMAR_ESTADISTICAS, (desde_id, hasta_id))
+
+def _sumar_estadisticas_archivo(conexion: sqlite3.Connection):
+    # Los recuentos por rol del archivo exigen abrir cada segmento; solo se
+    # hace al recalcular desde cero.
+    por_usuario: Dict[int, list] = {}
+    for fila in conexion.execute(
+        """
+        SELECT user_id, first_id, last_id, message_count, token_count,
+               first_timestamp, last_timestamp, codec, data
+        FROM archivo.archived_segments
+        ORDER BY user_id, first_id
+        """
+    ):
+        mensajes = descomprimir_mensajes(fila[7], fila[8])
+        de_usuario = sum(1 for m in mensajes if m['role'] == 'user')
+        de_asistente = sum(1 for m in mensajes if m['role'] == 'assistant')
+        actual = por_usuario.get(fila[0])
+        if actual is None:
+            por_usuario[fila[0]] = [fila[0], fila[3], de_usuario, de_asistente, fila[4],
+                                    fila[1], fila[5], fila[2], fila[6]]
+        else:
+            actual[1] += fila[3]
+            actual[2] += de_usuario
+            actual[3] += de_asistente
+            actual[4] += fila[4]
+            actual[7], actual[8] = fila[2], fila[6]
+    conexion.executemany("""
+        INSERT INTO user_stats (user_id, message_count, user_message_count, assistant_message_count,
+                                token_count, first_message_id, first_timestamp,
+                                last_message_id, last_timestamp)
+        SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+        WHERE EXISTS (SELECT 1 FROM users WHERE id = ?1)
+    """ + _SUMAR_ESTADISTICAS, list(por_usuario.values()))
+
+def recalcular_estadisticas_usuarios(conexion: sqlite3.Connection):
+    conexion.execute("DELETE FROM user_stats")
+    sumar_estadisticas_mensajes(conexion)
+    if archivo_creado(conexion):
+        _sumar_estadisticas_archivo(conexion)
+
+def _m012_estadisticas_usuario(conexion: sqlite3.Connection):
+    # Recuentos, tokens y extremos del historial de cada usuario (incluido el
+    # archivo), mantenidos por triggers para leerlos sin recorrer mensajes.
+    _ejecutar_script(conexion, """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            user_message_count INTEGER NOT NULL DEFAULT 0,
+            assistant_message_count INTEGER NOT NULL DEFAULT 0,
+            token_count INTEGER NOT NULL DEFAULT 0,
+            first_message_id INTEGER,
+            first_timestamp TIMESTAMP,
+            last_message_id INTEGER,
+            last_timestamp TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+    """)
+    for sql in TRIGGERS_ESTADISTICAS.values():
+        _ejecutar_script(conexion, sql)
+    recalcular_estadisticas_usuarios(conexion)
+
+def _m013_sin_indice_usuario_fecha(conexion: sqlite3.Connection):
+    # Las lecturas por usuario paginan y recorren por (user_id, id), que ya
+    # cubre idx_conversations_user_id (el rowid va implícito en el índice).
+    # Ninguna consulta usa (user_id, timestamp) y solo encarece cada INSERT.
+    conexion.execute("DROP INDEX IF EXISTS idx_conversations_user_timestamp")
+
+@contextmanager
+def sin_borrado_fts(conexion: sqlite3.Connection):
+    # Para archivar: los mensajes salen de conversations pero siguen en el
+    # índice de texto completo. Se usa dentro de la transacción del
+    # archivado, así que el resto de conexiones nunca ven el trigger quitado.
+    conexion.execute("DROP TRIGGER IF EXISTS conversations_fts_ad")
+    try:
+        yield
+    finally:
+        _ejecutar_script(conexion, TRIGGER_FTS_BORRADO)
+
+def indexar_archivo_fts(conexion: sqlite3.Connection):
+    # Añade al índice de texto completo los mensajes archivados; un
+    # 'rebuild' solo ve la tabla caliente a través de la vista.
+    if not archivo_creado(conexion):
+        return
+    for fila in conexion.execute(
+        "SELECT user_id, codec, data FROM archivo.archived_segments ORDER BY id"
+    ).fetchall():
+        conexion.executemany(
+            "INSERT INTO conversations_fts(rowid, content, owner) VALUES (?, ?, ?)",
+            [(m['id'], m['content'], f"u{fila[0]}") for m in descomprimir_mensajes(fila[1], fila[2])]
+        )
+
+def _m014_archivo_en_busqueda(conexion: sqlite3.Connection):
+    # Hasta ahora el archivado borraba del índice los mensajes que movía.
+    indexar_archivo_fts(conexion)
+
+def _existe(conexion: sqlite3.Connection, tipo: str, nombre: str) -> bool:
+    return conexion.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?", (tipo, nombre)
+    ).fetchone() is not None
+
+def suspender_indices_conversaciones(conexion: sqlite3.Connection):
+    # Para cargas masivas: sin índices secundarios ni trigger de FTS cada
+    # INSERT solo toca la tabla. restaurar_indices_conversaciones los
+    # vuelve a crear.
+    conexion.execute("DROP TRIGGER IF EXISTS conversations_fts_ai")
+    for nombre in TRIGGERS_ESTADISTICAS:
+        conexion.execute(f"DROP TRIGGER IF EXISTS {nombre}")
+    for nombre in INDICES_CONVERSACIONES:
+        conexion.execute(f"DROP INDEX IF EXISTS {nombre}")
+
+def indices_conversaciones_completos(conexion: sqlite3.Connection) -> bool:
+    return _existe(conexion, 'trigger', 'conversations_fts_ai') and all(
+        _existe(conexion, 'index', nombre) for nombre in INDICES_CONVERSACIONES
+    ) and all(
+        _existe(conexion, 'trigger', nombre) for nombre in TRIGGERS_ESTADISTICAS
+    )
+
+def restaurar_indices_conversaciones(conexion: sqlite3.Connection, reconstruir_fts: bool = True,
+                                     recalcular_estadisticas: bool = True):
+    # Si falta el trigger, los mensajes insertados mientras tanto no están en
+    # el índice de texto completo; con reconstruir_fts se rehace entero. Lo
+    # mismo con user_stats y recalcular_estadisticas.
+    for sql in INDICES_CONVERSACIONES.values():
+        conexion.execute(sql)
+    if not all(_existe(conexion, 'trigger', nombre) for nombre in TRIGGERS_ESTADISTICAS):
+        for sql in TRIGGERS_ESTADISTICAS.values():
+            _ejecutar_script(conexion, sql)
+        if recalcular_estadisticas:
+            recalcular_estadisticas_usuarios(conexion)
+    if not _existe(conexion, 'trigger', 'conversations_fts_ai'):
+        _ejecutar_script(conexion, TRIGGER_FTS_INSERCION)
+        if reconstruir_fts:
+            conexion.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+            indexar_archivo_fts(conexion)
+
+MIGRACIONES: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "esquema base", _m001_esquema_base),
+    (2, "tokens estimados por mensaje", _m002_tokens_por_mensaje),
+    (3, "resúmenes de conversación", _m003_resumenes),
+    (4, "índice compuesto por usuario y fecha", _m004_indices_por_usuario),
+    (5, "limpieza de filas huérfanas", _m005_integridad_referencial),
+    (6, "caché de respuestas", _m006_cache_respuestas),
+    (7, "búsqueda de texto completo", _m007_busqueda_texto_completo),
+    (8, "métricas de latencia", _m008_metricas),
+    (9, "sesiones persistentes", _m009_sesiones),
+    (10, "archivo de mensajes antiguos", _m010_archivo),
+    (11, "índice de nombres de usuario sin mayúsculas", _m011_indice_nombres_usuario),
+    (12, "estadísticas por usuario", _m012_estadisticas_usuario),
+    (13, "sin índice por usuario y fecha", _m013_sin_indice_usuario_fecha),
+    (14, "mensajes archivados en la búsqueda", _m014_archivo_en_busqueda),
+]
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+def obtener_version(conexion: sqlite3.Connection) -> int:
+    return conexion.execute("PRAGMA user_version").fetchone()[0]
+
+def esta_al_dia(conexion: sqlite3.Connection) -> bool:
+    return obtener_version(conexion) >= VERSION_ESQUEMA
+
+def aplicar_migraciones(conexion: sqlite3.Connection) -> List[int]:
+    aplicadas = []
+    if conexion.in_transaction:
+        conexion.commit()
+    if esta_al_dia(conexion):
+        return aplicadas
+    
+    for numero, descripcion, migracion in MIGRACIONES:
+        if numero <= obtener_version(conexion):
+            continue
+        
+        # BEGIN IMMEDIATE toma el bloqueo de escritura antes de volver a leer
+        # la versión, así que dos procesos no aplican la misma migración.
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            if numero <= obtener_version(conexion):
+                conexion.rollback()
+                continue
+            migracion(conexion)
+            conexion.execute(f"PRAGMA user_version = {int(numero)}")
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+        
+        print(f"Migración {numero} aplicada: {descripcion}")
+        aplicadas.append(numero)
+    
+    return aplicadas
@@ -0,0 +1,329 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+RUTAS_COMPLETIONS = ("/openai/v1/chat/completions", "/v1/chat/completions")
+
+PALABRAS = (
+    "claro aquí tienes una respuesta simulada para pruebas de carga del chatbot "
+    "con texto suficiente para medir latencia throughput y tiempo hasta el primer token"
+).split()
+
+class ConfiguracionSimulador:
+    
+    def __init__(self, latencia_ms: float = 300.0, distribucion: str = "lognormal",
+                 sigma: float = 0.5, tokens_por_segundo: float = 500.0,
+                 tokens_respuesta: int = 120, tasa_error: float = 0.0,
+                 tasa_429: float = 0.0, retry_after: float = 1.0,
+                 limite_peticiones_minuto: int = 0, limite_tokens_minuto: int = 0,
+                 semilla: Optional[int] = None, latencias_modelo: Optional[Dict[str, float]] = None):
+        self.latencia_ms = latencia_ms
+        self.latencias_modelo = latencias_modelo or {}
+        self.distribucion = distribucion
+        self.sigma = sigma
+        self.tokens_por_segundo = tokens_por_segundo
+        self.tokens_respuesta = tokens_respuesta
+        self.tasa_error = tasa_error
+        self.tasa_429 = tasa_429
+        self.retry_after = retry_after
+        self.limite_peticiones_minuto = limite_peticiones_minuto
+        self.limite_tokens_minuto = limite_tokens_minuto
+        self.rng = random.Random(semilla)
+        self.bloqueo = threading.Lock()
+        self.peticiones = 0
+        self.errores_inyectados = 0
+        self.limitadas_inyectadas = 0
+        self.limitadas_por_cuota = 0
+        # (instante, tokens) de las peticiones admitidas en el último minuto.
+        self._ventana: deque = deque()
+    
+    def _purgar_ventana(self, ahora: float):
+        while self._ventana and self._ventana[0][0] <= ahora - 60.0:
+            self._ventana.popleft()
+    
+    def admitir(self, tokens: int) -> Optional[float]:
+        # Aplica la cuota por minuto (ventana deslizante) si hay alguna
+        # configurada. Devuelve los segundos que faltan si no cabe; 0 en un
+        # límite lo desactiva.
+        if not (self.limite_peticiones_minuto or self.limite_tokens_minuto):
+            return None
+        ahora = time.monotonic()
+        with self.bloqueo:
+            self._purgar_ventana(ahora)
+            usados = sum(t for _, t in self._ventana)
+            sobra_peticiones = (self.limite_peticiones_minuto
+                                and len(self._ventana) >= self.limite_peticiones_minuto)
+            sobra_tokens = (self.limite_tokens_minuto and self._ventana
+                            and usados + tokens > self.limite_tokens_minuto)
+            if sobra_peticiones or sobra_tokens:
+                self.limitadas_por_cuota += 1
+                return max(0.05, self._ventana[0][0] + 60.0 - ahora)
+            self._ventana.append((ahora, tokens))
+        return None
+    
+    def restantes(self) -> Dict[str, str]:
+        # Cabeceras x-ratelimit-* con lo que queda de la ventana actual.
+        if not (self.limite_peticiones_minuto or self.limite_tokens_minuto):
+            return {}
+        ahora = time.monotonic()
+        with self.bloqueo:
+            self._purgar_ventana(ahora)
+            usados = sum(t for _, t in self._ventana)
+            reinicio = self._ventana[0][0] + 60.0 - ahora if self._ventana else 0.0
+            peticiones = len(self._ventana)
+        cabeceras = {}
+        if self.limite_peticiones_minuto:
+            cabeceras['x-ratelimit-limit-requests'] = str(self.limite_peticiones_minuto)
+            cabeceras['x-ratelimit-remaining-requests'] = str(max(0, self.limite_peticiones_minuto - peticiones))
+            cabeceras['x-ratelimit-reset-requests'] = f"{reinicio:.2f}s"
+        if self.limite_tokens_minuto:
+            cabeceras['x-ratelimit-limit-tokens'] = str(self.limite_tokens_minuto)
+            cabeceras['x-ratelimit-remaining-tokens'] = str(max(0, self.limite_tokens_minuto - usados))
+            cabeceras['x-ratelimit-reset-tokens'] = f"{reinicio:.2f}s"
+        return cabeceras
+    
+    def latencia(self, modelo: Optional[str] = None) -> float:
+        # Tiempo hasta el primer token, en segundos.
+        media = self.latencias_modelo.get(modelo, self.latencia_ms)
+        with self.bloqueo:
+            if self.distribucion == "fija":
+                valor = media
+            elif self.distribucion == "uniforme":
+                valor = self.rng.uniform(0, 2 * media)
+            elif self.distribucion == "exponencial":
+                valor = self.rng.expovariate(1.0 / media) if media else 0.0
+            else:
+                valor = media * self.rng.lognormvariate(0, self.sigma)
+        return max(0.0, valor) / 1000.0
+    
+    def sortear_fallo(self) -> Optional[int]:
+        with self.bloqueo:
+            self.peticiones += 1
+            sorteo = self.rng.random()
+            if sorteo < self.tasa_429:
+                self.limitadas_inyectadas += 1
+                return 429
+            if sorteo < self.tasa_429 + self.tasa_error:
+                self.errores_inyectados += 1
+                return 500
+        return None
+    
+    def texto_respuesta(self) -> List[str]:
+        with self.bloqueo:
+            return [self.rng.choice(PALABRAS) for _ in range(self.tokens_respuesta)]
+
+def _estimar_tokens(mensajes: List[Dict]) -> int:
+    return sum((len(m.get('content') or "") + 3) // 4 for m in mensajes)
+
+class ManejadorSimulado(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    configuracion: ConfiguracionSimulador = None
+    
+    def log_message(self, formato, *args):
+        pass
+    
+    def _cabeceras_limite(self) -> Dict[str, str]:
+        return self.configuracion.restantes()
+    
+    def _responder_json(self, estado: int, cuerpo: Dict, cabeceras: Optional[Dict[str, str]] = None):
+        datos = json.dumps(cuerpo).encode('utf-8')
+        self.send_response(estado)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(datos)))
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(datos)
+    
+    def do_GET(self):
+        if self.path.rstrip('/') in ("/openai/v1/models", "/v1/models"):
+            self._responder_json(200, {'object': 'list', 'data': [{'id': 'simulado', 'object': 'model'}]})
+        else:
+            self._responder_json(404, {'error': {'message': 'no encontrado'}})
+    
+    def do_POST(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        cuerpo = self.rfile.read(longitud) if longitud else b"{}"
+        
+        if self.path.split('?')[0] not in RUTAS_COMPLETIONS:
+            self._responder_json(404, {'error': {'message': 'no encontrado'}})
+            return
+        
+        try:
+            peticion = json.loads(cuerpo)
+        except ValueError:
+            self._responder_json(400, {'error': {'message': 'JSON inválido'}})
+            return
+        
+        cfg = self.configuracion
+        tokens_prompt = _estimar_tokens(peticion.get('messages', []))
+        fallo = cfg.sortear_fallo()
+        if fallo == 429:
+            cabeceras = self._cabeceras_limite()
+            cabeceras['retry-after'] = f"{cfg.retry_after:g}"
+            self._responder_json(429, {'error': {
+                'message': 'Rate limit reached (simulado)', 'type': 'tokens', 'code': 'rate_limit_exceeded'
+            }}, cabeceras)
+            return
+        if fallo == 500:
+            time.sleep(cfg.latencia(peticion.get('model')))
+            self._responder_json(500, {'error': {'message': 'Error interno simulado', 'type': 'internal_server_error'}})
+            return
+        
+        modelo = peticion.get('model', 'simulado')
+        max_tokens = int(peticion.get('max_tokens') or cfg.tokens_respuesta)
+        palabras = cfg.texto_respuesta()[:max_tokens]
+        espera = cfg.admitir(tokens_prompt + len(palabras))
+        if espera is not None:
+            cabeceras = self._cabeceras_limite()
+            cabeceras['retry-after'] = f"{espera:.2f}"
+            self._responder_json(429, {'error': {
+                'message': 'Rate limit reached (cuota simulada)', 'type': 'tokens', 'code': 'rate_limit_exceeded'
+            }}, cabeceras)
+            return
+        identificador = f"chatcmpl-sim-{int(time.time() * 1000)}-{threading.get_ident()}"
+        creado = int(time.time())
+        uso = {
+            'prompt_tokens': tokens_prompt,
+            'completion_tokens': len(palabras),
+            'total_tokens': tokens_prompt + len(palabras),
+        }
+        
+        time.sleep(cfg.latencia(modelo))
+        
+        if peticion.get('stream'):
+            self._responder_stream(identificador, creado, modelo, palabras, uso)
+            return
+        
+        pausa = len(palabras) / cfg.tokens_por_segundo if cfg.tokens_por_segundo else 0
+        time.sleep(pausa)
+        self._responder_json(200, {
+            'id': identificador,
+            'object': 'chat.completion',
+            'created': creado,
+            'model': modelo,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': " ".join(palabras)},
+                'finish_reason': 'stop',
+            }],
+            'usage': uso,
+        }, self._cabeceras_limite())
+    
+    def _responder_stream(self, identificador: str, creado: int, modelo: str,
+                          palabras: List[str], uso: Dict):
+        cfg = self.configuracion
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        for nombre, valor in self._cabeceras_limite().items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.close_connection = True
+        
+        pausa = 1.0 / cfg.tokens_por_segundo if cfg.tokens_por_segundo else 0
+        
+        def enviar(datos: Dict):
+            self.wfile.write(b"data: " + json.dumps(datos).encode('utf-8') + b"\n\n")
+            self.wfile.flush()
+        
+        base = {'id': identificador, 'object': 'chat.completion.chunk', 'created': creado, 'model': modelo}
+        try:
+            enviar(dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ""}, 'finish_reason': None}]))
+            for i, palabra in enumerate(palabras):
+                texto = palabra if i == 0 else " " + palabra
+                enviar(dict(base, choices=[{'index': 0, 'delta': {'content': texto}, 'finish_reason': None}]))
+                if pausa:
+                    time.sleep(pausa)
+            enviar(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+                        x_groq={'id': identificador, 'usage': uso}))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class ServidorSimulado(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def handle_error(self, peticion, direccion):
+        # Los clientes cierran conexiones keep-alive sin avisar; no es un error.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(peticion, direccion)
+
+def crear_servidor(configuracion: ConfiguracionSimulador, host: str = "127.0.0.1",
+                   puerto: int = 0) -> ServidorSimulado:
+    manejador = type("Manejador", (ManejadorSimulado,), {'configuracion': configuracion})
+    return ServidorSimulado((host, puerto), manejador)
+
+def iniciar_en_segundo_plano(configuracion: ConfiguracionSimulador, host: str = "127.0.0.1",
+                             puerto: int = 0) -> ServidorSimulado:
+    servidor = crear_servidor(configuracion, host, puerto)
+    threading.Thread(target=servidor.serve_forever, name="servidor-simulado", daemon=True).start()
+    return servidor
+
+def url_base(servidor: ServidorSimulado) -> str:
+    host, puerto = servidor.server_address[:2]
+    return f"http://{host}:{puerto}"
+
+def argumentos_configuracion(parser: argparse.ArgumentParser):
+    parser.add_argument("--latencia-ms", type=float, default=300.0, help="latencia media hasta el primer token")
+    parser.add_argument("--distribucion", choices=["fija", "uniforme", "exponencial", "lognormal"], default="lognormal")
+    parser.add_argument("--sigma", type=float, default=0.5, help="dispersión de la distribución log-normal")
+    parser.add_argument("--tokens-por-segundo", type=float, default=500.0)
+    parser.add_argument("--tokens-respuesta", type=int, default=120)
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="fracción de respuestas 500")
+    parser.add_argument("--tasa-429", type=float, default=0.0, help="fracción de respuestas 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="segundos anunciados en retry-after")
+    parser.add_argument("--limite-rpm", type=int, default=None,
+                        help="peticiones por minuto que admite el servidor (por defecto sin límite)")
+    parser.add_argument("--limite-tpm", type=int, default=None,
+                        help="tokens por minuto que admite el servidor (por defecto sin límite)")
+    parser.add_argument("--latencia-modelo", action="append", default=[], metavar="MODELO=MS",
+                        help="latencia media propia de un modelo (repetible)")
+    parser.add_argument("--semilla", type=int, default=None)
+
+def configuracion_desde_argumentos(args: argparse.Namespace) -> ConfiguracionSimulador:
+    return ConfiguracionSimulador(
+        latencia_ms=args.latencia_ms,
+        distribucion=args.distribucion,
+        sigma=args.sigma,
+        tokens_por_segundo=args.tokens_por_segundo,
+        tokens_respuesta=args.tokens_respuesta,
+        tasa_error=args.tasa_error,
+        tasa_429=args.tasa_429,
+        retry_after=args.retry_after,
+        limite_peticiones_minuto=args.limite_rpm or 0,
+        limite_tokens_minuto=args.limite_tpm or 0,
+        semilla=args.semilla,
+        latencias_modelo={
+            modelo: float(ms) for modelo, _, ms in (v.partition('=') for v in args.latencia_modelo)
+        },
+    )
+
+def main(argumentos: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Servidor local compatible con la API de chat de Groq/OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8787)
+    argumentos_configuracion(parser)
+    args = parser.parse_args(argumentos)
+    
+    servidor = crear_servidor(configuracion_desde_argumentos(args), args.host, args.puerto)
+    print(f"Servidor simulado escuchando en {url_base(servidor)} (usa GROQ_BASE_URL={url_base(servidor)})")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
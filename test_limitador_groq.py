@@ -0,0 +1,48 @@
+import os
+import time
+import tempfile
+import unittest
+
+import database as bd
+from benchmark import ClienteGroqSimulado, generar_datos_sinteticos
+from chatbot import ChatBotIA
+from limitador_groq import LimitadorGroq
+
+
+class PruebaContextoLlenoConLimitador(unittest.TestCase):
+    # Con los límites por defecto, un turno con el contexto lleno no puede
+    # dejar sin tokens al resto de sesiones.
+    
+    def setUp(self):
+        self.directorio = tempfile.TemporaryDirectory()
+        self.ruta_anterior = bd.NOMBRE_BD
+        bd.NOMBRE_BD = os.path.join(self.directorio.name, "prueba.db")
+        bd.inicializar_base_datos()
+    
+    def tearDown(self):
+        bd.cerrar_conexiones()
+        bd.cache.vaciar()
+        bd.NOMBRE_BD = self.ruta_anterior
+        self.directorio.cleanup()
+    
+    def test_contexto_lleno_no_bloquea_a_otro_usuario(self):
+        id_historial_largo, = generar_datos_sinteticos(1, 400)
+        id_nuevo = bd.crear_usuario("sin_historial", "x")
+        
+        chatbot = ChatBotIA(cliente=ClienteGroqSimulado(), compactacion_automatica=False)
+        chatbot.limitador = LimitadorGroq(peticiones_minuto=30, tokens_minuto=6000)
+        
+        contexto = chatbot.construir_contexto_chat(id_historial_largo)
+        reserva = sum(bd.estimar_tokens(m['content']) for m in contexto) + chatbot.max_tokens
+        self.assertLessEqual(reserva, chatbot.limitador.tokens_por_peticion())
+        
+        chatbot.enviar_mensaje(id_historial_largo, "resume todo lo anterior", usar_cache=False)
+        
+        inicio = time.monotonic()
+        chatbot.enviar_mensaje(id_nuevo, "hola", usar_cache=False)
+        self.assertLess(time.monotonic() - inicio, 1.0)
+        self.assertEqual(chatbot.limitador.esperas, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()